@@ -0,0 +1,32 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Measure requests/sec on update/heartbeat with and without the verified credentials cache
+# Usage: python benchmarks/bench_auth_cache.py [requests]
+
+import sys
+import common
+
+requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+base_directory, owner_id, owner_pass = common.bootstrap()
+system_id, system_auth = common.provision(base_directory, 1, 'system')[0]
+
+import main
+
+client = main.app.test_client()
+url = f'{main.api_base_url}{main.api_value_update_prefix}heartbeat'
+
+
+def heartbeat():
+    response = client.post(url, data={'id': system_id, 'auth': system_auth})
+    assert response.status_code == 200, response.status_code
+
+
+results = {}
+for label, cache_size in [('without cache', 0), ('with cache', 4096)]:
+    main.api_auth_cache_size = cache_size
+    main.verified_credentials.clear()
+    results[label] = common.requests_per_second(heartbeat, requests)
+    print(f'update/heartbeat {label}: {results[label]:.1f} requests/sec')
+print(f'speedup: {results["with cache"] / results["without cache"]:.1f}x')
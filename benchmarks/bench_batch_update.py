@@ -0,0 +1,51 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Compare sending N values and a heartbeat as N update/main requests plus update/heartbeat, against one update/batch
+# Usage: python benchmarks/bench_batch_update.py [values per report] [reports]
+
+import sys
+from time import perf_counter
+import common
+
+values_per_report = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+reports = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+base_directory, owner_id, owner_pass = common.bootstrap()
+system_id, system_auth = common.provision(base_directory, 1, 'system')[0]
+
+import main
+from flask import json
+
+client = main.app.test_client()
+update_url = f'{main.api_base_url}{main.api_value_update_prefix}'
+values = {f'value{i}': {'used': i, 'free': 100 - i} for i in range(0, values_per_report)}
+
+
+def single_requests():
+    for value_name, data in values.items():
+        response = client.post(f'{update_url}main', data={'id': system_id, 'auth': system_auth,
+                                                           'value': value_name, 'data': json.dumps(data)})
+        assert response.status_code == 200, response.status_code
+    response = client.post(f'{update_url}heartbeat', data={'id': system_id, 'auth': system_auth})
+    assert response.status_code == 200, response.status_code
+
+
+def batch_request():
+    response = client.post(f'{update_url}batch', data={'id': system_id, 'auth': system_auth,
+                                                        'data': json.dumps(values), 'heartbeat': 'true'})
+    assert response.status_code == 200, response.status_code
+
+
+# Warm the credential cache so that both approaches are measured with it
+batch_request()
+print(f'{reports} reports of {values_per_report} values and a heartbeat')
+for label, function in [(f'{values_per_report} x update/main + update/heartbeat', single_requests),
+                        ('1 x update/batch', batch_request)]:
+    start = perf_counter()
+    for i in range(0, reports):
+        function()
+    # Include the time taken to write everything to the database, an empty transaction completes after everything
+    # before it
+    main.queue_database_operation(['transaction', []]).result()
+    print(f'{label}: {reports / (perf_counter() - start):.1f} reports/sec')
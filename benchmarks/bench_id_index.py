@@ -0,0 +1,44 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Compare checking whether an ID exists by scanning the auth table against id_exists(), with 10k and 100k credentials
+# Usage: python benchmarks/bench_id_index.py [lookups]
+
+import sys
+import sqlite3
+from contextlib import closing
+from time import perf_counter
+import common
+
+lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+base_directory, owner_id, owner_pass = common.bootstrap()
+
+import main
+
+# Every credential shares one password hash, as hashing 100k passwords would take far longer than the benchmark itself
+hashed_auth = main.hash_password('benchmark')
+credential_count = 0
+for target_count in [10000, 100000]:
+    with closing(sqlite3.connect(main.database_path)) as _con:
+        _con.executemany('INSERT INTO auth VALUES (?, ?, ?)',
+                         ((f'bench{i}', hashed_auth, 'system') for i in range(credential_count, target_count)))
+        _con.commit()
+    credential_count = target_count
+    main.load_known_ids()
+    # Look up a mix of IDs that exist and IDs that don't
+    ids = [f'bench{i * 7919 % credential_count}' if i % 2 == 0 else f'missing{i}' for i in range(0, lookups)]
+
+    start = perf_counter()
+    for _id in ids:
+        with closing(sqlite3.connect(main.database_path)) as _db, closing(_db.cursor()) as _cur:
+            (str(_id),) in _cur.execute('SELECT id FROM auth').fetchall()
+    scan_rate = lookups / (perf_counter() - start)
+
+    start = perf_counter()
+    for _id in ids:
+        main.id_exists(_id)
+    index_rate = lookups / (perf_counter() - start)
+
+    print(f'{credential_count} credentials: table scan {scan_rate:.1f} lookups/sec, '
+          f'id_exists() {index_rate:.1f} lookups/sec ({index_rate / scan_rate:.0f}x)')
@@ -0,0 +1,54 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Compare the cost of updating single values with value_storage set to "json" and "table", committing after each
+# update as the database writer does when it isn't busy, and after each batch as it does under load. Every update
+# changes the stored value, as SQLite writes an unchanged document much more cheaply than a changed one
+# Usage: python benchmarks/bench_value_storage.py [values per system] [value size in bytes] [operations] [batch size]
+
+import sys
+import random
+import sqlite3
+from contextlib import closing
+from time import perf_counter
+import common
+
+values_per_system = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+value_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+operations = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+batch_size = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+
+base_directory, owner_id, owner_pass = common.bootstrap()
+systems = common.provision(base_directory, 20, 'system')
+
+import main
+from flask import json
+
+
+# Create a function to build a value of value_size bytes that is different each time
+def build_value(rng):
+    return json.dumps({'sequence': rng.randrange(1000000), 'data': 'x' * value_size})
+
+
+print(f'{len(systems)} systems with {values_per_system} values of {value_size} bytes, {operations} operations')
+with closing(sqlite3.connect(main.database_path)) as _con, closing(_con.cursor()) as cursor:
+    for value_storage in ['json', 'table']:
+        main.api_value_storage = value_storage
+        rng = random.Random(0)
+        # Fill every system up with values
+        for system_id, system_auth in systems:
+            main.store_system_values(cursor, system_id,
+                                     {f'value{i}': build_value(rng) for i in range(0, values_per_system)})
+        _con.commit()
+        rates = []
+        for commit_every in [1, batch_size]:
+            start = perf_counter()
+            for i in range(0, operations):
+                main.store_system_value(cursor, rng.choice(systems)[0], f'value{rng.randrange(values_per_system)}',
+                                        build_value(rng))
+                if (i + 1) % commit_every == 0:
+                    _con.commit()
+            _con.commit()
+            rates.append(operations / (perf_counter() - start))
+        print(f'value_storage={value_storage}: {rates[0]:.1f} updates/sec committing each update, '
+              f'{rates[1]:.1f} updates/sec in batches of {batch_size}')
@@ -0,0 +1,88 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Shared helpers for the benchmark scripts in this directory.
+# Each benchmark runs against a throwaway copy of the server created in a temporary directory,
+# so they can be run from a checkout without touching conf.yaml, main.sqlite, historical/ or logs/
+
+import os
+import sys
+import tempfile
+import yaml
+from time import perf_counter
+
+# Make main.py and initial_setup.py importable when a benchmark is run as "python benchmarks/<name>.py"
+repo_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_directory not in sys.path:
+    sys.path.insert(0, repo_directory)
+
+import initial_setup
+
+
+def bootstrap(api_config=None):
+    """Create a throwaway base directory the same way initial_setup.py does, and point CONF_FILE at it.
+
+    Returns the base directory along with the ID and auth code of an owner credential.
+    """
+    base_directory = tempfile.mkdtemp(prefix='status-server-bench-').replace('\\', '/')
+    os.makedirs(f'{base_directory}/historical/')
+    os.makedirs(f'{base_directory}/logs/')
+    conf_yaml = {
+        'main_conf': {
+            'api_config': {
+                'value_update_prefix': 'update/',
+                'value_fetch_prefix': 'fetch/',
+                'admin_prefix': 'admin/',
+                'general_prefix': 'general/',
+                'api_base_url': '/api/v2/',
+                'flask_debug': False,
+                'flask_port': 5000,
+                'flask_address': 'localhost',
+                'enable_historical': True
+            },
+            'environment_config': {
+                'base_directory': f'{base_directory}/',
+                'database_name': 'main.sqlite',
+                'log_directory': 'logs/'
+            }
+        }
+    }
+    conf_yaml['main_conf']['api_config'].update(api_config or {})
+    with open(f'{base_directory}/conf.yaml', 'w') as f:
+        yaml.dump(conf_yaml, f)
+    con = initial_setup.create_database(f'{base_directory}/main.sqlite')
+    owner_id, owner_pass, owner_hashed_pass = initial_setup.generate_new_auth()
+    con.execute('INSERT INTO auth VALUES(?, ?, "owner")', (owner_id, owner_hashed_pass,))
+    con.commit()
+    con.close()
+    os.environ['CONF_FILE'] = f'{base_directory}/conf.yaml'
+    return f'{base_directory}/', owner_id, owner_pass
+
+
+def provision(base_directory, count, access_level='system'):
+    """Insert count credentials with the given access level directly into the database.
+
+    Returns a list of (id, auth) tuples.
+    """
+    import sqlite3
+    credentials = []
+    con = sqlite3.connect(f'{base_directory}main.sqlite')
+    for i in range(0, count):
+        new_id, new_auth, hashed_new_auth = initial_setup.generate_new_auth()
+        new_id = f'{new_id}{i}'
+        con.execute('INSERT INTO auth VALUES(?, ?, ?)', (new_id, hashed_new_auth, access_level,))
+        if access_level == 'system':
+            con.execute('INSERT INTO systems_stats VALUES(?, ?, ?, ?)', (new_id, '', None, '{}',))
+            os.makedirs(f'{base_directory}historical/{new_id}/')
+        credentials.append((new_id, new_auth))
+    con.commit()
+    con.close()
+    return credentials
+
+
+def requests_per_second(function, requests):
+    """Call function() requests times and return the achieved rate."""
+    start = perf_counter()
+    for i in range(0, requests):
+        function()
+    return requests / (perf_counter() - start)
@@ -0,0 +1,249 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Drive a mix of heartbeat, update/main, update/logging and fetch traffic at a throwaway server, and report the
+# throughput, p50/p99 latency of each request type and how long it takes for a write to be visible to fetch/main.
+# Every run with the same arguments sends the same sequence of requests from each thread, and the results can be
+# written as JSON and compared with an earlier run
+# Usage: python benchmarks/load_test.py [--mode test|http] [--systems N] [--clients N] [--threads N]
+#                                       [--duration seconds] [--mix heartbeat=40,main=30,...] [--seed N]
+#                                       [--output results.json] [--compare earlier.json]
+
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+from time import perf_counter, sleep, time
+import yaml
+import common
+
+request_types = ['heartbeat', 'main', 'logging', 'fetch', 'bulk']
+
+parser = argparse.ArgumentParser(description='Run a mixed load against a throwaway copy of the server')
+parser.add_argument('--mode', choices=['test', 'http'], default='test',
+                    help='"test" calls the app in this process with the Flask test client, "http" starts main.py '
+                         'and sends requests over keep-alive HTTP connections')
+parser.add_argument('--systems', type=int, default=20, help='the number of system credentials to provision')
+parser.add_argument('--clients', type=int, default=5, help='the number of client credentials to provision')
+parser.add_argument('--threads', type=int, default=8, help='the number of threads sending requests')
+parser.add_argument('--duration', type=float, default=10, help='the number of seconds to send requests for')
+parser.add_argument('--values', type=int, default=5, help='the number of value names each system sends')
+parser.add_argument('--mix', default='heartbeat=40,main=30,logging=10,fetch=15,bulk=5',
+                    help=f'the relative weight of each request type, from {", ".join(request_types)}')
+parser.add_argument('--probe-interval', type=float, default=0.1,
+                    help='the number of seconds between writes that are timed until they are visible to fetch/main')
+parser.add_argument('--seed', type=int, default=0, help='the seed for the sequence of requests sent by each thread')
+parser.add_argument('--config', default='{}', help='a JSON dictionary of extra api_config settings for the server')
+parser.add_argument('--output', help='write the results to this JSON file')
+parser.add_argument('--compare', help='compare the results against an earlier JSON results file')
+args = parser.parse_args()
+
+mix = {}
+for item in args.mix.split(','):
+    request_type, weight = item.split('=')
+    if request_type not in request_types:
+        parser.error(f'unrecognised request type {request_type} in --mix')
+    mix[request_type] = float(weight)
+if args.clients < 1:
+    parser.error('--clients must be at least 1, the fetches and visibility probe use client credentials')
+
+base_directory, owner_id, owner_pass = common.bootstrap(json.loads(args.config))
+systems = common.provision(base_directory, args.systems, 'system')
+clients = common.provision(base_directory, args.clients, 'client')
+# The probe system is only written to by the probe thread, so that each of its writes can be told apart
+probe_id, probe_auth = common.provision(base_directory, 1, 'system')[0]
+value_names = [f'value{i}' for i in range(0, args.values)]
+base_url = '/api/v2/'
+
+server = None
+if args.mode == 'test':
+    import main
+
+    def new_session():
+        client = main.app.test_client()
+
+        def post(path, data):
+            response = client.post(f'{base_url}{path}', data=data)
+            return response.status_code, response.data
+        return post
+else:
+    import requests
+
+    # Start main.py on a free port against the throwaway base directory
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    with open(f'{base_directory}conf.yaml') as f:
+        conf = yaml.safe_load(f)
+    conf['main_conf']['api_config'].update({'flask_address': '127.0.0.1', 'flask_port': port})
+    with open(f'{base_directory}conf.yaml', 'w') as f:
+        yaml.dump(conf, f)
+    server = subprocess.Popen([sys.executable, os.path.join(common.repo_directory, 'main.py')], env=os.environ,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if time() > deadline or server.poll() is not None:
+                server.kill()
+                sys.exit('The server did not start')
+            sleep(0.1)
+
+    def new_session():
+        session = requests.Session()
+
+        def post(path, data):
+            response = session.post(f'http://127.0.0.1:{port}{base_url}{path}', data=data)
+            return response.status_code, response.content
+        return post
+
+
+# Create a function to build the path and arguments of a request of the given type
+def build_request(rng, request_type, sequence):
+    system_id, system_auth = rng.choice(systems)
+    if request_type == 'heartbeat':
+        return 'update/heartbeat', {'id': system_id, 'auth': system_auth}
+    if request_type == 'main':
+        data = json.dumps({'sequence': sequence, 'used': rng.randint(0, 100), 'free': rng.randint(0, 100)})
+        return 'update/main', {'id': system_id, 'auth': system_auth, 'value': rng.choice(value_names), 'data': data}
+    if request_type == 'logging':
+        return 'update/logging', {'id': system_id, 'auth': system_auth, 'data': f'load test entry {sequence}'}
+    client_id, client_auth = rng.choice(clients)
+    if request_type == 'fetch':
+        return 'fetch/main', {'id': client_id, 'auth': client_auth, 'system_id': system_id,
+                              'value': rng.choice(value_names)}
+    system_ids = [rng.choice(systems)[0] for i in range(0, 5)]
+    return 'fetch/bulk', {'id': client_id, 'auth': client_auth, 'system_ids': ','.join(system_ids)}
+
+
+# Create a function to work out the p50, p99 and other statistics of a list of latencies in seconds
+def summarise(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'requests': 0, 'errors': errors}
+
+    def percentile(fraction):
+        return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)] * 1000
+    return {'requests': len(latencies), 'errors': errors, 'per_second': len(latencies) / elapsed,
+            'mean_ms': sum(latencies) / len(latencies) * 1000, 'p50_ms': percentile(0.5),
+            'p99_ms': percentile(0.99), 'max_ms': latencies[-1] * 1000}
+
+
+# Each thread records the latency of every request and the number of responses that weren't 200, by request type
+latencies = {request_type: [] for request_type in request_types}
+errors = {request_type: 0 for request_type in request_types}
+results_lock = threading.Lock()
+visibility_lags = []
+stopping = threading.Event()
+
+
+def run_load_thread(thread_number):
+    rng = random.Random(args.seed * 1000 + thread_number)
+    post = new_session()
+    weights = [mix.get(request_type, 0) for request_type in request_types]
+    thread_latencies = {request_type: [] for request_type in request_types}
+    thread_errors = {request_type: 0 for request_type in request_types}
+    sequence = 0
+    while not stopping.is_set():
+        request_type = rng.choices(request_types, weights)[0]
+        path, data = build_request(rng, request_type, sequence)
+        sequence += 1
+        start = perf_counter()
+        status, body = post(path, data)
+        thread_latencies[request_type].append(perf_counter() - start)
+        # fetch/main returns 400 for values that haven't been written yet
+        if status != 200 and not (request_type == 'fetch' and status == 400):
+            thread_errors[request_type] += 1
+    with results_lock:
+        for request_type in request_types:
+            latencies[request_type] += thread_latencies[request_type]
+            errors[request_type] += thread_errors[request_type]
+
+
+# Write a new value to the probe system every probe_interval seconds, then time how long it takes from sending the
+# write until fetch/main returns it
+def run_visibility_probe():
+    post = new_session()
+    client_id, client_auth = clients[0]
+    sequence = 0
+    while not stopping.wait(args.probe_interval):
+        sequence += 1
+        expected = json.dumps({'probe': sequence})
+        start = perf_counter()
+        post('update/main', {'id': probe_id, 'auth': probe_auth, 'value': 'probe', 'data': expected})
+        while not stopping.is_set():
+            status, body = post('fetch/main', {'id': client_id, 'auth': client_auth, 'system_id': probe_id,
+                                               'value': 'probe'})
+            if status == 200 and json.loads(body) == {'probe': sequence}:
+                visibility_lags.append(perf_counter() - start)
+                break
+
+
+# Check every credential once before timing anything, so that the verified credentials cache is warm
+post = new_session()
+for system_id, system_auth in systems + [(probe_id, probe_auth)]:
+    post('update/heartbeat', {'id': system_id, 'auth': system_auth})
+for client_id, client_auth in clients:
+    post('general/check_auth', {'id': client_id, 'auth': client_auth})
+
+threads = [threading.Thread(target=run_load_thread, args=(i,)) for i in range(0, args.threads)]
+threads.append(threading.Thread(target=run_visibility_probe))
+start = perf_counter()
+for thread in threads:
+    thread.start()
+sleep(args.duration)
+stopping.set()
+for thread in threads:
+    thread.join()
+elapsed = perf_counter() - start
+stats = json.loads(post('admin/stats', {'id': owner_id, 'auth': owner_pass})[1])
+if server is not None:
+    server.terminate()
+    server.wait()
+
+results = {
+    'arguments': vars(args),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'elapsed': elapsed,
+    'total': summarise([latency for request_type in request_types for latency in latencies[request_type]],
+                       sum(errors.values()), elapsed),
+    'requests': {request_type: summarise(latencies[request_type], errors[request_type], elapsed)
+                 for request_type in request_types if mix.get(request_type)},
+    'visibility_lag': summarise(visibility_lags, 0, elapsed),
+    'database_writer': stats['database_writer']
+}
+
+print(f'{args.mode} mode, {args.threads} threads, {args.systems} systems, {args.clients} clients, {elapsed:.1f}s')
+for label, summary in list(results['requests'].items()) + [('total', results['total']),
+                                                            ('visibility lag', results['visibility_lag'])]:
+    if summary['requests'] == 0:
+        print(f'{label:>15}: no requests')
+        continue
+    print(f'{label:>15}: {summary["requests"]:>8} requests {summary["per_second"]:>9.1f}/s  '
+          f'p50 {summary["p50_ms"]:>8.2f}ms  p99 {summary["p99_ms"]:>8.2f}ms  errors {summary["errors"]}')
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+if args.compare:
+    with open(args.compare) as f:
+        earlier = json.load(f)
+    print(f'Compared with {args.compare} (this run / earlier run):')
+    for label in list(results['requests']) + ['total', 'visibility_lag']:
+        summary = results['requests'].get(label, results.get(label))
+        earlier_summary = earlier['requests'].get(label, earlier.get(label)) or {}
+        if not summary.get('requests') or not earlier_summary.get('requests'):
+            continue
+        print(f'{label:>15}: throughput x{summary["per_second"] / earlier_summary["per_second"]:.2f}  '
+              f'p50 x{summary["p50_ms"] / earlier_summary["p50_ms"]:.2f}  '
+              f'p99 x{summary["p99_ms"] / earlier_summary["p99_ms"]:.2f}')
@@ -38,6 +38,18 @@ def generate_new_auth():
     return id_out, pass_out, hashed_pass_out
 
 
+def create_database(database_path):
+    """Create a new database with the tables used by main.py."""
+    con = sqlite3.connect(database_path)
+    cur = con.cursor()
+    cur.execute('CREATE TABLE "auth" ("id" TEXT,"password" TEXT,"access_level" TEXT,PRIMARY KEY("id"))')
+    cur.execute('CREATE TABLE "systems_stats" ("id" TEXT,"system_name" TEXT,"heartbeat" TEXT,"system_data" TEXT,PRIMARY KEY("id"))')
+    cur.execute('CREATE TABLE "system_values" ("system_id" TEXT,"value_name" TEXT,"data" TEXT,'
+                'PRIMARY KEY("system_id","value_name")) WITHOUT ROWID')
+    con.commit()
+    return con
+
+
 if __name__ == '__main__':
     print('Status server initial setup wizard')
     print('Copyright (C) 2021 Alex Verrico (https://alexverrico.com/)')
@@ -79,7 +91,10 @@ if __name__ == '__main__':
                 'value_update_prefix': 'update/',
                 'value_fetch_prefix': 'fetch/',
                 'admin_prefix': 'admin/',
-                'general_prefix': 'general/'
+                'general_prefix': 'general/',
+                'auth_cache_size': 4096,
+                'auth_cache_ttl': 300,
+                'value_storage': 'table'
             },
             'environment_config': {
                 'base_directory': f'{base_path}/',
@@ -140,11 +155,8 @@ if __name__ == '__main__':
 
     if os.path.isfile(f'{base_path}/main.sqlite') is True:
         os.remove(f'{base_path}/main.sqlite')
-    con = sqlite3.connect(f'{base_path}/main.sqlite')
+    con = create_database(f'{base_path}/main.sqlite')
     cur = con.cursor()
-    cur.execute('CREATE TABLE "auth" ("id" TEXT,"password" TEXT,"access_level" TEXT,PRIMARY KEY("id"))')
-    cur.execute('CREATE TABLE "systems_stats" ("id" TEXT,"system_name" TEXT,"heartbeat" TEXT,"system_data" TEXT,PRIMARY KEY("id"))')
-    con.commit()
     owner_id, owner_pass, owner_hashed_pass = generate_new_auth()
     cur.execute('INSERT INTO auth VALUES(?, ?, "owner")', (owner_id, owner_hashed_pass,))
     con.commit()
@@ -4,21 +4,44 @@
 # #####################
 # ### BEGIN IMPORTS ###
 # #####################
-from flask import Flask, request, jsonify, json, abort
+from flask import Flask, Response, request, jsonify, json, abort, g
 import sqlite3
 from dotenv import load_dotenv
 import os
-from queue import Queue
-from threading import Timer
-from time import sleep, time
-from random import choice
+import sys
+import gzip
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, Event, Condition
+from time import time, sleep
+import atexit
+from random import choice, random
 from string import ascii_lowercase, digits as ascii_digits, ascii_uppercase
 import yaml
 from contextlib import closing
 import hashlib
+import hmac
 import binascii
+import struct
+import re
+import ast
+from bisect import bisect_left, bisect_right
 import python_confChecker as confChecker
 from functools import wraps
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, deque
+from heapq import heappush, heappop, heapify
+import math
+import cProfile
+import copy
+import socket
+import selectors
+from itertools import islice, count
+from multiprocessing import AuthenticationError, get_context
+from multiprocessing.connection import Listener, Client
+from urllib.parse import urlsplit, parse_qs
+import numpy
+from importlib.machinery import ModuleSpec
+from password_hashing import pbkdf2_hash
 
 # ###################
 # ### END IMPORTS ###
@@ -71,11 +94,75 @@ api_value_fetch_prefix = api_config['value_fetch_prefix']
 api_admin_prefix = api_config['admin_prefix']
 api_general_prefix = api_config['general_prefix']
 api_enable_historical = api_config['enable_historical']
+# Optional values, these fall back to a default so that older conf.yaml files keep working
+api_auth_cache_size = api_config.get('auth_cache_size', 4096)
+api_auth_cache_ttl = api_config.get('auth_cache_ttl', 300)
+api_database_batch_size = api_config.get('database_batch_size', 500)
+api_database_batch_delay = api_config.get('database_batch_delay', 0)
+api_value_storage = api_config.get('value_storage', 'table')
+api_database_write_timeout = api_config.get('database_write_timeout', 10)
+api_database_journal = api_config.get('database_journal', True)
+api_database_journal_sync = api_config.get('database_journal_sync', True)
+api_database_journal_segment_size = api_config.get('database_journal_segment_size', 16777216)
+api_database_queue_max_depth = api_config.get('database_queue_max_depth', 100000)
+api_bulk_new_auth_limit = api_config.get('bulk_new_auth_limit', 1000)
+api_password_hash_processes = api_config.get('password_hash_processes', os.cpu_count() or 1)
+api_historical_flush_interval = api_config.get('historical_flush_interval', 5)
+api_historical_buffer_limit = api_config.get('historical_buffer_limit', 10000)
+api_historical_segment_size = api_config.get('historical_segment_size', 4194304)
+api_historical_segment_age = api_config.get('historical_segment_age', 86400)
+api_historical_import_text = api_config.get('historical_import_text', True)
+api_history_max_buckets = api_config.get('history_max_buckets', 1000)
+api_historical_compaction_interval = api_config.get('historical_compaction_interval', 60)
+api_historical_retention = api_config.get('historical_retention', 0)
+api_historical_store_patches = api_config.get('historical_store_patches', False)
+api_log_queue_size = api_config.get('log_queue_size', 10000)
+api_log_overflow = api_config.get('log_overflow', 'drop')
+api_log_block_timeout = api_config.get('log_block_timeout', 0.5)
+api_log_batch_max_entries = api_config.get('log_batch_max_entries', 1000)
+api_log_batch_size = api_config.get('log_batch_size', 1000)
+api_log_open_files = api_config.get('log_open_files', 128)
+api_log_rotate_size = api_config.get('log_rotate_size', 10485760)
+api_log_rotate_age = api_config.get('log_rotate_age', 0)
+api_log_compress = api_config.get('log_compress', False)
+api_log_index_interval = api_config.get('log_index_interval', 65536)
+api_log_fetch_max_entries = api_config.get('log_fetch_max_entries', 1000)
+api_heartbeat_timeout = api_config.get('heartbeat_timeout', 300)
+api_heartbeat_history_size = api_config.get('heartbeat_history_size', 1000)
+api_subscribe_address = api_config.get('subscribe_address', api_config['flask_address'])
+api_subscribe_port = api_config.get('subscribe_port', 0)
+api_subscribe_max_connections = api_config.get('subscribe_max_connections', 1000)
+api_subscribe_buffer_size = api_config.get('subscribe_buffer_size', 10000)
+api_subscribe_heartbeat_interval = api_config.get('subscribe_heartbeat_interval', 5)
+api_subscribe_keepalive_interval = api_config.get('subscribe_keepalive_interval', 15)
+api_subscribe_poll_timeout = api_config.get('subscribe_poll_timeout', 30)
+api_subscribe_max_waiters = api_config.get('subscribe_max_waiters', 50)
+api_subscribe_max_output = api_config.get('subscribe_max_output', 1048576)
+api_server_mode = api_config.get('server_mode', 'single')
+api_writer_authkey = api_config.get('writer_authkey')
+api_writer_threads = api_config.get('writer_threads', 32)
+api_writer_connect_timeout = api_config.get('writer_connect_timeout', 10)
+api_profile_fraction = api_config.get('profile_fraction', 0)
+api_rate_limit_heartbeat = api_config.get('rate_limit_heartbeat', 0)
+api_rate_limit_values = api_config.get('rate_limit_values', 0)
+api_rate_limit_logging = api_config.get('rate_limit_logging', 0)
+api_rate_limit_burst = api_config.get('rate_limit_burst', 10)
+api_rate_limit_table_size = api_config.get('rate_limit_table_size', 100000)
 
 base_directory = environment_config['base_directory']
 database_path = f"{base_directory}{environment_config['database_name']}"
 log_directory = f"{base_directory}{environment_config['log_directory']}"
 historical_directory = f"{base_directory}historical/"
+database_journal_directory = f"{base_directory}journal/"
+profile_directory = f"{base_directory}profiles/"
+# The writer process listens on a Unix socket by default, writer_address can also be a [host, port] list
+writer_address = tuple(api_config['writer_address']) if type(api_config.get('writer_address')) == list else \
+    api_config.get('writer_address', f'{base_directory}writer.sock')
+# The writer process runs the functions that request workers ask it to, so it must never accept connections from the
+# network without writer_authkey. The Unix socket is only accessible to the user running the server
+if api_server_mode == 'prefork' and type(writer_address) == tuple and not api_writer_authkey:
+    print('ERROR:000018 writer_authkey must be set when writer_address is a TCP address', file=sys.stderr)
+    sys.exit(1)
 
 # Create the flask object
 app = Flask(__name__)
@@ -91,96 +178,853 @@ app.config['DEBUG'] = api_config['flask_debug']
 # ### BEGIN GENERAL FUNCTIONS ###
 # ###############################
 
+# In prefork mode several request worker processes share one writer process, which is the only process that writes to
+# the database, logs, historical data and subscriptions. Functions that write are decorated with writer_function, and
+# in a request worker they are called in the writer process through writer_connection instead.
+# writer_connection is None in the writer process, and when the server runs as a single process
+writer_connection = None
+writer_functions = {}
+
+
+# Create a decorator function for functions that must run in the writer process.
+# If wait is False then a request worker doesn't wait for the function to finish, and it always returns None
+def writer_function(wait=True):
+    def decorator(function):
+        writer_functions[function.__name__] = function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if writer_connection is None:
+                return function(*args, **kwargs)
+            return call_writer_function(function.__name__, args, kwargs, wait)
+        return wrapper
+    return decorator
+
+
 # Create a custom logging function
 def system_log(data):
-    # Open the file SYSTEM.txt in the configured log directory in append mode
-    with open(f"{log_directory}SYSTEM.txt", 'a') as log_file:
-        # Append the provided data to the file
-        log_file.write(f'{time()}: {str(data)}\n\n\n')
+    # Append the provided data to the file SYSTEM.txt in the configured log directory
+    write_log('SYSTEM', data)
     return
 
 
-# Create a function that will run asynchronously to write to the database
-def run_queue():
-    # Start a loop that will run until killed
-    while True:
-        # If a job exists in the queue
-        if database_operations_queue.empty() is False:
-            # Fetch the job from the queue (also removes it from the queue to avoid executing it multiple times)
-            operation = database_operations_queue.get()
-            # Check if the job type is update_row
-            if operation[0] == 'update_row':
-                # Create a connection the database which will automatically close
-                with closing(sqlite3.connect(database_path)) as _con, closing(_con.cursor()) as cursor:
-                    # Define the SQL command to run
-                    db_update_cmd = 'UPDATE %s SET %s = ? WHERE id = ?'
-                    # Run the SQL command
-                    cursor.execute(db_update_cmd % (operation[1], operation[3]), (operation[4], operation[2],))
-                    # Commit the changes
-                    _con.commit()
-                    # Delete the variables that we are finished with to avoid any chance of a memory leak
-                    del operation
-                    del db_update_cmd
-                    # Jump back to the start of the loop
-                    continue
-            # Check if the job type is new_row
-            elif operation[0] == 'new_row':
-                # Create a connection the database which will automatically close
-                with closing(sqlite3.connect(database_path)) as _con, closing(_con.cursor()) as cursor:
-                    # Define the SQL command to run
-                    db_update_cmd = 'INSERT INTO %s VALUES (%s)'
-                    # Creat the tuple of values to insert into the new row
-                    param_list = []
-                    for i in range(0, len(operation[2])):
-                        param_list.append('?')
-                    param_str = ','.join(param_list)
-                    # Run the SQL command
-                    cursor.execute(db_update_cmd % (operation[1], param_str), operation[2])
-                    # Commit the changes
-                    _con.commit()
-                    # Delete the variables that we are finished with to avoid any chance of a memory leak
-                    del operation
-                    del db_update_cmd
-                    del param_list
-                    del param_str
-                    # Jump back to the start of the loop
-                    continue
-            # Check if the job type is update_system_value
-            elif operation[0] == 'update_system_value':
-                # Create a connection the database which will automatically close
-                with closing(sqlite3.connect(database_path)) as _con, closing(_con.cursor()) as cursor:
-                    # Define the SQL command to run to get the current system value(s)
-                    db_fetch_value_cmd = 'SELECT system_data FROM systems_stats WHERE id = ?'
-                    # Fetch the current value(s) from the database
-                    old_values = cursor.execute(db_fetch_value_cmd, (operation[1],)).fetchone()[0]
-                    # Load the current values as a json object to make manipulation easier
-                    new_values = json.loads(old_values)
-                    # Store the new value
-                    new_values[operation[2]] = json.loads(operation[3])
-                    # Define the SQL command to store the new value
-                    db_update_value_cmd = 'UPDATE systems_stats SET system_data = ? WHERE id = ?'
-                    # Run the SQL command to store the new values
-                    cursor.execute(db_update_value_cmd, (json.dumps(new_values), operation[1],))
-                    # Commit the changes
-                    _con.commit()
-                    # Delete the variables that we are finished with to avoid any chance of a memory leak
-                    del operation
-                    del db_fetch_value_cmd
-                    del db_update_value_cmd
-                    del old_values
-                    del new_values
-                    # Jump back to the start of the loop
+# Create a function to add any tables that are missing from older databases
+def create_database_tables():
+    with closing(sqlite3.connect(database_path)) as _con:
+        # Each value of each system is stored in its own row when value_storage is set to "table"
+        _con.execute('CREATE TABLE IF NOT EXISTS "system_values" ("system_id" TEXT,"value_name" TEXT,"data" TEXT,'
+                     'PRIMARY KEY("system_id","value_name")) WITHOUT ROWID')
+        # The sequence number of the last operation from the database journal that has been committed
+        _con.execute('CREATE TABLE IF NOT EXISTS "database_journal_checkpoint" ('
+                     '"id" INTEGER PRIMARY KEY CHECK ("id" = 0),"sequence" INTEGER)')
+        _con.commit()
+
+
+# Create a function to move any stored values into the layout set by value_storage.
+# This migrates the systems_stats.system_data column into system_values and vice versa, so the setting can be changed
+def migrate_value_storage():
+    with closing(sqlite3.connect(database_path)) as _con, closing(_con.cursor()) as cursor:
+        if api_value_storage == 'table':
+            # Copy every value out of the system_data JSON of each system into its own row
+            for system_id, system_data in cursor.execute(
+                    'SELECT id, system_data FROM systems_stats WHERE system_data NOT IN (\'\', \'{}\')').fetchall():
+                for value_name, data in json.loads(system_data).items():
+                    cursor.execute('INSERT OR REPLACE INTO system_values VALUES (?, ?, ?)',
+                                   (system_id, value_name, json.dumps(data),))
+                cursor.execute('UPDATE systems_stats SET system_data = \'{}\' WHERE id = ?', (system_id,))
+        else:
+            # Fold the rows of each system back into its system_data JSON
+            for system_id, in cursor.execute('SELECT DISTINCT system_id FROM system_values').fetchall():
+                system_data = cursor.execute('SELECT system_data FROM systems_stats WHERE id = ?',
+                                             (system_id,)).fetchone()
+                if system_data is None:
                     continue
+                new_values = json.loads(system_data[0] or '{}')
+                for value_name, data in cursor.execute('SELECT value_name, data FROM system_values WHERE system_id = ?',
+                                                       (system_id,)).fetchall():
+                    new_values[value_name] = json.loads(data)
+                cursor.execute('UPDATE systems_stats SET system_data = ? WHERE id = ?',
+                               (json.dumps(new_values), system_id,))
+            cursor.execute('DELETE FROM system_values')
+        _con.commit()
+
+
+# Create a function to store several values for a system at once, in whichever layout is set by value_storage.
+# values is a dictionary of value names to JSON strings
+def store_system_values(cursor, system_id, values):
+    if api_value_storage == 'table':
+        # Only the rows for these values are touched
+        cursor.executemany('INSERT OR REPLACE INTO system_values VALUES (?, ?, ?)',
+                           [(system_id, value_name, data,) for value_name, data in values.items()])
+        return
+    # Define the SQL command to run to get the current system value(s)
+    db_fetch_value_cmd = 'SELECT system_data FROM systems_stats WHERE id = ?'
+    # Fetch the current value(s) from the database
+    old_values = cursor.execute(db_fetch_value_cmd, (system_id,)).fetchone()[0]
+    # Load the current values as a json object to make manipulation easier
+    new_values = json.loads(old_values)
+    # Store the new values
+    for value_name, data in values.items():
+        new_values[value_name] = json.loads(data)
+    # Define the SQL command to store the new value
+    db_update_value_cmd = 'UPDATE systems_stats SET system_data = ? WHERE id = ?'
+    # Run the SQL command to store the new values
+    cursor.execute(db_update_value_cmd, (json.dumps(new_values), system_id,))
+
+
+# Create a function to store a single value for a system, in whichever layout is set by value_storage
+def store_system_value(cursor, system_id, value_name, data):
+    store_system_values(cursor, system_id, {value_name: data})
+
+
+# Create a dictionary to hold the latest heartbeat and values of every system in memory, keyed by system ID.
+# The update endpoints change this straight away and the database writer persists the changes in the background,
+# so the fetch endpoints never need to wait for the database or read a value that is still waiting in the queue
+system_state = {}
+# Create a lock to stop multiple request threads from modifying the system state at the same time
+system_state_lock = Lock()
+# Every change to a heartbeat or value is given a new version from this counter, which the fetch endpoints use as ETags
+# and for since_version. It starts at the current time in microseconds so that versions keep increasing across
+# restarts, and everything loaded from the database is given the starting version
+system_state_version = int(time() * 1000000)
+
+
+# Create a function to create the state of a system, versions holds the version of each value
+def new_system_state(heartbeat=None, values=None):
+    values = {} if values is None else values
+    return {'heartbeat': heartbeat, 'heartbeat_version': system_state_version, 'values': values,
+            'versions': {value_name: system_state_version for value_name in values}}
+
+
+# Create a function to get a new version, this must be called while holding system_state_lock
+def next_system_state_version():
+    global system_state_version
+    system_state_version += 1
+    return system_state_version
+
+
+# Create a function to load the heartbeat and values of every system from the database into system_state
+def load_system_state():
+    new_state = {}
+    with closing(sqlite3.connect(database_path)) as _con, closing(_con.cursor()) as cursor:
+        for system_id, heartbeat, system_data in cursor.execute(
+                'SELECT id, heartbeat, system_data FROM systems_stats').fetchall():
+            values = {}
+            # Store each value as a JSON string so that fetches don't need to serialise it again
+            for value_name, data in json.loads(system_data or '{}').items():
+                values[value_name] = json.dumps(data)
+            new_state[system_id] = new_system_state(heartbeat, values)
+        if api_value_storage == 'table':
+            for system_id, value_name, data in cursor.execute(
+                    'SELECT system_id, value_name, data FROM system_values').fetchall():
+                if system_id in new_state:
+                    new_state[system_id]['values'][value_name] = data
+                    new_state[system_id]['versions'][value_name] = system_state_version
+    with system_state_lock:
+        system_state.clear()
+        system_state.update(new_state)
+
+
+# Create a function to add a newly created system to system_state. The system is given a new version, so that fetch/bulk
+# reports it as changed to clients that already have the previous version
+@writer_function()
+def add_system_state(system_id):
+    with system_state_lock:
+        if system_id not in system_state:
+            state = system_state[system_id] = new_system_state()
+            state['heartbeat_version'] = next_system_state_version()
+            replicate_change(('system', system_id, state['heartbeat_version']))
+
+
+# Create a function to store the latest heartbeat of a system and queue it to be written to the database, then pass it
+# to the heartbeat monitor and subscribers. The heartbeat is queued before system_state is changed, so system_state is
+# left as it was if it can't be queued
+@writer_function()
+def set_system_heartbeat(system_id, heartbeat):
+    with system_state_lock:
+        future, sequence = append_database_operation(['update_row', 'systems_stats', system_id, 'heartbeat', heartbeat])
+        state = system_state.setdefault(system_id, new_system_state())
+        state['heartbeat'] = heartbeat
+        state['heartbeat_version'] = next_system_state_version()
+        replicate_change(('heartbeat', system_id, heartbeat, state['heartbeat_version']))
+    sync_database_journal(sequence)
+    record_system_heartbeat(system_id, float(heartbeat))
+    publish_heartbeat(system_id, float(heartbeat))
+
+
+# Create a function to store the latest value of a system as a JSON string and queue it to be written to the database,
+# then pass it to subscribers
+@writer_function()
+def set_system_value(system_id, value_name, data):
+    set_system_values(system_id, {value_name: data})
+
+
+# Create a function to store several values of a system at once and queue them to be written to the database, then
+# pass them to subscribers. values is a dictionary of value names to JSON strings, and every value is given the same
+# version. Like heartbeats, the values are queued before system_state is changed
+@writer_function()
+def set_system_values(system_id, values):
+    with system_state_lock:
+        future, sequence = append_database_operation(['update_system_values', system_id, values])
+        state = system_state.setdefault(system_id, new_system_state())
+        version = next_system_state_version()
+        state['values'].update(values)
+        state['versions'].update({value_name: version for value_name in values})
+        replicate_change(('values', system_id, values, version))
+    sync_database_journal(sequence)
+    publish_value_changes(system_id, values)
+
+
+# Create a function to fetch a copy of the latest heartbeat and values of a system, this returns None if it doesn't
+# exist. If value_names is not None then only those values are included. If since_version is not None then only the
+# values that have changed since that version are included, and the heartbeat is only included if it has changed
+def get_system_snapshot(system_id, value_names=None, since_version=None):
+    with system_state_lock:
+        if system_id not in system_state:
+            return None
+        state = system_state[system_id]
+        if value_names is None:
+            value_names = state['values'].keys()
+        snapshot = {'values': {value_name: state['values'][value_name] for value_name in value_names
+                               if value_name in state['values'] and
+                               (since_version is None or state['versions'][value_name] > since_version)}}
+        if since_version is None or state['heartbeat_version'] > since_version:
+            snapshot['heartbeat'] = state['heartbeat']
+        return snapshot
+
+
+# Create a function to store the latest value of a system as a JSON string and queue it to be written to the database,
+# but only if its version is still expected_version. expected_version is None if the value didn't exist, this returns
+# False if it has changed since
+def compare_and_set_system_value(system_id, value_name, data, expected_version):
+    with system_state_lock:
+        state = system_state.setdefault(system_id, new_system_state())
+        if state['versions'].get(value_name) != expected_version:
+            return False
+        future, sequence = append_database_operation(['update_system_value', system_id, value_name, data])
+        state['values'][value_name] = data
+        state['versions'][value_name] = next_system_state_version()
+        replicate_change(('values', system_id, {value_name: data}, state['versions'][value_name]))
+    sync_database_journal(sequence)
+    publish_value_changes(system_id, {value_name: data})
+    return True
+
+
+# Create a function to apply a JSON merge patch (RFC 7396) to a document. The document is modified in place
+def apply_merge_patch(document, patch):
+    if type(patch) != dict:
+        return patch
+    if type(document) != dict:
+        document = {}
+    for key, value in patch.items():
+        if value is None:
+            document.pop(key, None)
+        else:
+            document[key] = apply_merge_patch(document.get(key), value)
+    return document
+
+
+# Create a function to find the parent of the location that a JSON pointer (RFC 6901) refers to in a document.
+# This returns the parent and the last token of the pointer, or (None, None) for the whole document
+def resolve_json_pointer(document, pointer):
+    if pointer == '':
+        return None, None
+    if type(pointer) != str or pointer.startswith('/') is False:
+        raise ValueError(f'invalid JSON pointer {json.dumps(pointer)}')
+    tokens = [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+    parent = document
+    for token in tokens[:-1]:
+        if type(parent) == dict and token in parent:
+            parent = parent[token]
+        elif type(parent) == list:
+            parent = parent[json_pointer_index(parent, token)]
+        else:
+            raise ValueError(f'{json.dumps(pointer)} does not exist')
+    return parent, tokens[-1]
+
+
+# Create a function to convert a JSON pointer token to an index of a list, allow_end allows the index after the end
+def json_pointer_index(parent, token, allow_end=False):
+    if re.match(r'^(0|[1-9][0-9]*)$', token) is None or int(token) > len(parent) - (0 if allow_end else 1):
+        raise ValueError(f'invalid list index {json.dumps(token)}')
+    return int(token)
+
+
+# Create a function to get the value that a JSON pointer refers to in a document
+def get_json_pointer(document, pointer):
+    parent, token = resolve_json_pointer(document, pointer)
+    if token is None:
+        return document
+    if type(parent) == dict and token in parent:
+        return parent[token]
+    if type(parent) == list:
+        return parent[json_pointer_index(parent, token)]
+    raise ValueError(f'{json.dumps(pointer)} does not exist')
+
+
+# Create a function to compare two JSON documents in the way that the "test" operation of RFC 6902 does. Unlike ==,
+# values only match if they have the same JSON type, so true doesn't match 1. Numbers match if they are numerically
+# equal, as JSON doesn't tell integers and floats apart
+def json_values_equal(a, b):
+    if type(a) in [int, float] and type(b) in [int, float]:
+        return a == b
+    if type(a) != type(b):
+        return False
+    if type(a) == list:
+        return len(a) == len(b) and all(json_values_equal(item_a, item_b) for item_a, item_b in zip(a, b))
+    if type(a) == dict:
+        return a.keys() == b.keys() and all(json_values_equal(a[key], b[key]) for key in a)
+    return a == b
+
+
+# Create a function to apply a JSON patch (RFC 6902) to a document, patch is a list of operations.
+# The document is modified in place, and ValueError is raised if any operation fails
+def apply_json_patch(document, patch):
+    if type(patch) != list:
+        raise ValueError('a JSON patch must be a list of operations')
+    for operation in patch:
+        if type(operation) != dict or type(operation.get('path')) != str:
+            raise ValueError('each operation must be a JSON object with an "op" and a "path"')
+        op = operation.get('op')
+        if op in ['add', 'replace', 'test'] and 'value' not in operation:
+            raise ValueError(f'"{op}" operations need a "value"')
+        if op in ['move', 'copy'] and type(operation.get('from')) != str:
+            raise ValueError(f'"{op}" operations need a "from"')
+        if op == 'test':
+            if json_values_equal(get_json_pointer(document, operation['path']), operation['value']) is False:
+                raise ValueError(f'test of {json.dumps(operation["path"])} failed')
+            continue
+        if op == 'move' and operation['path'].startswith(f'{operation["from"]}/'):
+            raise ValueError('a value can not be moved into itself')
+        # Every other operation is a remove of one location, an add at another, or both
+        if op in ['add', 'replace']:
+            value = operation['value']
+        elif op in ['move', 'copy']:
+            value = copy.deepcopy(get_json_pointer(document, operation['from']))
+        elif op != 'remove':
+            raise ValueError(f'unknown operation {json.dumps(op)}')
+        if op in ['remove', 'replace', 'move']:
+            parent, token = resolve_json_pointer(document, operation['from' if op == 'move' else 'path'])
+            if token is None:
+                document = None
+            elif type(parent) == dict and token in parent:
+                del parent[token]
+            elif type(parent) == list:
+                del parent[json_pointer_index(parent, token)]
             else:
-                # Log the unsupported operation
-                system_log(f'ERROR:000001 Unrecognised operation in DB queue: {operation}\n')
-                # Wait 0.1 seconds then skip back to the start of the loop
-                sleep(0.1)
-                continue
+                raise ValueError(f'{json.dumps(operation["from" if op == "move" else "path"])} does not exist')
+        if op in ['add', 'replace', 'move', 'copy']:
+            parent, token = resolve_json_pointer(document, operation['path'])
+            if token is None:
+                document = value
+            elif type(parent) == dict:
+                parent[token] = value
+            elif type(parent) == list:
+                parent.insert(len(parent) if token == '-' else json_pointer_index(parent, token, allow_end=True), value)
+            else:
+                raise ValueError(f'the parent of {json.dumps(operation["path"])} does not exist')
+    return document
+
+
+# Create a function to apply a patch to the latest value of a system, patch_type is either "merge" or "json".
+# The patch is applied outside of system_state_lock so that large values don't hold it up, and is applied again if
+# the value changed while it was being applied. This returns the new value as a JSON string and the new value, and
+# raises ValueError if the patch can't be applied
+@writer_function()
+def patch_system_value(system_id, value_name, patch_type, patch):
+    while True:
+        data, version = get_system_value(system_id, value_name)
+        document = None if data is None else json.loads(data)
+        if patch_type == 'merge':
+            document = apply_merge_patch(document, patch)
         else:
-            # Wait 0.1 seconds then skip back to the start of the loop
-            sleep(0.1)
+            document = apply_json_patch(document, patch)
+        data = json.dumps(document)
+        if compare_and_set_system_value(system_id, value_name, data, version) is True:
+            return data, document
+
+
+# Create a function to fetch the latest version of anything in system_state
+def get_system_state_version():
+    with system_state_lock:
+        return system_state_version
+
+
+# Create a function to fetch the ID of every system
+def get_system_ids():
+    with system_state_lock:
+        return list(system_state.keys())
+
+
+# Create a function to fetch the latest heartbeat of a system, this returns None if it doesn't have one yet
+def get_system_heartbeat(system_id):
+    with system_state_lock:
+        return system_state.get(system_id, {}).get('heartbeat')
+
+
+# Create a function to fetch the latest value of a system as a JSON string and its version, this returns
+# (None, None) if it doesn't exist yet
+def get_system_value(system_id, value_name):
+    with system_state_lock:
+        state = system_state.get(system_id)
+        if state is None or value_name not in state['values']:
+            return None, None
+        return state['values'][value_name], state['versions'][value_name]
+
+
+# Create a dictionary to store statistics about the database writer in, these are returned by admin/stats
+database_writer_stats = {
+    'batches': 0,
+    'operations': 0,
+    'merged_operations': 0,
+    'failed_operations': 0,
+    'last_batch_size': 0,
+    'max_batch_size': 0,
+    'last_commit_latency': 0.0,
+    'max_commit_latency': 0.0,
+    'total_commit_latency': 0.0,
+    'last_writer_lag': 0.0,
+    'rejected_operations': 0,
+    'replayed_operations': 0,
+    'journal_syncs': 0,
+    'checkpoint': 0
+}
+
+
+# Create a function to run a single operation from the database queue, this doesn't commit the changes
+def execute_database_operation(cursor, operation):
+    # Check if the job type is update_row
+    if operation[0] == 'update_row':
+        # Define the SQL command to run
+        db_update_cmd = 'UPDATE %s SET %s = ? WHERE id = ?'
+        # Run the SQL command
+        cursor.execute(db_update_cmd % (operation[1], operation[3]), (operation[4], operation[2],))
+    # Check if the job type is new_row
+    elif operation[0] == 'new_row':
+        # Define the SQL command to run
+        db_update_cmd = 'INSERT INTO %s VALUES (%s)'
+        # Create the string of placeholders for the values to insert into the new row
+        param_str = ','.join(['?'] * len(operation[2]))
+        # Run the SQL command
+        cursor.execute(db_update_cmd % (operation[1], param_str), operation[2])
+    # Check if the job type is update_system_value
+    elif operation[0] == 'update_system_value':
+        store_system_value(cursor, operation[1], operation[2], operation[3])
+    # Check if the job type is update_system_values, which stores a dictionary of values for a system at once
+    elif operation[0] == 'update_system_values':
+        store_system_values(cursor, operation[1], operation[2])
+    # Check if the job type is transaction, which runs a list of operations that either all succeed or all fail
+    elif operation[0] == 'transaction':
+        # Make sure that a transaction is open, otherwise releasing the savepoint would commit it straight away
+        if cursor.connection.in_transaction is False:
+            cursor.execute('BEGIN')
+        cursor.execute('SAVEPOINT "transaction_operation"')
+        try:
+            for sub_operation in operation[1]:
+                if execute_database_operation(cursor, sub_operation) is False:
+                    raise ValueError(f'Unrecognised operation {sub_operation[0]}')
+        except Exception:
+            cursor.execute('ROLLBACK TO "transaction_operation"')
+            raise
+        finally:
+            cursor.execute('RELEASE "transaction_operation"')
+    else:
+        # Log the unsupported operation
+        system_log(f'ERROR:000001 Unrecognised operation in DB queue: {operation}\n')
+        return False
+    return True
+
+
+# Create a function to remove update_row operations that are overwritten by a later operation in the same batch.
+# This means that a system sending several heartbeats while the writer is busy only causes a single UPDATE
+def merge_database_operations(batch):
+    merged_batch = []
+    seen_rows = set()
+    # Walk through the batch backwards so that the last update to each row is the one that is kept
+    for operation, future, sequence, queued in reversed(batch):
+        if operation[0] == 'update_row':
+            row_key = (operation[1], operation[2], operation[3])
+            if row_key in seen_rows:
+                continue
+            seen_rows.add(row_key)
+        merged_batch.append((operation, future, sequence, queued))
+    merged_batch.reverse()
+    return merged_batch
+
+
+# Create a function to write a batch of operations from the database queue in a single transaction.
+# The batch is a list of (operation, future, sequence, queued) where sequence is the operation's number in the database
+# journal, or None if the journal is disabled, and queued is the time the operation was accepted
+def write_database_batch(_con, batch):
+    merged_batch = merge_database_operations(batch)
+    failed_futures = {}
+    commit_start = time()
+    with closing(_con.cursor()) as cursor:
+        for operation, future, sequence, queued in merged_batch:
+            # A failed statement is rolled back by SQLite on its own, so the rest of the batch can still be committed
+            statement_start = time()
+            try:
+                if execute_database_operation(cursor, operation) is False:
+                    raise ValueError(f'Unrecognised operation {operation[0]}')
+                observe_latency('sqlite_statement_duration_seconds', time() - statement_start, operation=operation[0])
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                database_writer_stats['failed_operations'] += 1
+                failed_futures[future] = e
+                release_reserved_ids(operation)
+                system_log(f'ERROR:000005 Failed to run operation from DB queue: {operation}: {e}\n')
+        # Record the last journal operation in the batch in the same transaction, so that the operations replayed from
+        # the journal on startup are exactly the ones that were never committed. The checkpoint never passes a batch
+        # that failed to commit, so that its operations are retried when the server restarts
+        checkpoint = max((sequence for operation, future, sequence, queued in batch if sequence is not None),
+                         default=None)
+        if checkpoint is not None and database_journal_failed_sequence is not None:
+            checkpoint = min(checkpoint, database_journal_failed_sequence - 1)
+        if checkpoint is not None:
+            cursor.execute('INSERT OR REPLACE INTO database_journal_checkpoint VALUES (0, ?)', (checkpoint,))
+    # Commit the changes
+    statement_start = time()
+    _con.commit()
+    committed = time()
+    commit_latency = committed - commit_start
+    observe_latency('sqlite_statement_duration_seconds', committed - statement_start, operation='commit')
+    # If any rows in auth were changed then remove any cached credentials for them
+    for operation, future, sequence, queued in merged_batch:
+        if future in failed_futures:
             continue
+        for sub_operation in operation[1] if operation[0] == 'transaction' else [operation]:
+            if sub_operation[0] == 'update_row' and sub_operation[1] == 'auth':
+                invalidate_cached_credentials(sub_operation[2])
+            elif sub_operation[0] == 'new_row' and sub_operation[1] == 'auth':
+                invalidate_cached_credentials(sub_operation[2][0])
+                with known_ids_lock:
+                    known_ids.add(sub_operation[2][0])
+    # Let anything waiting on the operations know that they have been committed
+    for operation, future, sequence, queued in batch:
+        if future in failed_futures:
+            future.set_exception(failed_futures[future])
+        else:
+            future.set_result(True)
+        observe_latency('database_writer_lag_seconds', committed - queued)
+    # Update the statistics that are returned by admin/stats
+    database_writer_stats['batches'] += 1
+    database_writer_stats['operations'] += len(batch)
+    database_writer_stats['merged_operations'] += len(batch) - len(merged_batch)
+    database_writer_stats['last_batch_size'] = len(batch)
+    database_writer_stats['max_batch_size'] = max(database_writer_stats['max_batch_size'], len(batch))
+    database_writer_stats['last_commit_latency'] = commit_latency
+    database_writer_stats['max_commit_latency'] = max(database_writer_stats['max_commit_latency'], commit_latency)
+    database_writer_stats['total_commit_latency'] += commit_latency
+    database_writer_stats['last_writer_lag'] = committed - min(queued for operation, future, sequence, queued in batch)
+    if checkpoint is not None:
+        database_writer_stats['checkpoint'] = checkpoint
+        remove_database_journal_segments(checkpoint)
+
+
+# Create a function that will run asynchronously to write to the database
+def run_queue():
+    global database_journal_failed_sequence
+    # Create a single connection to the database that is kept open for as long as the writer is running
+    with closing(sqlite3.connect(database_path)) as _con:
+        stopping = False
+        # Start a loop that will run until stop_queue() is called
+        while stopping is False:
+            # Wait until a job is added to the queue
+            job = database_operations_queue.get()
+            # None is used by stop_queue() to tell the writer to stop once the queue is empty
+            if job is None:
+                break
+            batch = [job]
+            # Collect any other jobs that are added to the queue before the batch is full or the maximum delay is
+            # reached
+            batch_deadline = time() + api_database_batch_delay
+            while len(batch) < api_database_batch_size:
+                try:
+                    job = database_operations_queue.get(timeout=max(batch_deadline - time(), 0)) \
+                        if api_database_batch_delay > 0 else database_operations_queue.get_nowait()
+                except Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            # Write the whole batch in a single transaction
+            try:
+                write_database_batch(_con, batch)
+            except sqlite3.Error as e:
+                _con.rollback()
+                system_log(f'ERROR:000006 Failed to commit batch from DB queue ({len(batch)} operations): {e}\n')
+                # Keep the journal from this batch onwards, so that it is replayed when the server restarts
+                failed_sequence = min((sequence for operation, future, sequence, queued in batch
+                                       if sequence is not None), default=None)
+                if failed_sequence is not None and (database_journal_failed_sequence is None or
+                                                    failed_sequence < database_journal_failed_sequence):
+                    database_journal_failed_sequence = failed_sequence
+                for operation, future, sequence, queued in batch:
+                    release_reserved_ids(operation)
+                    if future.done() is False:
+                        future.set_exception(e)
+            # Delete the variables that we are finished with to avoid any chance of a memory leak
+            del batch
+            del job
+
+
+# Every operation is appended to the database journal before it is queued, so that operations that were accepted but
+# not yet committed are replayed when the server restarts. The journal is split into segments in journal/ named after
+# the sequence number of their first operation, each line of a segment is a JSON list of [sequence, operation].
+# Segments are removed once every operation in them has been committed
+database_journal_file = None
+database_journal_segments = []
+database_journal_sequence = 0
+# The sequence number of the first operation in a batch that failed to commit, the checkpoint is kept before it until
+# the server restarts and replays it
+database_journal_failed_sequence = None
+# Create a lock to stop multiple request threads from appending to the journal at the same time, operations are queued
+# while holding it so that they are written to the database in the same order as the journal
+database_journal_lock = Lock()
+# Journal writes are synced in groups, the first request thread that needs a sync syncs everything appended so far
+# while any others wait for it. This Condition guards the sequence number that has been synced
+database_journal_sync_condition = Condition()
+database_journal_synced_sequence = 0
+database_journal_syncing = False
+
+
+# Create a function to list the segments of the database journal, oldest first, as (first sequence, path)
+def list_database_journal_segments():
+    segments = []
+    for file_name in os.listdir(database_journal_directory):
+        if re.match(r'^[0-9]{20}\.jsonl$', file_name) is not None:
+            segments.append((int(file_name[:20]), f'{database_journal_directory}{file_name}'))
+    segments.sort()
+    return segments
+
+
+# Create a function to start a new journal segment, this must be called while holding database_journal_lock.
+# This returns the previous segment file, or None
+def open_database_journal_segment():
+    global database_journal_file
+    previous_file = database_journal_file
+    path = f'{database_journal_directory}{database_journal_sequence + 1:020d}.jsonl'
+    database_journal_file = open(path, 'ab')
+    database_journal_segments.append((database_journal_sequence + 1, path))
+    return previous_file
+
+
+# Create a function to remove every journal segment that only contains committed operations
+def remove_database_journal_segments(checkpoint):
+    with database_journal_lock:
+        # The current segment is never removed, a segment only contains committed operations if the next one starts
+        # after the checkpoint
+        while len(database_journal_segments) > 1 and database_journal_segments[1][0] - 1 <= checkpoint:
+            try:
+                os.remove(database_journal_segments.pop(0)[1])
+            except OSError as e:
+                system_log(f'ERROR:000014 Failed to remove database journal segment: {e}\n')
+
+
+# Create a function to commit every operation in the database journal that wasn't committed before the server stopped,
+# then start a new segment
+def replay_database_journal():
+    global database_journal_sequence
+    os.makedirs(database_journal_directory, exist_ok=True)
+    with closing(sqlite3.connect(database_path)) as _con:
+        _temp = _con.execute('SELECT sequence FROM database_journal_checkpoint WHERE id = 0').fetchone()
+        checkpoint = 0 if _temp is None else _temp[0]
+        database_journal_sequence = checkpoint
+        batch = []
+        for first_sequence, path in list_database_journal_segments():
+            with open(path, 'rb') as segment_file:
+                for line in segment_file:
+                    try:
+                        sequence, operation = json.loads(line)
+                    except ValueError:
+                        # The server stopped part way through appending this operation, so it was never accepted
+                        break
+                    database_journal_sequence = max(database_journal_sequence, sequence)
+                    if sequence > checkpoint:
+                        batch.append((operation, Future(), sequence, time()))
+                    if len(batch) >= api_database_batch_size:
+                        write_database_batch(_con, batch)
+                        database_writer_stats['replayed_operations'] += len(batch)
+                        batch = []
+        if batch:
+            write_database_batch(_con, batch)
+            database_writer_stats['replayed_operations'] += len(batch)
+    if database_writer_stats['replayed_operations'] > 0:
+        system_log(f'Replayed {database_writer_stats["replayed_operations"]} operations from the database journal\n')
+    # Everything in the old segments has now been committed
+    for first_sequence, path in list_database_journal_segments():
+        os.remove(path)
+    with database_journal_lock:
+        open_database_journal_segment()
+
+
+# Create a function to wait until the journal has been synced up to a sequence number. If no other request thread is
+# syncing then this one syncs everything appended so far, otherwise it waits for that sync to finish. sequence is None
+# if the journal is disabled
+def sync_database_journal(sequence):
+    global database_journal_synced_sequence, database_journal_syncing
+    if sequence is None:
+        # The journal is disabled
+        return
+    with database_journal_sync_condition:
+        while database_journal_synced_sequence < sequence:
+            if database_journal_syncing is False:
+                database_journal_syncing = True
+                break
+            database_journal_sync_condition.wait()
+        else:
+            return
+    synced_sequence = database_journal_synced_sequence
+    try:
+        with database_journal_lock:
+            database_journal_file.flush()
+            synced_sequence = database_journal_sequence
+            journal_file = database_journal_file
+            # Start a new segment once this one is full, everything in it is synced below
+            if journal_file.tell() >= api_database_journal_segment_size:
+                open_database_journal_segment()
+            else:
+                journal_file = None
+        if api_database_journal_sync is True:
+            os.fsync(database_journal_file.fileno() if journal_file is None else journal_file.fileno())
+        if journal_file is not None:
+            journal_file.close()
+        database_writer_stats['journal_syncs'] += 1
+    finally:
+        with database_journal_sync_condition:
+            database_journal_synced_sequence = max(database_journal_synced_sequence, synced_sequence)
+            database_journal_syncing = False
+            database_journal_sync_condition.notify_all()
+
+
+# Create a function to append an operation to the database journal and add it to the database queue, without waiting
+# for the journal to be synced. This returns a Future that is completed once the operation has been committed, or has
+# failed, and the sequence number to pass to sync_database_journal(). Changes to system_state call this while holding
+# system_state_lock, so that the database is changed in the same order as system_state
+def append_database_operation(operation):
+    global database_journal_sequence
+    future = Future()
+    if api_database_journal is False:
+        database_operations_queue.put((operation, future, None, time()))
+        return future, None
+    with database_journal_lock:
+        database_journal_sequence += 1
+        sequence = database_journal_sequence
+        database_journal_file.write(f'{json.dumps([sequence, operation])}\n'.encode('utf-8'))
+        database_operations_queue.put((operation, future, sequence, time()))
+    return future, sequence
+
+
+# Create a function to add an operation to the database queue, once it has been synced to the database journal.
+# This returns a Future that is completed once the operation has been committed, or has failed
+@writer_function()
+def queue_database_operation(operation):
+    future, sequence = append_database_operation(operation)
+    sync_database_journal(sequence)
+    return future
+
+
+# Create a function to stop the database writer once every queued operation has been written
+def stop_queue():
+    database_operations_queue.put(None)
+    database_writer_thread.join()
+    if database_journal_file is not None:
+        with database_journal_lock:
+            database_journal_file.close()
+
+
+# Create a function to get the number of operations waiting to be written to the database. A request worker uses the
+# depth the writer process sent with its latest reply, so checking it doesn't need a request to the writer process
+def get_database_queue_depth():
+    if writer_connection is not None:
+        return writer_queue_depth
+    return database_operations_queue.qsize()
+
+
+# Create a decorator function to return 503 Service Unavailable when database_queue_max_depth operations are waiting
+# to be written, so that the update endpoints don't accept more work than the database writer can keep up with
+def check_database_queue(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if get_database_queue_depth() >= api_database_queue_max_depth:
+            database_writer_stats['rejected_operations'] += 1
+            return 'Error: too many updates are waiting to be written, please try again later', 503, \
+                {'Retry-After': '1'}
+        return function(*args, **kwargs)
+    return wrapper
+
+
+# The update endpoints are split into classes that each have a token bucket for every system ID, refilled at the
+# configured number of requests per second. A rate of 0 means that the class isn't limited
+rate_limits = {'heartbeat': api_rate_limit_heartbeat, 'values': api_rate_limit_values,
+               'logging': api_rate_limit_logging}
+# Create a dictionary of (class, ID) to [tokens, time last updated], ordered from least to most recently used. When
+# server_mode is prefork the buckets are kept in the writer process, so the limits apply across every request worker
+rate_limit_buckets = OrderedDict()
+# Create a lock to stop multiple request threads from modifying rate_limit_buckets at the same time
+rate_limit_lock = Lock()
+# Create a dictionary of the number of requests rejected with 429 Too Many Requests for each class, these are returned
+# by admin/stats
+rate_limit_stats = {endpoint_class: 0 for endpoint_class in rate_limits}
+
+
+# Create a function to get the maximum number of tokens in a bucket, this allows a burst of rate_limit_burst seconds
+# worth of requests after a system has been quiet
+def rate_limit_capacity(endpoint_class):
+    return max(rate_limits[endpoint_class] * api_rate_limit_burst, 1)
+
+
+# Create a function to take a token from the bucket of an ID for each of several classes of endpoint. Either a token is
+# taken from every bucket or from none of them, and the request is counted as rejected for each class that didn't have
+# a token. This returns 0 if the tokens were taken, otherwise the number of seconds until they will all be available
+@writer_function()
+def take_rate_limit_tokens(endpoint_classes, _id):
+    now = time()
+    retry_after = 0
+    with rate_limit_lock:
+        buckets = []
+        for endpoint_class in endpoint_classes:
+            key = (endpoint_class, str(_id))
+            bucket = rate_limit_buckets.get(key)
+            if bucket is None:
+                # Remove the least recently used bucket to make room, it is likely to be full anyway
+                if len(rate_limit_buckets) >= api_rate_limit_table_size:
+                    rate_limit_buckets.popitem(last=False)
+                bucket = rate_limit_buckets[key] = [rate_limit_capacity(endpoint_class), now]
+            else:
+                rate_limit_buckets.move_to_end(key)
+                bucket[0] = min(bucket[0] + (now - bucket[1]) * rate_limits[endpoint_class],
+                                rate_limit_capacity(endpoint_class))
+                bucket[1] = now
+            if bucket[0] < 1:
+                rate_limit_stats[endpoint_class] += 1
+                retry_after = max(retry_after, (1 - bucket[0]) / rate_limits[endpoint_class])
+            buckets.append(bucket)
+        if retry_after == 0:
+            for bucket in buckets:
+                bucket[0] -= 1
+    return retry_after
+
+
+# Create a decorator function to return 429 Too Many Requests when a system ID sends requests to a class of endpoint
+# faster than its rate limit. This must be used before check_auth, so that rejected requests don't cost a password hash.
+# If heartbeat_argument is True then a request with the heartbeat argument set is also charged to the heartbeat class
+def check_rate_limit(endpoint_class, heartbeat_argument=False):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            endpoint_classes = [endpoint_class]
+            if heartbeat_argument is True and request.values.get('heartbeat', 'false').lower() in ['1', 'true', 'yes']:
+                endpoint_classes.append('heartbeat')
+            endpoint_classes = [limited_class for limited_class in endpoint_classes if rate_limits[limited_class] > 0]
+            if endpoint_classes:
+                retry_after = take_rate_limit_tokens(endpoint_classes, request.values['id'])
+                if retry_after > 0:
+                    return 'Error: too many requests, please try again later', 429, \
+                        {'Retry-After': str(math.ceil(retry_after))}
+            return function(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 # Create a function to hash a password
@@ -188,13 +1032,42 @@ def hash_password(password):
     # Generate some salt to add to the password
     salt = hashlib.sha256(os.urandom(60)).hexdigest().encode('ascii')
     # Hash the password along with the salt
-    pw_hash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), salt, 100000)
+    pw_hash = pbkdf2_hash(password.encode('utf-8'), salt)
     # Convert the binary hash to hexadecimal
     pw_hash = binascii.hexlify(pw_hash)
     # Return the hashed password
     return (salt + pw_hash).decode('ascii')
 
 
+# Create a variable to store the process pool used to hash passwords in parallel, this is only created when it is needed
+password_hash_pool = None
+
+
+# Create a function to fetch the process pool used to hash passwords in parallel. Its processes are started with spawn
+# rather than fork, since forking would copy every thread and lock of the server in whatever state they were in
+def get_password_hash_pool():
+    global password_hash_pool
+    if password_hash_pool is None:
+        # A spawned process imports the main script again as __mp_main__ before it runs anything, which would read the
+        # config and build the whole server in every process of the pool. multiprocessing skips this when the main
+        # module's spec is named __main__, so the processes only import password_hashing
+        main_module = sys.modules['__main__']
+        if getattr(main_module, '__spec__', None) is None:
+            main_module.__spec__ = ModuleSpec('__main__', None)
+        password_hash_pool = ProcessPoolExecutor(max_workers=api_password_hash_processes,
+                                                 mp_context=get_context('spawn'))
+    return password_hash_pool
+
+
+# Create a function to hash a list of passwords in parallel, in the same format as hash_password(). Only
+# password_hashing.pbkdf2_hash is run in the pool, so its processes never import this module
+def hash_passwords(passwords):
+    salts = [hashlib.sha256(os.urandom(60)).hexdigest().encode('ascii') for password in passwords]
+    pw_hashes = get_password_hash_pool().map(pbkdf2_hash, [password.encode('utf-8') for password in passwords], salts,
+                                             chunksize=max(len(passwords) // (4 * api_password_hash_processes), 1))
+    return [(salt + binascii.hexlify(pw_hash)).decode('ascii') for salt, pw_hash in zip(salts, pw_hashes)]
+
+
 # Create a function to compare a plaintext password to a hashed password
 def verify_password(stored_password, provided_password):
     # Get the salt from the stored password
@@ -202,51 +1075,191 @@ def verify_password(stored_password, provided_password):
     # Get the hash of the stored password
     stored_password = stored_password[64:]
     # Generate a hash for the provided_password
-    pw_hash = hashlib.pbkdf2_hmac('sha512',
-                                  provided_password.encode('utf-8'),
-                                  salt.encode('ascii'),
-                                  100000)
+    hash_start = time()
+    pw_hash = pbkdf2_hash(provided_password.encode('utf-8'), salt.encode('ascii'))
+    observe_latency('password_hash_duration_seconds', time() - hash_start)
     # Convert the binary hash to hexadecimal
     pw_hash = binascii.hexlify(pw_hash).decode('ascii')
     # Compare the provided passwords
     return pw_hash == stored_password
 
 
-# Create a function to check if a set of credentials is valid
-def auth(_id, _auth, access_level='system'):
+# Create a random key that is used to derive the keys of the verified credentials cache.
+# The cache is keyed with an HMAC of the ID and auth code so that plaintext auth codes are never kept in memory
+verified_credentials_key = os.urandom(32)
+# Create an ordered dictionary to store recently verified credentials in, ordered from least to most recently used
+verified_credentials = OrderedDict()
+# Create a lock to stop multiple request threads from modifying the cache at the same time
+verified_credentials_lock = Lock()
+# Create a dictionary of the number of times the cached credentials of each ID have been invalidated. A request that
+# read an auth row before it changed mustn't cache the old access level, so credentials are only cached if this hasn't
+# changed since the row was read. IDs that have never been invalidated aren't in it
+verified_credentials_generations = {}
+
+
+# Create a function to derive the verified credentials cache key for a set of credentials
+def credentials_cache_key(_id, _auth):
+    return hmac.new(verified_credentials_key, f'{_id}\x00{_auth}'.encode('utf-8'), hashlib.sha256).digest()
+
+
+# Create a function to fetch the access level of a set of credentials from the verified credentials cache
+def get_cached_credentials(cache_key):
+    with verified_credentials_lock:
+        cached = verified_credentials.get(cache_key)
+        # If the credentials aren't in the cache then return None
+        if cached is None:
+            return None
+        # If the cached entry has expired then remove it and return None
+        if cached[2] < time():
+            del verified_credentials[cache_key]
+            return None
+        # Mark the entry as recently used
+        verified_credentials.move_to_end(cache_key)
+        # Return the access level of the credentials
+        return cached[1]
+
+
+# Create a function to fetch the generation of the cached credentials of an ID, this must be called before its auth
+# row is read and passed to cache_credentials()
+def get_credentials_generation(_id):
+    with verified_credentials_lock:
+        return verified_credentials_generations.get(_id, 0)
+
+
+# Create a function to store a set of verified credentials in the verified credentials cache, unless they have been
+# invalidated since generation
+def cache_credentials(cache_key, _id, access_level, generation):
+    # Check if caching of verified credentials is enabled
+    if api_auth_cache_size <= 0:
+        return
+    with verified_credentials_lock:
+        if verified_credentials_generations.get(_id, 0) != generation:
+            return
+        # Store the ID, access level and expiry time of the credentials
+        verified_credentials[cache_key] = (_id, access_level, time() + api_auth_cache_ttl)
+        verified_credentials.move_to_end(cache_key)
+        # Remove the least recently used entries until the cache is back under its maximum size
+        while len(verified_credentials) > api_auth_cache_size:
+            verified_credentials.popitem(last=False)
+
+
+# Create a function to remove any cached credentials for an ID, this must be called whenever a row in auth changes
+def invalidate_cached_credentials(_id):
+    with verified_credentials_lock:
+        verified_credentials_generations[str(_id)] = verified_credentials_generations.get(str(_id), 0) + 1
+        for cache_key in [k for k, v in verified_credentials.items() if v[0] == str(_id)]:
+            del verified_credentials[cache_key]
+    # Request workers have their own caches
+    replicate_change(('invalidate_credentials', str(_id)))
+
+
+# Create a function to fetch the access level of a set of credentials, this returns None if they are invalid.
+# Only one database lookup and one password hash are done no matter how many access levels the caller is checked against
+def get_access_level(_id, _auth):
+    # Check whether these credentials have already been verified recently
+    auth_start = time()
+    cache_key = credentials_cache_key(_id, _auth)
+    stored_access_level = get_cached_credentials(cache_key)
+    if stored_access_level is not None:
+        observe_latency('auth_duration_seconds', time() - auth_start, cached='true')
+        return stored_access_level
+    generation = get_credentials_generation(str(_id))
     # Create a database connection and cursor object
     with closing(sqlite3.connect(database_path)) as db_connection, closing(db_connection.cursor()) as db_cursor:
-        # define the command for fetching the password
-        _auth_cmd = 'SELECT password FROM auth WHERE id = ? AND access_level = ?'
-        # Check what access level the client is attempting to authenticate for and execute the appropriate command
-        if access_level == 'system':
-            _temp = db_cursor.execute(_auth_cmd, (str(_id), 'system',)).fetchone()
-        elif access_level == 'client':
-            _temp = db_cursor.execute(_auth_cmd, (str(_id), 'client',)).fetchone()
-        elif access_level == 'admin':
-            _temp = db_cursor.execute(_auth_cmd, (str(_id), 'admin',)).fetchone()
-        elif access_level == 'owner':
-            _temp = db_cursor.execute(_auth_cmd, (str(_id), 'owner',)).fetchone()
-        # This allows a client to check if they are in the database anywhere regardless of their access level
-        elif access_level == 'any':
-            _temp = db_cursor.execute('SELECT password FROM auth WHERE id = ?', (str(_id),)).fetchone()
-        # If the access level provided was unrecognised we log it and return False
-        else:
-            system_log(f'ERROR:000002 Unrecognised access_level in auth(): {access_level}\n')
-            return False
-        # Attempt to convert the stored password and provided password to
-        # strings then return the result of verify_password()
-        try:
-            return verify_password(str(_temp[0]), str(_auth))
-        # If converting the stored password and provided passwords to strings fails then log it and return False
-        except TypeError:
-            system_log(f'WARN: Failed to convert passwords to strings')
+        # Fetch the password and access level stored for the ID
+        statement_start = time()
+        _temp = db_cursor.execute('SELECT password, access_level FROM auth WHERE id = ?', (str(_id),)).fetchone()
+        observe_latency('sqlite_statement_duration_seconds', time() - statement_start, operation='select_auth')
+    # Attempt to convert the stored password and provided password to
+    # strings then check them with verify_password()
+    try:
+        if verify_password(str(_temp[0]), str(_auth)) is False:
+            observe_latency('auth_duration_seconds', time() - auth_start, cached='false')
+            return None
+    # If converting the stored password and provided passwords to strings fails then log it and return None
+    except TypeError:
+        system_log(f'WARN: Failed to convert passwords to strings')
+        return None
+    # Store the verified credentials so that later requests can skip verify_password()
+    cache_credentials(cache_key, str(_id), _temp[1], generation)
+    observe_latency('auth_duration_seconds', time() - auth_start, cached='false')
+    return _temp[1]
+
+
+# Create a function to check whether an access level is one of the allowed access levels
+def access_level_allowed(stored_access_level, allowed_access_levels):
+    # Invalid credentials are never allowed
+    if stored_access_level is None:
+        return False
+    # This allows a client to check if they are in the database anywhere regardless of their access level
+    if 'any' in allowed_access_levels:
+        return True
+    return stored_access_level in allowed_access_levels
+
+
+# Create a function to check if a set of credentials is valid
+def auth(_id, _auth, access_level='system'):
+    # If the access level provided was unrecognised we log it and return False
+    if access_level not in ['system', 'client', 'admin', 'owner', 'any']:
+        system_log(f'ERROR:000002 Unrecognised access_level in auth(): {access_level}\n')
+        return False
+    return access_level_allowed(get_access_level(_id, _auth), [access_level])
+
+
+# Create a set of every ID in the auth table, so that checking whether an ID exists doesn't need to scan the table
+known_ids = set()
+# Create a lock to stop multiple request threads from modifying known_ids at the same time
+known_ids_lock = Lock()
+
+
+# Create a function to load every ID in the auth table into known_ids
+def load_known_ids():
+    with closing(sqlite3.connect(database_path)) as _con, closing(_con.cursor()) as cursor:
+        new_ids = {row[0] for row in cursor.execute('SELECT id FROM auth')}
+    with known_ids_lock:
+        known_ids.clear()
+        known_ids.update(new_ids)
+
+
+# Create a function to check whether an ID exists in the auth table
+def id_exists(_id):
+    _id = str(_id)
+    with known_ids_lock:
+        if _id in known_ids:
+            return True
+    # Fall back to a primary key lookup, in case the ID was added by manually editing the database
+    with closing(sqlite3.connect(database_path)) as _con, closing(_con.cursor()) as cursor:
+        if cursor.execute('SELECT 1 FROM auth WHERE id = ?', (_id,)).fetchone() is None:
             return False
+    with known_ids_lock:
+        known_ids.add(_id)
+    return True
+
+
+# Create a function to claim an unused ID, this returns False if the ID is already in use
+@writer_function()
+def reserve_id(_id):
+    if id_exists(_id) is True:
         return False
+    with known_ids_lock:
+        # Check again now that we hold the lock, in case another request thread claimed the same ID
+        if _id in known_ids:
+            return False
+        known_ids.add(_id)
+    return True
 
 
-# Create a function to generate a new set of credentials for the API
-def generate_new_auth():
+# Create a function to forget the IDs claimed by reserve_id() for a database operation that failed, so that an ID
+# without a row in auth isn't treated as existing. An ID that does have a row is added back by id_exists()
+def release_reserved_ids(operation):
+    for sub_operation in operation[1] if operation[0] == 'transaction' else [operation]:
+        if sub_operation[0] == 'new_row' and sub_operation[1] == 'auth':
+            with known_ids_lock:
+                known_ids.discard(sub_operation[2][0])
+
+
+# Create a function to generate a new ID and plaintext password for the API
+def generate_new_credentials():
     # Don't use certain characters for IDs and passwords to avoid ambiguity
     char_blacklist = 'iI1lo0OBgzsS'
     # Create the list of characters to use for ID generation
@@ -260,11 +1273,8 @@ def generate_new_auth():
         id_out = ''
         for i in range(0, 6):
             id_out = f'{id_out}{choice(id_rand_list)}'
-        # Check if the ID is already in use
-        with closing(sqlite3.connect(database_path)) as _db, closing(_db.cursor()) as _cur:
-            if (id_out,) in _cur.execute('SELECT "id" FROM auth').fetchall():
-                sleep(3)
-                continue
+        # Check if the ID is already in use, and claim it if it isn't
+        if reserve_id(id_out) is True:
             # If the ID isn't used then we break out of this loop
             break
     # Create the list of characters to use for password generation
@@ -276,58 +1286,62 @@ def generate_new_auth():
     pass_out = ''
     for i in range(0, 10):
         pass_out = f'{pass_out}{choice(pass_rand_list)}'
+    # Return the generated password in plaintext along with the ID
+    return id_out, pass_out
+
+
+# Create a function to generate a new set of credentials for the API
+def generate_new_auth():
+    id_out, pass_out = generate_new_credentials()
     # Hash the generate password
     hashed_pass_out = hash_password(pass_out)
     # Return the generated password in plaintext and hashed form, along with the ID
     return id_out, pass_out, hashed_pass_out
 
 
-# Create a function for logging historical API data for later analysis
-def api_historical(_id, _val_name, _data):
-    # Check if we should be logging historical data
-    if api_enable_historical is True:
-        # Open the file in append mode
-        with open(f'{historical_directory}{_id}/{_val_name}.txt', 'a') as historical_file:
-            # Append the value
-            historical_file.write(f'"{time()}": "{str(_data)}"\n')
-    return True
-
-
-# Create a decorator function to use for checking if a user of the api is authorised
+# Create a decorator function to use for checking if a user of the api is authorised.
+# access_level can either be a single access level or a list of access levels that are allowed to use the endpoint
 def check_auth(access_level):
     def decorator(function):
         @wraps(function)
         def wrapper(*args, **kwargs):
             if type(access_level) == str:
-                # If the argument access_level is a string,
-                # check whether the provided id is authorised for a single access_level
-                authorised = auth(request.values['id'], request.values['auth'], access_level=access_level)
-                if authorised is False:
-                    # Let the client know that their credentials were invalid
-                    abort(401, description='Error: you do not have the proper credentials')
-                else:
-                    return function(*args, **kwargs)
-
+                allowed_access_levels = [access_level]
             elif type(access_level) == list:
-                # If the argument access_level is a list,
-                # check where the provided id is authorised for any of the access_levels in the list
-                authorised = []
-                # Loop through the provided list of access_levels, checking
-                # each one and appending the result to "authorised"
-                for level in access_level:
-                    authorised.append(auth(request.values['id'], request.values['auth'], access_level=level))
-                if True in authorised:
-                    return function(*args, **kwargs)
-                else:
-                    # Let the client know that their credentials were invalid
-                    abort(401, description='Error: you do not have the proper credentials')
+                allowed_access_levels = access_level
             else:
                 # Log that the argument access_level is an unsupported type
                 system_log(f'ERROR:000004 access_level type is {type(access_level)}')
+                abort(500)
+            # Fetch the access level of the provided credentials once, and check it against every allowed access level
+            g.access_level = get_access_level(request.values['id'], request.values['auth'])
+            if access_level_allowed(g.access_level, allowed_access_levels) is False:
+                # Let the client know that their credentials were invalid
+                abort(401, description='Error: you do not have the proper credentials')
+            return function(*args, **kwargs)
         return wrapper
     return decorator
 
 
+# Create a function to read an argument that is a list, either as a JSON list or as a comma separated string.
+# This returns None if the argument wasn't supplied
+def list_argument(name):
+    return parse_list_argument(request.values.get(name, ''))
+
+
+# Create a function to parse the value of a list argument, this returns None if it is empty
+def parse_list_argument(value):
+    if value == '':
+        return None
+    try:
+        _temp = json.loads(value)
+        if type(_temp) == list:
+            return [str(i) for i in _temp]
+    except ValueError:
+        pass
+    return [i.strip() for i in value.split(',') if i.strip() != '']
+
+
 # Create a decorator function to use for checking whether all required arguments have been supplied to an api endpoint
 def check_args(required_args):
     def decorator(function):
@@ -345,10 +1359,1846 @@ def check_args(required_args):
 # #############################
 
 
+# #########################
+# ### BEGIN LOG STORAGE ###
+# #########################
+
+# Log entries for logs/<name>.txt are added to log_queue by request threads and written by a single log writer thread,
+# which keeps a limited number of log files open and rotates them to logs/<name>.<start>.txt[.gz] once they reach
+# log_rotate_size bytes or log_rotate_age seconds, where <start> is the time of the first entry in milliseconds
+log_queue = Queue(maxsize=api_log_queue_size)
+# Create a lock to stop request threads from adding to log_queue while a batch of entries is being added
+log_queue_lock = Lock()
+# Create an ordered dictionary to store the open log files in, ordered from least to most recently used
+log_files = OrderedDict()
+# Create a dictionary to store the time of the first entry in each log file, used for rotation
+log_file_starts = {}
+# Each log file has an index of (timestamp, offset) pairs in logs/<name>.idx, used to seek straight to a time range.
+# Create a dictionary to store the offset of the last index entry of each open log file
+log_index_struct = struct.Struct('<dQ')
+log_index_offsets = {}
+# Create a dictionary to store statistics about the log writer in, these are returned by admin/stats
+log_stats = {
+    'written_entries': 0,
+    'dropped_entries': 0,
+    'rotations': 0
+}
+
+
+# Create a function to add an entry to a log file, this returns False if the entry was dropped because the log writer
+# has too much to write
+@writer_function()
+def write_log(name, data):
+    entry = (str(name), time(), str(data))
+    try:
+        with log_queue_lock:
+            if api_log_overflow == 'block':
+                # Wait for space in the queue for up to log_block_timeout seconds before dropping the entry
+                log_queue.put(entry, timeout=api_log_block_timeout)
+            else:
+                log_queue.put_nowait(entry)
+    except Full:
+        log_stats['dropped_entries'] += 1
+        return False
+    return True
+
+
+# Create a function to add a list of entries to a log file, either every entry is added or none are. This returns False
+# if the entries were dropped because the log writer has too much to write
+@writer_function()
+def write_logs(name, entries):
+    timestamp = time()
+    with log_queue_lock:
+        # Only the log writer can take entries out of the queue while the lock is held, so once there is space for every
+        # entry they can all be added without waiting
+        deadline = timestamp + (api_log_block_timeout if api_log_overflow == 'block' else 0)
+        while log_queue.maxsize > 0 and log_queue.maxsize - log_queue.qsize() < len(entries):
+            if time() >= deadline:
+                log_stats['dropped_entries'] += len(entries)
+                return False
+            sleep(0.01)
+        for data in entries:
+            log_queue.put_nowait((str(name), timestamp, str(data)))
+    return True
+
+
+# Create a function to get the open log file and index file for a name, opening them if needed. The log file being
+# opened is always kept open, even if log_open_files is 0
+def get_log_file(name):
+    if name in log_files:
+        log_files.move_to_end(name)
+        return log_files[name]
+    # Close the least recently used log files until there is room for this one
+    while log_files and len(log_files) >= api_log_open_files:
+        for open_file in log_files.popitem(last=False)[1]:
+            open_file.close()
+    log_path = f'{log_directory}{name}.txt'
+    log_file = open(log_path, 'ab')
+    index_file = open(f'{log_directory}{name}.idx', 'ab')
+    log_files[name] = (log_file, index_file)
+    # Work out when the log file was started, from its first entry if it already has some
+    if name not in log_file_starts:
+        log_file_starts[name] = time()
+        if log_file.tell() > 0:
+            with open(log_path, 'rb') as existing_log_file:
+                try:
+                    log_file_starts[name] = float(existing_log_file.readline().split(b':', 1)[0])
+                except ValueError:
+                    pass
+    # Work out where the last index entry points to, so the next one is added log_index_interval bytes after it
+    if name not in log_index_offsets:
+        log_index_offsets[name] = None
+        if index_file.tell() >= log_index_struct.size:
+            with open(f'{log_directory}{name}.idx', 'rb') as existing_index_file:
+                existing_index_file.seek(index_file.tell() // log_index_struct.size * log_index_struct.size -
+                                         log_index_struct.size)
+                log_index_offsets[name] = log_index_struct.unpack(existing_index_file.read(log_index_struct.size))[1]
+    return log_files[name]
+
+
+# Create a function to rotate a log file if it has reached the maximum size or age
+def rotate_log_file(name, now):
+    log_file, index_file = log_files[name]
+    too_big = api_log_rotate_size > 0 and log_file.tell() >= api_log_rotate_size
+    too_old = api_log_rotate_age > 0 and now - log_file_starts[name] >= api_log_rotate_age
+    if too_big is False and too_old is False:
+        return
+    log_file.close()
+    index_file.close()
+    del log_files[name]
+    log_index_offsets.pop(name, None)
+    rotated_start = int(log_file_starts.pop(name) * 1000)
+    # Make sure that a log file rotated in the same millisecond as an earlier one doesn't replace it
+    while os.path.exists(f'{log_directory}{name}.{rotated_start:016d}.idx') or \
+            os.path.exists(f'{log_directory}{name}.{rotated_start:016d}.gz.idx'):
+        rotated_start += 1
+    rotated_path = f'{log_directory}{name}.{rotated_start:016d}.txt'
+    # The index is moved first, so a reader never finds a rotated log file without its index
+    os.rename(f'{log_directory}{name}.idx', f'{log_directory}{name}.{rotated_start:016d}.idx')
+    os.rename(f'{log_directory}{name}.txt', rotated_path)
+    if api_log_compress is True:
+        compress_log_file(rotated_path, f'{log_directory}{name}.{rotated_start:016d}')
+    log_stats['rotations'] += 1
+
+
+# Create a function to compress a rotated log file to <path>.gz. The chunk that starts at each index entry is
+# compressed as a separate gzip member, so the result is still a normal gzip file but a search only needs to decompress
+# the chunks it reads. The index of the compressed file is written to <segment>.gz.idx, with the offset of each member
+def compress_log_file(rotated_path, segment_path):
+    timestamps, offsets = read_log_index(rotated_path, f'{segment_path}.idx')
+    index_entries = bytearray()
+    with open(rotated_path, 'rb') as rotated_file, open(f'{rotated_path}.gz.tmp', 'wb') as compressed_file:
+        for i in range(0, len(offsets)):
+            chunk = rotated_file.read(offsets[i + 1] - offsets[i] if i + 1 < len(offsets) else -1)
+            index_entries += log_index_struct.pack(timestamps[i], compressed_file.tell())
+            compressed_file.write(gzip.compress(chunk))
+    # The index is written first, so a reader never finds a compressed log file without its index. Until the
+    # uncompressed log file is removed, list_log_segments() keeps using it
+    with open(f'{segment_path}.gz.idx', 'wb') as index_file:
+        index_file.write(index_entries)
+    os.replace(f'{rotated_path}.gz.tmp', f'{rotated_path}.gz')
+    os.remove(rotated_path)
+    os.remove(f'{segment_path}.idx')
+
+
+# Create a function to write a batch of log entries, grouping them so each log file is written to once.
+# An index entry of (timestamp, offset) is added for the first entry of each log file, then for the first entry at
+# least log_index_interval bytes after the previous index entry
+def write_log_batch(batch):
+    entries = {}
+    for name, timestamp, data in batch:
+        entries.setdefault(name, []).append((timestamp, f'{timestamp}: {data}\n\n\n'.encode('utf-8')))
+    now = time()
+    for name, name_entries in entries.items():
+        try:
+            log_file, index_file = get_log_file(name)
+            offset = log_file.tell()
+            index_entries = bytearray()
+            for timestamp, entry in name_entries:
+                last_index_offset = log_index_offsets.get(name)
+                if last_index_offset is None or offset - last_index_offset >= api_log_index_interval:
+                    index_entries += log_index_struct.pack(timestamp, offset)
+                    log_index_offsets[name] = offset
+                offset += len(entry)
+            # The entries are written before the index, so the index never points past the end of the log file
+            log_file.write(b''.join(entry for timestamp, entry in name_entries))
+            log_file.flush()
+            index_file.write(index_entries)
+            index_file.flush()
+            rotate_log_file(name, now)
+        except OSError as e:
+            # The system log may be the file that is failing, so report this on stderr instead
+            print(f'ERROR:000011 Failed to write {len(name_entries)} entries to log {name}: {e}', file=sys.stderr)
+    log_stats['written_entries'] += len(batch)
+
+
+# Create a function to list the segments of a log, oldest first. This returns a list of (start, log path, index path)
+# where start is the time of the first entry in the segment, or None for the current log file
+def list_log_segments(name):
+    segments = {}
+    for file_name in os.listdir(log_directory):
+        match = re.match(rf'^{re.escape(name)}\.([0-9]{{16}})\.txt(\.gz)?$', file_name)
+        # While a log file is being compressed both files exist, the uncompressed one is used until it is removed
+        if match is not None and (match.group(2) is None or match.group(1) not in segments):
+            segments[match.group(1)] = (int(match.group(1)) / 1000, f'{log_directory}{file_name}',
+                                        f'{log_directory}{name}.{match.group(1)}{match.group(2) or ""}.idx')
+    segments = sorted(segments.values())
+    if os.path.exists(f'{log_directory}{name}.txt'):
+        segments.append((None, f'{log_directory}{name}.txt', f'{log_directory}{name}.idx'))
+    return segments
+
+
+# Create a function to read the index of a log segment and split the segment into chunks that start at each index
+# entry. This returns a list of the timestamps and a list of the offsets that the chunks start at, the first chunk
+# always starts at offset 0. The offsets of a compressed segment are those of its gzip members
+def read_log_index(log_path, index_path):
+    timestamps, offsets = [float('-inf')], [0]
+    try:
+        with open(index_path, 'rb') as index_file:
+            index = index_file.read()
+    except FileNotFoundError:
+        return timestamps, offsets
+    for timestamp, offset in log_index_struct.iter_unpack(index[:len(index) - len(index) % log_index_struct.size]):
+        if offset == 0:
+            timestamps[0] = timestamp
+        else:
+            timestamps.append(timestamp)
+            offsets.append(offset)
+    return timestamps, offsets
+
+
+# Create a function to read the entries of a log segment from an offset, as a list of (timestamp, data).
+# If length is set then only that many bytes are read, otherwise the rest of the segment is read. The offset and length
+# of a compressed segment must cover whole gzip members, which is what its index points to
+def read_log_segment(log_path, offset, length=None):
+    try:
+        with open(log_path, 'rb') as log_file:
+            log_file.seek(offset)
+            data = log_file.read(-1 if length is None else length)
+    except FileNotFoundError:
+        return []
+    if log_path.endswith('.gz'):
+        data = gzip.decompress(data)
+    data = data.decode('utf-8', errors='replace')
+    entries = []
+    # The last part is either empty or an entry that is still being written
+    for entry in data.split('\n\n\n')[:-1]:
+        timestamp, separator, entry_data = entry.partition(': ')
+        try:
+            entries.append((float(timestamp), entry_data))
+        except ValueError:
+            # Entries can contain blank lines, in which case this is the rest of the previous entry
+            if entries:
+                entries[-1] = (entries[-1][0], f'{entries[-1][1]}\n\n\n{entry}')
+    return entries
+
+
+# Create a function to search a log, returning a list of (timestamp, data) oldest first.
+# Only entries between start and end (inclusive) that contain search are returned. If tail is set only the last tail
+# of those are returned, otherwise only the first log_fetch_max_entries. The time index is used to skip to the start
+# of the range and the log is read forwards one index entry at a time, or when tail is set it is read backwards from
+# the end of the range, until enough entries have been found
+def search_log(name, start=None, end=None, search=None, tail=None):
+    start = float('-inf') if start is None else start
+    end = float('inf') if end is None else end
+    segments = list_log_segments(name)
+    segment_ranges = []
+    for i, (segment_start, log_path, index_path) in enumerate(segments):
+        segment_end = segments[i + 1][0] if i + 1 < len(segments) and segments[i + 1][0] is not None else float('inf')
+        # Skip any segments that are entirely outside of the time range, a segment ends where the next one starts
+        if (segment_start is not None and segment_start > end) or segment_end < start:
+            continue
+        segment_ranges.append((log_path,) + read_log_index(log_path, index_path))
+
+    def matches(entry):
+        return start <= entry[0] <= end and (search is None or search in entry[1])
+
+    results = []
+    if tail is None:
+        for log_path, timestamps, offsets in segment_ranges:
+            # Read forwards through the chunks from the last one that starts before the time range, until the end of
+            # the time range has been passed
+            for i in range(max(bisect_right(timestamps, start) - 1, 0), len(offsets)):
+                if timestamps[i] > end:
+                    return results
+                length = offsets[i + 1] - offsets[i] if i + 1 < len(offsets) else None
+                for entry in read_log_segment(log_path, offsets[i], length):
+                    if entry[0] > end:
+                        return results
+                    if matches(entry):
+                        results.append(entry)
+                        if len(results) >= api_log_fetch_max_entries:
+                            return results
+        return results
+    for log_path, timestamps, offsets in reversed(segment_ranges):
+        # Read backwards through the chunks, skipping any that start after the time range
+        for i in reversed(range(0, bisect_right(timestamps, end))):
+            length = offsets[i + 1] - offsets[i] if i + 1 < len(offsets) else None
+            entries = read_log_segment(log_path, offsets[i], length)
+            results = [entry for entry in entries if matches(entry)] + results
+            # Stop once enough entries have been found, or the start of the time range has been reached
+            if len(results) >= tail or (entries and entries[0][0] < start):
+                return results[-tail:]
+    return results[-tail:]
+
+
+# Create a function that will run asynchronously to write log entries
+def run_log_writer():
+    stopping = False
+    while stopping is False:
+        # Wait until an entry is added to the queue, then collect any others that are waiting
+        entry = log_queue.get()
+        batch = []
+        while entry is not None:
+            batch.append(entry)
+            if len(batch) >= api_log_batch_size:
+                break
+            try:
+                entry = log_queue.get_nowait()
+            except Empty:
+                break
+        # None is used by stop_log_writer() to tell the writer to stop once the queue is empty
+        if entry is None:
+            stopping = True
+        write_log_batch(batch)
+    for open_files in log_files.values():
+        for open_file in open_files:
+            open_file.close()
+    log_files.clear()
+
+
+# Create a function to stop the log writer once every queued entry has been written
+def stop_log_writer():
+    log_queue.put(None)
+    log_writer_thread.join()
+
+
+# #######################
+# ### END LOG STORAGE ###
+# #######################
+
+
+# #####################################
+# ### BEGIN HISTORICAL DATA STORAGE ###
+# #####################################
+
+# Historical data for each value of each system is stored in historical/<system_id>/<value_name>/ as segment files,
+# which are named after the time of their first sample in milliseconds. Each segment file starts with
+# historical_segment_header and is followed by samples in timestamp order. Each sample is stored as a little endian
+# double timestamp, an unsigned int length, then the sample itself as a JSON string.
+# Next to each <start>.seg file is a <start>.idx file of (timestamp, offset) pairs, which is used to seek straight to
+# the first sample needed instead of reading the whole segment
+historical_segment_header = b'SSHS\x01\x00\x00\x00'
+historical_record_struct = struct.Struct('<dI')
+historical_index_struct = struct.Struct('<dQ')
+# Add an entry to the index every this many samples
+historical_index_interval = 256
+
+# Create a dictionary to buffer samples in until they are flushed to disk, keyed by (system_id, value_name)
+historical_buffer = {}
+# Create a lock to stop multiple request threads from modifying the buffer at the same time
+historical_buffer_lock = Lock()
+# Create a dictionary to store the timestamp of the latest sample of each series, so samples are always in order
+historical_last_timestamps = {}
+# Create a dictionary to store the segment that new samples are appended to for each series, and its size
+historical_open_segments = {}
+# Create a lock to stop the compactor from removing a segment while samples are being appended to it
+historical_segments_lock = Lock()
+# Create an Event that is used to wake up the historical flusher early
+historical_flush_event = Event()
+# Create a dictionary to store statistics about the historical flusher in, these are returned by admin/stats
+historical_stats = {
+    'buffered_samples': 0,
+    'flushes': 0,
+    'flushed_samples': 0,
+    'last_flush_latency': 0.0,
+    'imported_files': 0,
+    'compactions': 0,
+    'last_compaction_latency': 0.0,
+    'removed_segments': 0
+}
+
+
+# Create a function to get the directory that the segments of a series are stored in.
+# If resolution is set then this is the directory of the rollups of the series at that resolution
+def historical_series_directory(_id, _val_name, resolution=None):
+    if resolution is not None:
+        return f'{historical_directory}{_id}/{_val_name}/rollup_{resolution}/'
+    return f'{historical_directory}{_id}/{_val_name}/'
+
+
+# Create a function to add samples to the buffer, samples is a dictionary of value names to JSON strings.
+# Every sample is given the same timestamp, unless that would put it before the latest sample of its series
+@writer_function(wait=False)
+def buffer_historical_samples(_id, samples):
+    with historical_buffer_lock:
+        now = time()
+        for _val_name, data in samples.items():
+            series = (str(_id), str(_val_name))
+            timestamp = max(now, historical_last_timestamps.get(series, 0))
+            historical_last_timestamps[series] = timestamp
+            historical_buffer.setdefault(series, []).append((timestamp, data))
+        historical_stats['buffered_samples'] += len(samples)
+        buffer_full = historical_stats['buffered_samples'] >= api_historical_buffer_limit
+    # Flush straight away if too many samples are buffered
+    if buffer_full is True:
+        historical_flush_event.set()
+
+
+# Create a function for logging historical API data for later analysis
+def api_historical(_id, _val_name, _data):
+    # Check if we should be logging historical data
+    if api_enable_historical is True:
+        buffer_historical_samples(_id, {_val_name: json.dumps(_data)})
+    return True
+
+
+# Create a function for logging several historical values of a system at once, _values is a dictionary of value names
+# to data. Every value is logged with the same timestamp
+def api_historical_batch(_id, _values):
+    # Check if we should be logging historical data
+    if api_enable_historical is True:
+        buffer_historical_samples(_id, {_val_name: json.dumps(_data) for _val_name, _data in _values.items()})
+    return True
+
+
+# Create a function to list the start times (in milliseconds) of the segments of a series, oldest first
+def list_historical_segments(series_directory):
+    try:
+        return sorted(int(name[:-4]) for name in os.listdir(series_directory) if name.endswith('.seg'))
+    except FileNotFoundError:
+        return []
+
+
+# Create a function to append samples to the segments of a series, samples is a list of (timestamp, JSON string)
+# in timestamp order. A new segment is started whenever the current one reaches historical_segment_size, and for raw
+# samples whenever it is historical_segment_age seconds old, so that historical_retention can remove old samples
+def write_historical_samples(_id, _val_name, samples, resolution=None):
+    write_start = time()
+    with historical_segments_lock:
+        append_historical_samples(_id, _val_name, samples, resolution)
+    observe_latency('historical_write_duration_seconds', time() - write_start, resolution=resolution or 'raw')
+
+
+# Create a function to append samples to the segments of a series, this must be called while holding
+# historical_segments_lock
+def append_historical_samples(_id, _val_name, samples, resolution):
+    series = (str(_id), str(_val_name), resolution)
+    series_directory = historical_series_directory(_id, _val_name, resolution)
+    # Find the segment that samples are currently appended to
+    if series not in historical_open_segments:
+        segments = list_historical_segments(series_directory)
+        if segments:
+            segment_path = f'{series_directory}{segments[-1]:016d}'
+            historical_open_segments[series] = (segment_path, os.path.getsize(f'{segment_path}.seg'))
+    segment_path, segment_size = historical_open_segments.get(series, (None, api_historical_segment_size))
+    max_age = api_historical_segment_age if resolution is None and api_historical_segment_age > 0 else float('inf')
+    segment_end = float('inf') if segment_path is None else int(os.path.basename(segment_path)) / 1000 + max_age
+    i = 0
+    while i < len(samples):
+        if segment_size >= api_historical_segment_size or samples[i][0] >= segment_end:
+            # Start a new segment named after its first sample, making sure that it sorts after the previous segment
+            os.makedirs(series_directory, exist_ok=True)
+            segment_start = int(samples[i][0] * 1000)
+            if segment_path is not None:
+                segment_start = max(segment_start, int(os.path.basename(segment_path)) + 1)
+            segment_path = f'{series_directory}{segment_start:016d}'
+            with open(f'{segment_path}.seg', 'wb') as segment_file:
+                segment_file.write(historical_segment_header)
+            open(f'{segment_path}.idx', 'wb').close()
+            segment_size = len(historical_segment_header)
+            segment_end = segment_start / 1000 + max_age
+        # Build the samples and index entries until the segment is full, then write each of them with a single call
+        records = bytearray()
+        index_entries = bytearray()
+        first_sample = i
+        while i < len(samples) and segment_size + len(records) < api_historical_segment_size and \
+                samples[i][0] < segment_end:
+            timestamp, data = samples[i]
+            if (i - first_sample) % historical_index_interval == 0:
+                index_entries += historical_index_struct.pack(timestamp, segment_size + len(records))
+            data = data.encode('utf-8')
+            records += historical_record_struct.pack(timestamp, len(data))
+            records += data
+            i += 1
+        # The samples are written before the index, so the index never points past the end of the segment
+        with open(f'{segment_path}.seg', 'ab') as segment_file:
+            segment_file.write(records)
+        with open(f'{segment_path}.idx', 'ab') as index_file:
+            index_file.write(index_entries)
+        segment_size += len(records)
+        historical_open_segments[series] = (segment_path, segment_size)
+
+
+# Create a function to read the samples of a series between two timestamps (inclusive).
+# This is a generator of (timestamp, JSON string) in timestamp order, start and end can be None for no limit
+def read_historical_samples(_id, _val_name, start=None, end=None, resolution=None):
+    start = float('-inf') if start is None else start
+    end = float('inf') if end is None else end
+    series_directory = historical_series_directory(_id, _val_name, resolution)
+    segments = list_historical_segments(series_directory)
+    for i, segment_start in enumerate(segments):
+        # Skip any segments that are entirely outside of the requested time range, a segment ends where the next starts.
+        # Segment names can be a few milliseconds after their first sample, so allow a second either side
+        if segment_start / 1000 - 1 > end:
+            break
+        if i + 1 < len(segments) and segments[i + 1] / 1000 + 1 < start:
+            continue
+        segment_path = f'{series_directory}{segment_start:016d}'
+        try:
+            # Use the index to find the offset of the last indexed sample at or before the start of the range
+            offset = len(historical_segment_header)
+            with open(f'{segment_path}.idx', 'rb') as index_file:
+                index = index_file.read()
+            index_entries = [historical_index_struct.unpack_from(index, position)
+                             for position in range(0, len(index) - historical_index_struct.size + 1,
+                                                   historical_index_struct.size)]
+            position = bisect_right([entry[0] for entry in index_entries], start) - 1
+            if position >= 0:
+                offset = index_entries[position][1]
+            with open(f'{segment_path}.seg', 'rb') as segment_file:
+                segment_file.seek(offset)
+                records = segment_file.read()
+        # The segment may have been removed while it was being read
+        except FileNotFoundError:
+            continue
+        position = 0
+        while position + historical_record_struct.size <= len(records):
+            timestamp, length = historical_record_struct.unpack_from(records, position)
+            position += historical_record_struct.size
+            # Stop at a sample that is still being written
+            if position + length > len(records):
+                break
+            if timestamp > end:
+                return
+            if timestamp >= start:
+                yield timestamp, records[position:position + length].decode('utf-8')
+            position += length
+
+
+# Create a function to read the samples of a series that are still waiting in the buffer, between two timestamps
+@writer_function()
+def read_buffered_historical_samples(_id, _val_name, start, end):
+    with historical_buffer_lock:
+        samples = list(historical_buffer.get((str(_id), str(_val_name)), []))
+    return [(timestamp, data) for timestamp, data in samples if start <= timestamp <= end]
+
+
+# Create a function to group samples into buckets of bucket_size seconds, buckets are aligned to multiples of
+# bucket_size. This returns a list of dictionaries with the start of each bucket, the number of samples, the last
+# sample, and the number, sum, min and max of any numeric samples (min and max are None if the bucket has no numeric
+# samples)
+def aggregate_historical_samples(samples, bucket_size):
+    if not samples:
+        return []
+    timestamps = numpy.fromiter((sample[0] for sample in samples), dtype=numpy.float64, count=len(samples))
+    numbers = numpy.empty(len(samples), dtype=numpy.float64)
+    for i, (timestamp, data) in enumerate(samples):
+        # Samples that aren't a plain number are still counted, but are left out of min, max and mean
+        try:
+            numbers[i] = float(data)
+        except ValueError:
+            numbers[i] = numpy.nan
+    # Samples are in timestamp order, so each bucket is a contiguous run of samples
+    bucket_numbers = numpy.floor(timestamps / bucket_size).astype(numpy.int64)
+    bucket_starts = numpy.flatnonzero(numpy.diff(bucket_numbers, prepend=bucket_numbers[0] - 1))
+    bucket_ends = numpy.append(bucket_starts[1:], len(samples))
+    is_number = ~numpy.isnan(numbers)
+    number_counts = numpy.add.reduceat(is_number.astype(numpy.int64), bucket_starts)
+    sums = numpy.add.reduceat(numpy.where(is_number, numbers, 0), bucket_starts)
+    minimums = numpy.fmin.reduceat(numbers, bucket_starts)
+    maximums = numpy.fmax.reduceat(numbers, bucket_starts)
+    buckets = []
+    for i in range(0, len(bucket_starts)):
+        has_numbers = number_counts[i] > 0
+        buckets.append({
+            'start': int(bucket_numbers[bucket_starts[i]]) * bucket_size,
+            'count': int(bucket_ends[i] - bucket_starts[i]),
+            'numbers': int(number_counts[i]),
+            'sum': float(sums[i]),
+            'min': float(minimums[i]) if has_numbers else None,
+            'max': float(maximums[i]) if has_numbers else None,
+            'last': json.loads(samples[bucket_ends[i] - 1][1])
+        })
+    return buckets
+
+
+# Create a function to combine buckets from aggregate_historical_samples() into larger buckets of bucket_size seconds.
+# bucket_size must be a multiple of the size of the buckets being combined, and they must be in order
+def merge_historical_buckets(buckets, bucket_size):
+    merged_buckets = []
+    for bucket in buckets:
+        bucket_start = math.floor(bucket['start'] / bucket_size) * bucket_size
+        if not merged_buckets or merged_buckets[-1]['start'] != bucket_start:
+            merged_buckets.append(dict(bucket, start=bucket_start))
+            continue
+        merged_bucket = merged_buckets[-1]
+        merged_bucket['count'] += bucket['count']
+        merged_bucket['numbers'] += bucket['numbers']
+        merged_bucket['sum'] += bucket['sum']
+        if bucket['numbers'] > 0:
+            merged_bucket['min'] = bucket['min'] if merged_bucket['min'] is None \
+                else min(merged_bucket['min'], bucket['min'])
+            merged_bucket['max'] = bucket['max'] if merged_bucket['max'] is None \
+                else max(merged_bucket['max'], bucket['max'])
+        merged_bucket['last'] = bucket['last']
+    return merged_buckets
+
+
+# Create a function to convert buckets into the format returned by fetch/history
+def format_historical_buckets(buckets):
+    return [{
+        'start': bucket['start'],
+        'count': bucket['count'],
+        'min': bucket['min'],
+        'max': bucket['max'],
+        'mean': bucket['sum'] / bucket['numbers'] if bucket['numbers'] > 0 else None,
+        'last': bucket['last']
+    } for bucket in buckets]
+
+
+# Create a function to import a historical/<system_id>/<value_name>.txt file written by older versions into segments.
+# Once it has been imported the file is renamed to <value_name>.txt.imported
+def import_historical_text_file(_id, _val_name):
+    text_path = f'{historical_directory}{_id}/{_val_name}.txt'
+    samples = []
+    with open(text_path, 'r') as text_file:
+        for line in text_file:
+            # Each line is in the format "<timestamp>": "<str(data)>"
+            match = re.match(r'^"([0-9.eE+-]+)": "(.*)"$', line.rstrip('\n'))
+            if match is None:
+                continue
+            data = match.group(2)
+            # The data was written with str(), so try reading it as JSON then as a Python literal before keeping it as
+            # text
+            try:
+                data = json.dumps(json.loads(data))
+            except ValueError:
+                try:
+                    data = json.dumps(ast.literal_eval(data))
+                except (ValueError, SyntaxError, TypeError):
+                    data = json.dumps(data)
+            samples.append((float(match.group(1)), data))
+    # Merge the imported samples with any that have already been stored, then rewrite the series
+    series_directory = historical_series_directory(_id, _val_name)
+    samples.extend(read_historical_samples(_id, _val_name))
+    samples.sort(key=lambda sample: sample[0])
+    for segment_start in list_historical_segments(series_directory):
+        os.remove(f'{series_directory}{segment_start:016d}.seg')
+        os.remove(f'{series_directory}{segment_start:016d}.idx')
+    historical_open_segments.pop((str(_id), str(_val_name), None), None)
+    write_historical_samples(_id, _val_name, samples)
+    os.rename(text_path, f'{text_path}.imported')
+    historical_stats['imported_files'] += 1
+
+
+# Create a function to import every historical text file written by older versions
+def import_historical_text_files():
+    for _id in os.listdir(historical_directory):
+        if os.path.isdir(f'{historical_directory}{_id}') is False:
+            continue
+        for name in os.listdir(f'{historical_directory}{_id}'):
+            if name.endswith('.txt') is False:
+                continue
+            try:
+                import_historical_text_file(_id, name[:-4])
+            except (OSError, ValueError) as e:
+                system_log(f'ERROR:000008 Failed to import historical file {_id}/{name}: {e}\n')
+
+
+# Create a function to write every buffered sample to disk
+def flush_historical_buffer():
+    global historical_buffer
+    flush_start = time()
+    # Swap the buffer for an empty one, so request threads aren't blocked while the samples are written
+    with historical_buffer_lock:
+        buffer = historical_buffer
+        historical_buffer = {}
+        historical_stats['buffered_samples'] = 0
+    for (_id, _val_name), samples in buffer.items():
+        try:
+            write_historical_samples(_id, _val_name, samples)
+        except OSError as e:
+            system_log(f'ERROR:000009 Failed to write {len(samples)} historical samples for {_id}/{_val_name}: {e}\n')
+    historical_stats['flushes'] += 1
+    historical_stats['flushed_samples'] += sum(len(samples) for samples in buffer.values())
+    historical_stats['last_flush_latency'] = time() - flush_start
+
+
+# Create a function that will run asynchronously to flush the historical buffer to disk
+def run_historical_flusher():
+    # Import any text files written by older versions before anything else is written
+    if api_historical_import_text is True:
+        import_historical_text_files()
+    historical_import_done.set()
+    while historical_flusher_stopping is False:
+        # Wait until the flush interval has passed or the buffer is full
+        historical_flush_event.wait(api_historical_flush_interval)
+        historical_flush_event.clear()
+        flush_historical_buffer()
+    # Write anything that was buffered while the last flush was running
+    flush_historical_buffer()
+
+
+# Create a function to stop the historical flusher once every buffered sample has been written
+def stop_historical_flusher():
+    global historical_flusher_stopping
+    historical_flusher_stopping = True
+    historical_flush_event.set()
+    historical_flusher_thread.join()
+
+
+# The resolutions in seconds that raw samples are rolled up into, each one is built from the one before it
+historical_rollup_resolutions = [60, 3600, 86400]
+# The maximum number of buckets that are rolled up for each series at each resolution each time the compactor runs,
+# so that rolling up a long history is spread across several runs
+historical_rollup_batch = 1440
+# Create a dictionary to store the end of the latest rollup of each series at each resolution
+historical_rollup_watermarks = {}
+# Create an Event that is set once historical text files have been imported, the compactor waits for this
+historical_import_done = Event()
+# Create an Event that is used to stop the historical compactor
+historical_compactor_stop = Event()
+
+
+# Create a function to get the end of the latest rollup of a series at a resolution, this returns None if there are none
+def get_historical_rollup_watermark(_id, _val_name, resolution):
+    key = (str(_id), str(_val_name), resolution)
+    # The rollups are written by the writer process, so a request worker has to read the watermark every time
+    if key not in historical_rollup_watermarks or writer_connection is not None:
+        watermark = None
+        segments = list_historical_segments(historical_series_directory(_id, _val_name, resolution))
+        if segments:
+            # Only the end of the rollups needs to be read to find the latest one
+            for timestamp, data in read_historical_samples(_id, _val_name, segments[-1] / 1000 - 1,
+                                                           resolution=resolution):
+                watermark = timestamp + resolution
+        historical_rollup_watermarks[key] = watermark
+    return historical_rollup_watermarks[key]
+
+
+# Create a function to read the rollups of a series at a resolution as buckets, for rollups starting between two times
+def read_historical_rollups(_id, _val_name, resolution, start, end):
+    buckets = []
+    for timestamp, data in read_historical_samples(_id, _val_name, start, end, resolution=resolution):
+        if timestamp < end:
+            buckets.append(dict(json.loads(data), start=timestamp))
+    return buckets
+
+
+# Create a function to roll up any complete buckets of a series that haven't been rolled up yet, and to remove any raw
+# segments older than historical_retention once they have been rolled up
+def compact_historical_series(_id, _val_name, now):
+    # Samples can reach the disk up to historical_flush_interval seconds after they were received
+    complete_before = now - api_historical_flush_interval - 5
+    source_start = None
+    for i, resolution in enumerate(historical_rollup_resolutions):
+        watermark = get_historical_rollup_watermark(_id, _val_name, resolution)
+        if watermark is None:
+            # Start from the first raw sample, or the first rollup at the previous resolution
+            source_segments = list_historical_segments(
+                historical_series_directory(_id, _val_name, historical_rollup_resolutions[i - 1] if i > 0 else None))
+            if not source_segments:
+                return
+            watermark = math.floor(source_segments[0] / 1000 / resolution) * resolution
+        # Only roll up buckets that can't receive any more samples, and that are covered by the previous resolution
+        cutoff = math.floor(complete_before / resolution) * resolution
+        if source_start is not None:
+            cutoff = min(cutoff, math.floor(source_start / resolution) * resolution)
+        cutoff = min(cutoff, watermark + resolution * historical_rollup_batch)
+        if cutoff > watermark:
+            if i == 0:
+                samples = [sample for sample in read_historical_samples(_id, _val_name, watermark, cutoff)
+                           if sample[0] < cutoff]
+                buckets = aggregate_historical_samples(samples, resolution)
+            else:
+                buckets = merge_historical_buckets(read_historical_rollups(
+                    _id, _val_name, historical_rollup_resolutions[i - 1], watermark, cutoff), resolution)
+            if buckets:
+                write_historical_samples(_id, _val_name, [
+                    (bucket['start'], json.dumps({key: value for key, value in bucket.items() if key != 'start'}))
+                    for bucket in buckets], resolution)
+            historical_rollup_watermarks[(str(_id), str(_val_name), resolution)] = cutoff
+            watermark = cutoff
+        source_start = watermark
+    # Remove raw segments that are older than historical_retention and have been rolled up. A segment ends where the
+    # next one starts, and the newest segment ends when it was last written to
+    if api_historical_retention > 0:
+        rolled_up_before = historical_rollup_watermarks.get(
+            (str(_id), str(_val_name), historical_rollup_resolutions[0]))
+        series_directory = historical_series_directory(_id, _val_name)
+        with historical_segments_lock:
+            segments = list_historical_segments(series_directory)
+            segment_ends = [next_segment_start / 1000 + 1 for next_segment_start in segments[1:]]
+            if segments:
+                segment_ends.append(os.path.getmtime(f'{series_directory}{segments[-1]:016d}.seg'))
+            for segment_start, segment_end in zip(segments, segment_ends):
+                if segment_end >= now - api_historical_retention or rolled_up_before is None or \
+                        segment_end >= rolled_up_before:
+                    break
+                os.remove(f'{series_directory}{segment_start:016d}.seg')
+                os.remove(f'{series_directory}{segment_start:016d}.idx')
+                historical_stats['removed_segments'] += 1
+            else:
+                # Every segment was removed, so the next sample starts a new one
+                historical_open_segments.pop((str(_id), str(_val_name), None), None)
+
+
+# Create a function to compact every series
+def compact_historical_data():
+    now = time()
+    for _id in os.listdir(historical_directory):
+        if os.path.isdir(f'{historical_directory}{_id}') is False:
+            continue
+        for _val_name in os.listdir(f'{historical_directory}{_id}'):
+            if os.path.isdir(f'{historical_directory}{_id}/{_val_name}') is False:
+                continue
+            try:
+                compact_historical_series(_id, _val_name, now)
+            except (OSError, ValueError) as e:
+                system_log(f'ERROR:000010 Failed to compact historical data for {_id}/{_val_name}: {e}\n')
+
+
+# Create a function that will run asynchronously to roll up and remove old historical data
+def run_historical_compactor():
+    # Wait until any text files have been imported, as that rewrites the raw segments
+    historical_import_done.wait()
+    while historical_compactor_stop.is_set() is False:
+        compact_start = time()
+        compact_historical_data()
+        historical_stats['compactions'] += 1
+        historical_stats['last_compaction_latency'] = time() - compact_start
+        historical_compactor_stop.wait(api_historical_compaction_interval)
+
+
+# Create a function to stop the historical compactor
+def stop_historical_compactor():
+    historical_compactor_stop.set()
+    historical_compactor_thread.join()
+
+
+# Create a function to fetch the buckets of a series between two times for fetch/history.
+# If bucket_size is a multiple of a rollup resolution then the coarsest rollups are used for as much of the time range
+# as they cover, and raw samples are only read for the rest. Otherwise the finest rollups are used for any of the time
+# range before the oldest raw segment, with each rollup counted in the bucket it starts in, so that samples removed by
+# historical_retention are still included
+def query_historical_buckets(_id, _val_name, start, end, bucket_size):
+    buckets = []
+    raw_start = start
+    resolution = None
+    for rollup_resolution in reversed(historical_rollup_resolutions):
+        if bucket_size % rollup_resolution == 0:
+            resolution = rollup_resolution
+            break
+    rollup_resolution = historical_rollup_resolutions[0] if resolution is None else resolution
+    watermark = get_historical_rollup_watermark(_id, _val_name, rollup_resolution)
+    if resolution is None and watermark is not None:
+        raw_segments = list_historical_segments(historical_series_directory(_id, _val_name))
+        if api_historical_retention <= 0:
+            watermark = None
+        elif raw_segments:
+            # The rollup that the oldest raw segment starts in also covers raw samples, so raw samples are only read
+            # from the end of it
+            watermark = min(watermark, math.ceil(raw_segments[0] / 1000 / rollup_resolution) * rollup_resolution)
+    if watermark is not None and watermark > start:
+        buckets = read_historical_rollups(_id, _val_name, rollup_resolution,
+                                          math.floor(start / rollup_resolution) * rollup_resolution,
+                                          min(watermark, end))
+        raw_start = watermark
+    samples = []
+    if raw_start <= end:
+        samples = list(read_historical_samples(_id, _val_name, raw_start, end))
+        samples.extend(read_buffered_historical_samples(_id, _val_name, raw_start, end))
+    return merge_historical_buckets(buckets + aggregate_historical_samples(samples, resolution or bucket_size),
+                                    bucket_size)
+
+
+# ###################################
+# ### END HISTORICAL DATA STORAGE ###
+# ###################################
+
+
+# ###############################
+# ### BEGIN HEARTBEAT MONITOR ###
+# ###############################
+
+# Every system that has sent a heartbeat has a deadline of its latest heartbeat plus heartbeat_timeout, and is marked
+# as down if the deadline passes before it sends another one. The deadlines are kept in a heap so that the monitor only
+# ever looks at the earliest one. A heartbeat pushes a new deadline rather than moving the old one, so the heap can hold
+# old deadlines, these are skipped when they are popped because they no longer match heartbeat_deadlines
+heartbeat_deadlines = {}
+heartbeat_deadline_heap = []
+# Create a dictionary to store the systems that are down, and the time they were marked as down
+down_systems = {}
+# Create a deque to store the latest transitions between up and down, oldest first
+heartbeat_transitions = deque(maxlen=api_heartbeat_history_size)
+# Create a lock to stop request threads and the monitor from modifying the deadlines at the same time
+heartbeat_monitor_lock = Lock()
+# Create an Event that is used to wake up the heartbeat monitor when the earliest deadline changes
+heartbeat_monitor_event = Event()
+heartbeat_monitor_stopping = False
+
+
+# Create a function to record a heartbeat from a system, moving its deadline and marking it as up if it was down
+def record_system_heartbeat(system_id, heartbeat):
+    if api_heartbeat_timeout <= 0:
+        return
+    deadline = heartbeat + api_heartbeat_timeout
+    transition = None
+    with heartbeat_monitor_lock:
+        heartbeat_deadlines[system_id] = deadline
+        heappush(heartbeat_deadline_heap, (deadline, system_id))
+        if system_id in down_systems:
+            del down_systems[system_id]
+            transition = {'system_id': system_id, 'state': 'up', 'time': heartbeat}
+            heartbeat_transitions.append(transition)
+        # Rebuild the heap once old deadlines make up most of it, so it doesn't grow with every heartbeat
+        if len(heartbeat_deadline_heap) > 2 * len(heartbeat_deadlines) + 1024:
+            heartbeat_deadline_heap[:] = [(deadline, system_id) for system_id, deadline in heartbeat_deadlines.items()]
+            heapify(heartbeat_deadline_heap)
+        # The monitor only needs waking if it is waiting on a later deadline, which is only when the heap was empty
+        if heartbeat_deadline_heap[0] == (deadline, system_id):
+            heartbeat_monitor_event.set()
+    # Request workers keep their own deadlines for fetch/down_systems, but only the writer process logs transitions
+    if transition is not None and writer_connection is None:
+        system_log(f'System {system_id} is up after sending a heartbeat\n')
+
+
+# Create a function to load a deadline for every system that has sent a heartbeat from system_state.
+# Systems that have been silent for longer than heartbeat_timeout are marked as down the first time the monitor runs
+def load_heartbeat_deadlines():
+    for system_id in get_system_ids():
+        heartbeat = get_system_heartbeat(system_id)
+        if heartbeat is not None:
+            record_system_heartbeat(system_id, float(heartbeat))
+
+
+# Create a function to mark every system whose deadline has passed as down, and return the time until the next deadline.
+# This returns None if there are no deadlines
+def check_heartbeat_deadlines():
+    transitions = []
+    with heartbeat_monitor_lock:
+        now = time()
+        while heartbeat_deadline_heap and heartbeat_deadline_heap[0][0] <= now:
+            deadline, system_id = heappop(heartbeat_deadline_heap)
+            # Skip deadlines that have been replaced by a later heartbeat
+            if heartbeat_deadlines.get(system_id) != deadline:
+                continue
+            del heartbeat_deadlines[system_id]
+            down_systems[system_id] = deadline
+            transitions.append({'system_id': system_id, 'state': 'down', 'time': deadline})
+        heartbeat_transitions.extend(transitions)
+        next_deadline = heartbeat_deadline_heap[0][0] - now if heartbeat_deadline_heap else None
+    for transition in transitions if writer_connection is None else []:
+        system_log(f'System {transition["system_id"]} is down, it has not sent a heartbeat for '
+                   f'{api_heartbeat_timeout} seconds\n')
+    return next_deadline
+
+
+# Create a function to fetch the systems that are down and the transitions since a time.
+# This returns a list of (system_id, down since) and a list of transitions, both oldest first
+def get_down_systems(since=None):
+    with heartbeat_monitor_lock:
+        systems = sorted(down_systems.items(), key=lambda item: item[1])
+        transitions = [transition for transition in heartbeat_transitions
+                       if since is None or transition['time'] >= since]
+    return systems, transitions
+
+
+# Create a function that will run asynchronously to mark systems as down when their deadline passes
+def run_heartbeat_monitor():
+    while heartbeat_monitor_stopping is False:
+        # Clear the Event before checking, so a heartbeat that arrives during the check still wakes the monitor
+        heartbeat_monitor_event.clear()
+        heartbeat_monitor_event.wait(check_heartbeat_deadlines())
+
+
+# Create a function to stop the heartbeat monitor
+def stop_heartbeat_monitor():
+    global heartbeat_monitor_stopping
+    heartbeat_monitor_stopping = True
+    heartbeat_monitor_event.set()
+    heartbeat_monitor_thread.join()
+
+# #############################
+# ### END HEARTBEAT MONITOR ###
+# #############################
+
+
+# ###########################
+# ### BEGIN SUBSCRIPTIONS ###
+# ###########################
+
+# Every change to a heartbeat or value is published as an event with an increasing sequence number. The latest
+# subscribe_buffer_size events are kept as (sequence, system_id, value_name, event JSON) so that subscribers can catch
+# up on events they missed, value_name is None for heartbeats
+subscription_events = deque(maxlen=api_subscribe_buffer_size)
+subscription_sequence = 0
+# Create a Condition that guards the events and is notified whenever one is published, long-poll requests wait on this
+subscription_condition = Condition()
+# A heartbeat is published at most once every subscribe_heartbeat_interval seconds for each system. Later heartbeats
+# are held until the interval has passed and only the latest is published, the heap holds (due time, system_id)
+subscription_pending_heartbeats = {}
+subscription_pending_heartbeat_heap = []
+subscription_heartbeat_times = {}
+# Create a dictionary to store statistics about subscriptions in, these are returned by admin/stats
+subscription_stats = {
+    'published_events': 0,
+    'coalesced_heartbeats': 0,
+    'accepted_connections': 0,
+    'rejected_connections': 0,
+    'dropped_connections': 0,
+    'rejected_polls': 0
+}
+# Each long-poll that is waiting for an event holds a request thread, so only subscribe_max_waiters are allowed to wait
+# at once in each process. This is guarded by subscription_condition
+subscription_waiters = 0
+# The subscription server is a single thread that uses a selector to serve every connection, and keeps a dictionary
+# for each connection keyed by its socket
+subscription_selector = selectors.DefaultSelector()
+subscription_connections = {}
+subscription_path = f'{api_base_url}{api_value_fetch_prefix}subscribe'
+# Create a pair of connected sockets, writing to the first one wakes up the subscription server
+subscription_wake_sender, subscription_wake_receiver = socket.socketpair()
+subscription_wake_sender.setblocking(False)
+subscription_wake_receiver.setblocking(False)
+# Credentials are checked in a thread pool so that the subscription server never waits for the database or
+# verify_password(), the results are added to this deque as (connection, future)
+subscription_auth_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='subscription_auth')
+subscription_authenticated = deque()
+subscription_server_stopping = False
+
+
+# Create a function to add an event, this must be called while holding subscription_condition
+def append_subscription_event(system_id, value_name, data):
+    global subscription_sequence
+    subscription_sequence += 1
+    if value_name is None:
+        event = (f'{{"seq":{subscription_sequence},"system_id":{json.dumps(system_id)},"type":"heartbeat",'
+                 f'"data":{data}}}')
+    else:
+        event = (f'{{"seq":{subscription_sequence},"system_id":{json.dumps(system_id)},"type":"value",'
+                 f'"value":{json.dumps(value_name)},"data":{data}}}')
+    subscription_events.append((subscription_sequence, system_id, value_name, event))
+    subscription_stats['published_events'] += 1
+    replicate_change(('event', subscription_sequence, system_id, value_name, event))
+
+
+# Create a function to count a long-poll that was rejected because too many were already waiting
+@writer_function(wait=False)
+def count_rejected_subscription_poll():
+    with subscription_condition:
+        subscription_stats['rejected_polls'] += 1
+
+
+# Create a function to wake up the subscription server so that it sends new events straight away
+def wake_subscription_server():
+    try:
+        subscription_wake_sender.send(b'\0')
+    except OSError:
+        # The socket buffer is full, so the subscription server already has a wake up waiting
+        pass
+
+
+# Create a function to publish new values of a system, values is a dictionary of value names to JSON strings
+def publish_value_changes(system_id, values):
+    with subscription_condition:
+        for value_name, data in values.items():
+            append_subscription_event(system_id, value_name, data)
+        subscription_condition.notify_all()
+    wake_subscription_server()
+
+
+# Create a function to publish a heartbeat of a system, or hold it if one was published too recently
+def publish_heartbeat(system_id, heartbeat):
+    with subscription_condition:
+        last_published = subscription_heartbeat_times.get(system_id)
+        if last_published is not None and time() - last_published < api_subscribe_heartbeat_interval:
+            held = system_id in subscription_pending_heartbeats
+            subscription_pending_heartbeats[system_id] = heartbeat
+            if held is True:
+                subscription_stats['coalesced_heartbeats'] += 1
+                return
+            heappush(subscription_pending_heartbeat_heap,
+                     (last_published + api_subscribe_heartbeat_interval, system_id))
+        else:
+            subscription_heartbeat_times[system_id] = time()
+            append_subscription_event(system_id, None, json.dumps(heartbeat))
+            subscription_condition.notify_all()
+    # Wake up the subscription server to send the heartbeat, or to wait for when the held heartbeat is due
+    wake_subscription_server()
+
+
+# Create a function to publish every held heartbeat that is due, and return the number of seconds until the next one is.
+# This returns None if no heartbeats are held
+def publish_pending_heartbeats():
+    with subscription_condition:
+        now = time()
+        published = False
+        while subscription_pending_heartbeat_heap and subscription_pending_heartbeat_heap[0][0] <= now:
+            due, system_id = heappop(subscription_pending_heartbeat_heap)
+            subscription_heartbeat_times[system_id] = now
+            append_subscription_event(system_id, None, json.dumps(subscription_pending_heartbeats.pop(system_id)))
+            published = True
+        if published:
+            subscription_condition.notify_all()
+        return subscription_pending_heartbeat_heap[0][0] - now if subscription_pending_heartbeat_heap else None
+
+
+# Create a function to check whether an event is one that a subscriber asked for, heartbeats are included by asking
+# for the value "heartbeat". system_ids and value_names are sets, or None for every system or value
+def subscription_event_matches(system_ids, value_names, system_id, value_name):
+    if system_ids is not None and system_id not in system_ids:
+        return False
+    return value_names is None or ('heartbeat' if value_name is None else value_name) in value_names
+
+
+# Create a function to fetch the events after a sequence number that a subscriber asked for, this must be called while
+# holding subscription_condition. This returns a list of (sequence, system_id, value_name, event JSON), the sequence
+# number to continue from, and whether any events after the sequence number are no longer kept
+def get_subscription_events(cursor, system_ids, value_names):
+    if cursor > subscription_sequence:
+        # The cursor is from before the server restarted
+        return [], subscription_sequence, True
+    first_sequence = subscription_sequence - len(subscription_events) + 1
+    events = [event for event in islice(subscription_events, max(0, cursor + 1 - first_sequence), None)
+              if subscription_event_matches(system_ids, value_names, event[1], event[2])]
+    return events, subscription_sequence, cursor + 1 < first_sequence
+
+
+# Create a function to format events to be sent to a subscription server connection
+def format_subscription_events(events, missed, cursor):
+    data = ''.join(f'id: {event[0]}\ndata: {event[3]}\n\n' for event in events)
+    # Let the subscriber know that it needs to fetch the current values again
+    if missed is True:
+        data = f'id: {cursor}\nevent: missed\ndata: {{"cursor":{cursor}}}\n\n{data}'
+    return data.encode('utf-8')
+
+
+# Create a function to close a subscription server connection
+def close_subscription_connection(connection):
+    connection['state'] = 'closed'
+    subscription_connections.pop(connection['socket'], None)
+    try:
+        subscription_selector.unregister(connection['socket'])
+    except (KeyError, ValueError):
+        pass
+    connection['socket'].close()
+
+
+# Create a function to send as much of the output of a subscription server connection as the socket will take, and
+# only ask the selector to wait for the socket to be writable while some is left
+def flush_subscription_connection(connection):
+    if connection['output']:
+        try:
+            sent = connection['socket'].send(connection['output'])
+            del connection['output'][:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            close_subscription_connection(connection)
+            return
+    if not connection['output'] and connection['state'] == 'closing':
+        close_subscription_connection(connection)
+        return
+    if len(connection['output']) > api_subscribe_max_output:
+        # The subscriber isn't reading events as fast as they are published
+        subscription_stats['dropped_connections'] += 1
+        close_subscription_connection(connection)
+        return
+    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if connection['output'] else 0)
+    if events != connection['events']:
+        subscription_selector.modify(connection['socket'], events, connection)
+        connection['events'] = events
+
+
+# Create a function to send a plain text error response on a subscription server connection, then close it
+def send_subscription_error(connection, status, message):
+    body = message.encode('utf-8')
+    connection['output'] += (f'HTTP/1.1 {status}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n'
+                             f'Connection: close\r\n\r\n').encode('utf-8') + body
+    connection['state'] = 'closing'
+    flush_subscription_connection(connection)
+
+
+# Create a function to parse the request of a subscription server connection once all of its headers have arrived,
+# then start checking its credentials
+def parse_subscription_request(connection):
+    lines = bytes(connection['input']).split(b'\r\n\r\n', 1)[0].decode('latin-1').split('\r\n')
+    request_line = lines[0].split(' ')
+    if len(request_line) != 3:
+        send_subscription_error(connection, '400 Bad Request', 'Error: invalid request')
+        return
+    url = urlsplit(request_line[1])
+    if url.path != subscription_path:
+        send_subscription_error(connection, '404 Not Found', 'Error: not found')
+        return
+    if request_line[0] != 'GET':
+        send_subscription_error(connection, '405 Method Not Allowed', 'Error: only GET is supported')
+        return
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    args = {name: values[-1] for name, values in parse_qs(url.query).items()}
+    # Credentials are sent with HTTP Basic authentication, so that they aren't written to the access logs of proxies.
+    # They can also be in the query string, as the browser EventSource API can't send headers
+    authorization = headers.get('authorization', '')
+    if authorization[:6].lower() == 'basic ':
+        try:
+            _id, separator, auth = binascii.a2b_base64(authorization[6:]).decode('utf-8').partition(':')
+        except (binascii.Error, UnicodeDecodeError):
+            separator = ''
+        if separator == '':
+            send_subscription_error(connection, '400 Bad Request', 'Error: invalid Authorization header')
+            return
+        args['id'], args['auth'] = _id, auth
+    for arg in ['id', 'auth']:
+        if arg not in args:
+            send_subscription_error(connection, '400 Bad Request', f'Error: missing required argument "{arg}"')
+            return
+    system_ids = parse_list_argument(args.get('system_ids', ''))
+    value_names = parse_list_argument(args.get('values', ''))
+    connection['system_ids'] = None if system_ids is None else set(system_ids)
+    connection['value_names'] = None if value_names is None else set(value_names)
+    # A reconnecting EventSource sends the ID of the last event it received
+    cursor = args.get('cursor', headers.get('last-event-id'))
+    try:
+        connection['cursor'] = None if cursor is None else int(cursor)
+    except ValueError:
+        send_subscription_error(connection, '400 Bad Request', 'Error: "cursor" must be a number')
+        return
+    connection['state'] = 'authenticating'
+
+    def authenticated(future):
+        subscription_authenticated.append((connection, future))
+        wake_subscription_server()
+    subscription_auth_pool.submit(get_access_level, args['id'], args['auth']).add_done_callback(authenticated)
+
+
+# Create a function to start sending events on a subscription server connection once its credentials have been checked
+def start_subscription_stream(connection, future):
+    try:
+        access_level = future.result()
+    except Exception as e:
+        system_log(f'ERROR:000012 Failed to check the credentials of a subscriber: {e}\n')
+        send_subscription_error(connection, '500 Internal Server Error', 'Error: failed to check your credentials')
+        return
+    if access_level_allowed(access_level, ['client', 'admin', 'owner']) is False:
+        send_subscription_error(connection, '401 Unauthorized', 'Error: you do not have the proper credentials')
+        return
+    connection['output'] += (b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                             b'Connection: keep-alive\r\n\r\n')
+    with subscription_condition:
+        if connection['cursor'] is None:
+            connection['cursor'] = subscription_sequence
+        else:
+            events, connection['cursor'], missed = get_subscription_events(
+                connection['cursor'], connection['system_ids'], connection['value_names'])
+            connection['output'] += format_subscription_events(events, missed, connection['cursor'])
+    connection['state'] = 'streaming'
+    flush_subscription_connection(connection)
+
+
+# Create a function to read from a subscription server connection
+def read_subscription_connection(connection):
+    try:
+        data = connection['socket'].recv(4096)
+    except BlockingIOError:
+        return
+    except OSError:
+        data = b''
+    if data == b'':
+        close_subscription_connection(connection)
+        return
+    # Anything sent after the request headers is ignored
+    if connection['state'] != 'reading':
+        return
+    connection['input'] += data
+    if b'\r\n\r\n' in connection['input']:
+        parse_subscription_request(connection)
+    elif len(connection['input']) > 8192:
+        send_subscription_error(connection, '431 Request Header Fields Too Large', 'Error: request headers too large')
+
+
+# Create a function to accept every waiting connection to the subscription server
+def accept_subscription_connections(listener):
+    while True:
+        try:
+            client, address = listener.accept()
+        except OSError:
+            return
+        if len(subscription_connections) >= api_subscribe_max_connections:
+            subscription_stats['rejected_connections'] += 1
+            client.close()
+            continue
+        client.setblocking(False)
+        connection = {'socket': client, 'state': 'reading', 'input': bytearray(), 'output': bytearray(),
+                      'events': selectors.EVENT_READ, 'opened': time(), 'last_write': time(), 'cursor': None,
+                      'system_ids': None, 'value_names': None}
+        subscription_connections[client] = connection
+        subscription_selector.register(client, selectors.EVENT_READ, connection)
+        subscription_stats['accepted_connections'] += 1
+
+
+# Create a function to send every event published since the last call to the streaming connections that asked for it
+def dispatch_subscription_events(dispatched_sequence):
+    with subscription_condition:
+        events, dispatched_sequence, missed = get_subscription_events(dispatched_sequence, None, None)
+    if not events and missed is False:
+        return dispatched_sequence
+    for connection in list(subscription_connections.values()):
+        if connection['state'] != 'streaming':
+            continue
+        # Skip anything the connection already received when it caught up
+        connection_events = [event for event in events if event[0] > connection['cursor'] and
+                             subscription_event_matches(connection['system_ids'], connection['value_names'],
+                                                        event[1], event[2])]
+        connection['cursor'] = dispatched_sequence
+        if connection_events or missed is True:
+            connection['output'] += format_subscription_events(connection_events, missed, dispatched_sequence)
+            connection['last_write'] = time()
+            flush_subscription_connection(connection)
+    return dispatched_sequence
+
+
+# Create a function to send a comment to streaming connections that have been idle for subscribe_keepalive_interval
+# seconds so that dead connections are noticed, and close connections that never finished sending their request
+def check_subscription_connections():
+    now = time()
+    for connection in list(subscription_connections.values()):
+        if connection['state'] == 'reading' and now - connection['opened'] > api_subscribe_keepalive_interval:
+            close_subscription_connection(connection)
+        elif connection['state'] == 'streaming' and now - connection['last_write'] >= api_subscribe_keepalive_interval:
+            connection['output'] += b': keepalive\n\n'
+            connection['last_write'] = now
+            flush_subscription_connection(connection)
+
+
+# Create a function that will run asynchronously to publish held heartbeats and, if subscribe_port is set, serve
+# subscriptions as Server-Sent Events
+def run_subscription_server():
+    subscription_selector.register(subscription_wake_receiver, selectors.EVENT_READ, 'wake')
+    listener = None
+    if api_subscribe_port:
+        try:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((api_subscribe_address, api_subscribe_port))
+            listener.listen(128)
+            listener.setblocking(False)
+            subscription_selector.register(listener, selectors.EVENT_READ, 'listener')
+        except OSError as e:
+            system_log(f'ERROR:000013 Failed to start the subscription server on port {api_subscribe_port}: {e}\n')
+            listener = None
+    with subscription_condition:
+        dispatched_sequence = subscription_sequence
+    last_check = time()
+    while subscription_server_stopping is False:
+        next_heartbeat = publish_pending_heartbeats()
+        timeout = api_subscribe_keepalive_interval if next_heartbeat is None else \
+            min(next_heartbeat, api_subscribe_keepalive_interval)
+        for key, mask in subscription_selector.select(timeout):
+            if key.data == 'wake':
+                try:
+                    while subscription_wake_receiver.recv(4096):
+                        pass
+                except OSError:
+                    pass
+            elif key.data == 'listener':
+                accept_subscription_connections(listener)
+            elif key.data['state'] != 'closed':
+                if mask & selectors.EVENT_READ:
+                    read_subscription_connection(key.data)
+                if mask & selectors.EVENT_WRITE and key.data['state'] != 'closed':
+                    flush_subscription_connection(key.data)
+        while subscription_authenticated:
+            connection, future = subscription_authenticated.popleft()
+            if connection['state'] == 'authenticating':
+                start_subscription_stream(connection, future)
+        dispatched_sequence = dispatch_subscription_events(dispatched_sequence)
+        if time() - last_check >= 1:
+            check_subscription_connections()
+            last_check = time()
+    for connection in list(subscription_connections.values()):
+        close_subscription_connection(connection)
+    if listener is not None:
+        listener.close()
+
+
+# Create a function to stop the subscription server
+def stop_subscription_server():
+    global subscription_server_stopping
+    subscription_server_stopping = True
+    wake_subscription_server()
+    subscription_server_thread.join()
+    subscription_auth_pool.shutdown(wait=False)
+
+# #########################
+# ### END SUBSCRIPTIONS ###
+# #########################
+
+
+# #####################
+# ### BEGIN METRICS ###
+# #####################
+
+# Latency histograms are kept for each metric name and set of labels, they are returned by admin/metrics in the
+# Prometheus text format. Each histogram is a dictionary of the count of observations in each bucket (not cumulative,
+# the last bucket is for observations above every bound), the number of observations and their sum in seconds
+metrics_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+metrics_histograms = {}
+# Create a lock to stop multiple threads from modifying metrics_histograms at the same time
+metrics_lock = Lock()
+# Descriptions of each histogram, for the HELP lines of admin/metrics
+metrics_descriptions = {
+    'http_request_duration_seconds': 'Time taken to handle each request, by endpoint, method and status',
+    'auth_duration_seconds': 'Time taken to check a set of credentials, by whether they were already cached',
+    'password_hash_duration_seconds': 'Time taken to hash a password with PBKDF2 to check it',
+    'sqlite_statement_duration_seconds': 'Time taken to run each SQLite statement, by operation',
+    'historical_write_duration_seconds': 'Time taken to write samples to a historical series, by resolution',
+    'database_writer_lag_seconds': 'Time between a database operation being accepted and committed'
+}
+# In a request worker, histograms are sent to the writer process every metrics_push_interval seconds so that
+# admin/metrics covers every process
+metrics_push_interval = 1
+# Create a Thread object to send histograms to the writer process, this is only started in request workers
+metrics_pusher_thread = None
+
+
+# Create a function to add an observation in seconds to a histogram
+def observe_latency(name, latency, **labels):
+    key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+    with metrics_lock:
+        histogram = metrics_histograms.get(key)
+        if histogram is None:
+            histogram = metrics_histograms[key] = {'buckets': [0] * (len(metrics_buckets) + 1), 'count': 0, 'sum': 0.0}
+        histogram['buckets'][bisect_left(metrics_buckets, latency)] += 1
+        histogram['count'] += 1
+        histogram['sum'] += latency
+
+
+# Create a function to add histograms from another process to metrics_histograms
+@writer_function(wait=False)
+def merge_metric_histograms(histograms):
+    with metrics_lock:
+        for key, other in histograms.items():
+            histogram = metrics_histograms.get(key)
+            if histogram is None:
+                metrics_histograms[key] = other
+                continue
+            histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], other['buckets'])]
+            histogram['count'] += other['count']
+            histogram['sum'] += other['sum']
+
+
+# Create a function to send the histograms of a request worker to the writer process, and start new ones
+def push_metric_histograms():
+    global metrics_histograms
+    with metrics_lock:
+        histograms = metrics_histograms
+        metrics_histograms = {}
+    if histograms:
+        merge_metric_histograms(histograms)
+
+
+# Create a function that will run asynchronously in a request worker to send its histograms to the writer process
+def run_metrics_pusher():
+    while True:
+        sleep(metrics_push_interval)
+        try:
+            push_metric_histograms()
+        except OSError:
+            # The receiver thread reports a lost connection to the writer process
+            break
+
+
+# Create a function to fetch a copy of every histogram along with the statistics returned by admin/stats
+@writer_function()
+def get_metric_samples():
+    with metrics_lock:
+        histograms = copy.deepcopy(metrics_histograms)
+    return histograms, get_server_stats()
+
+
+# Create a function to format a metric name and labels as a Prometheus series
+def format_metric_series(name, labels):
+    if not labels:
+        return name
+    escaped = [(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in labels]
+    return name + '{' + ','.join(f'{label}="{value}"' for label, value in escaped) + '}'
+
+
+# Create a function to build the Prometheus text format returned by admin/metrics. Every number in the statistics
+# returned by admin/stats is included as a gauge named status_server_<group>_<key>
+def format_metrics(histograms, stats):
+    lines = []
+    for group, group_stats in sorted(stats.items()):
+        for key, value in sorted(group_stats.items()):
+            if type(value) not in [int, float]:
+                continue
+            lines.append(f'# TYPE status_server_{group}_{key} gauge')
+            lines.append(f'status_server_{group}_{key} {value}')
+    names = sorted({name for name, labels in histograms})
+    for name in names:
+        lines.append(f'# HELP status_server_{name} {metrics_descriptions.get(name, name)}')
+        lines.append(f'# TYPE status_server_{name} histogram')
+        for (histogram_name, labels), histogram in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(metrics_buckets + ('+Inf',), histogram['buckets']):
+                cumulative += bucket_count
+                series = format_metric_series(f'status_server_{name}_bucket', labels + (('le', str(bound)),))
+                lines.append(f'{series} {cumulative}')
+            lines.append(f'{format_metric_series(f"status_server_{name}_sum", labels)} {histogram["sum"]}')
+            lines.append(f'{format_metric_series(f"status_server_{name}_count", labels)} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+# Record the time each request started at, and profile a random profile_fraction of requests with cProfile
+@app.before_request
+def start_request_metrics():
+    g.request_start = time()
+    g.profiler = None
+    if api_profile_fraction > 0 and random() < api_profile_fraction:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can run at a time on newer versions of Python
+            return
+        g.profiler = profiler
+
+
+# Record how long each request took, and write the profile of the request if it was profiled.
+# Profiles are written to profile_directory as <time in milliseconds>_<process ID>_<endpoint>.prof
+@app.after_request
+def finish_request_metrics(response):
+    if getattr(g, 'profiler', None) is not None:
+        g.profiler.disable()
+        os.makedirs(profile_directory, exist_ok=True)
+        g.profiler.dump_stats(f'{profile_directory}{int(time() * 1000)}_{os.getpid()}_{request.endpoint}.prof')
+    if 'request_start' in g:
+        observe_latency('http_request_duration_seconds', time() - g.request_start,
+                        endpoint=request.endpoint or 'none', method=request.method, status=response.status_code)
+    return response
+
+# ###################
+# ### END METRICS ###
+# ###################
+
+
+# #############################
+# ### BEGIN PREFORK SERVING ###
+# #############################
+
+# The writer process sends every change to system_state, known credentials and subscriptions to each request worker,
+# so that request workers can answer fetches from memory. Each connected request worker has a dictionary containing
+# its connection and a queue of messages waiting to be sent to it
+writer_clients = []
+# Create a ThreadPoolExecutor in the writer process to run the functions that request workers call, this is created
+# when the writer process starts
+writer_request_pool = None
+# In a request worker, create dictionaries of the Futures waiting for replies from the writer process and the Futures
+# returned by queue_database_operation(), both keyed by request ID
+writer_replies = {}
+writer_commit_futures = {}
+# Create a lock to stop request threads and the receiver thread from modifying writer_replies at the same time, and a
+# flag that is set once the connection to the writer process has been lost
+writer_replies_lock = Lock()
+writer_connection_lost = False
+writer_request_ids = count(1)
+# Create a lock to stop multiple request threads from sending to the writer process at the same time
+writer_send_lock = Lock()
+# The number of operations waiting to be written to the database, as of the latest reply from the writer process
+writer_queue_depth = 0
+# Create an Event that is set once a request worker has a copy of system_state from the writer process
+writer_snapshot_loaded = Event()
+
+
+# Create a function to send a change to every request worker. For changes to system_state and subscriptions this must
+# be called while holding the lock that guards them, so that request workers apply changes in the same order
+def replicate_change(change):
+    for client in tuple(writer_clients):
+        client['outgoing'].put(('change', change))
+
+
+# Create a function to apply a change sent by the writer process to this request worker.
+# This runs on the thread that receives from the writer process, so it must never call a writer_function that waits
+def apply_replicated_change(change):
+    global system_state_version, subscription_sequence
+    if change[0] == 'heartbeat':
+        system_id, heartbeat, version = change[1:]
+        with system_state_lock:
+            state = system_state.setdefault(system_id, new_system_state())
+            state['heartbeat'] = heartbeat
+            state['heartbeat_version'] = version
+            system_state_version = max(system_state_version, version)
+        record_system_heartbeat(system_id, float(heartbeat))
+    elif change[0] == 'values':
+        system_id, values, version = change[1:]
+        with system_state_lock:
+            state = system_state.setdefault(system_id, new_system_state())
+            state['values'].update(values)
+            state['versions'].update({value_name: version for value_name in values})
+            system_state_version = max(system_state_version, version)
+    elif change[0] == 'system':
+        system_id, version = change[1:]
+        with system_state_lock:
+            if system_id not in system_state:
+                system_state[system_id] = new_system_state()
+                system_state[system_id]['heartbeat_version'] = version
+            system_state_version = max(system_state_version, version)
+    elif change[0] == 'event':
+        # Events keep the sequence numbers the writer process gave them, so a cursor works with any request worker
+        with subscription_condition:
+            subscription_sequence = change[1]
+            subscription_events.append(change[1:])
+            subscription_condition.notify_all()
+    elif change[0] == 'invalidate_credentials':
+        invalidate_cached_credentials(change[1])
+    elif change[0] == 'snapshot':
+        state, version, events, sequence = change[1:]
+        with system_state_lock:
+            system_state.clear()
+            system_state.update(state)
+            system_state_version = version
+        with subscription_condition:
+            subscription_events.clear()
+            subscription_events.extend(events)
+            subscription_sequence = sequence
+        writer_snapshot_loaded.set()
+
+
+# Create a function to call a writer_function in the writer process from a request worker, and return its result.
+# If the function returns a Future then a Future that is completed at the same time is returned
+def call_writer_function(name, args, kwargs, wait):
+    if writer_connection_lost is True:
+        raise ConnectionError('Lost the connection to the writer process')
+    if wait is False:
+        with writer_send_lock:
+            writer_connection.send((None, name, args, kwargs))
+        return None
+    request_id = next(writer_request_ids)
+    reply = Future()
+    with writer_replies_lock:
+        # Check again now that we hold the lock, in case the receiver thread failed every reply since the check above
+        if writer_connection_lost is True:
+            raise ConnectionError('Lost the connection to the writer process')
+        writer_replies[request_id] = reply
+    try:
+        with writer_send_lock:
+            writer_connection.send((request_id, name, args, kwargs))
+        return reply.result(timeout=api_database_write_timeout)
+    except FutureTimeoutError:
+        raise TimeoutError(f'The writer process did not reply to {name} within {api_database_write_timeout} seconds')
+    finally:
+        with writer_replies_lock:
+            writer_replies.pop(request_id, None)
+
+
+# Create a function that will run asynchronously in a request worker to receive replies and changes from the writer
+# process. Messages are handled in the order they were sent, so a change is always applied before the reply to the
+# call that made it
+def run_writer_receiver():
+    global writer_queue_depth, writer_connection_lost
+    try:
+        while True:
+            try:
+                message = writer_connection.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'change':
+                apply_replicated_change(message[1])
+            elif message[0] == 'reply':
+                request_id, result, error, writer_queue_depth = message[1:]
+                with writer_replies_lock:
+                    reply = writer_replies.pop(request_id, None)
+                # The request thread may have already given up waiting for the reply
+                if reply is None:
+                    continue
+                if error is not None:
+                    reply.set_exception(error)
+                else:
+                    reply.set_result(result)
+            elif message[0] == 'future':
+                request_id, writer_queue_depth = message[1:]
+                with writer_replies_lock:
+                    writer_commit_futures[request_id] = Future()
+                    reply = writer_replies.pop(request_id, None)
+                if reply is not None:
+                    reply.set_result(writer_commit_futures[request_id])
+            elif message[0] == 'done':
+                request_id, error = message[1:]
+                with writer_replies_lock:
+                    future = writer_commit_futures.pop(request_id)
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(True)
+    finally:
+        # The system log is written by the writer process, so report this on stderr instead
+        print('ERROR:000015 Lost the connection to the writer process, restart this worker once it is running again',
+              file=sys.stderr)
+        # Fail every call that is still waiting, and stop any more from being sent
+        with writer_replies_lock:
+            writer_connection_lost = True
+            futures = list(writer_replies.values()) + list(writer_commit_futures.values())
+            writer_replies.clear()
+            writer_commit_futures.clear()
+        for future in futures:
+            future.set_exception(ConnectionError('Lost the connection to the writer process'))
+
+
+# Create a function to connect a request worker to the writer process and wait for its copy of system_state
+def connect_to_writer():
+    global writer_connection
+    deadline = time() + api_writer_connect_timeout
+    while True:
+        try:
+            connection = Client(writer_address, authkey=api_writer_authkey and api_writer_authkey.encode('utf-8'))
+            break
+        except OSError:
+            # The writer process may still be starting
+            if time() > deadline:
+                raise
+            sleep(0.1)
+    writer_connection = connection
+    Thread(target=run_writer_receiver, name='writer_receiver', daemon=True).start()
+    if writer_snapshot_loaded.wait(api_writer_connect_timeout) is False:
+        raise TimeoutError('The writer process did not send a copy of system_state')
+
+
+# Create a function to run a writer_function that a request worker called, and send the result back to it
+def handle_writer_request(client, request_id, name, args, kwargs):
+    try:
+        result, error = writer_functions[name](*args, **kwargs), None
+    except Exception as e:
+        result = None
+        # Only send exceptions that the request worker is sure to be able to unpickle
+        error = e if type(e) in [ValueError, TypeError, KeyError, OSError, sqlite3.IntegrityError] else \
+            RuntimeError(f'{type(e).__name__}: {e}')
+    if request_id is None:
+        if error is not None:
+            system_log(f'ERROR:000016 Failed to run {name} for a request worker: {error}\n')
+        return
+    if isinstance(result, Future):
+        client['outgoing'].put(('future', request_id, get_database_queue_depth()))
+
+        def done(future):
+            error = future.exception()
+            if error is not None and type(error) not in [ValueError, TypeError, sqlite3.IntegrityError]:
+                error = RuntimeError(f'{type(error).__name__}: {error}')
+            client['outgoing'].put(('done', request_id, error))
+        result.add_done_callback(done)
+    else:
+        client['outgoing'].put(('reply', request_id, result, error, get_database_queue_depth()))
+
+
+# Create a function that will run asynchronously in the writer process to send messages to a request worker
+def run_writer_client_sender(client):
+    while True:
+        message = client['outgoing'].get()
+        if message is None:
+            break
+        try:
+            client['connection'].send(message)
+        except OSError:
+            break
+    client['connection'].close()
+
+
+# Create a function that will run asynchronously in the writer process to receive calls from a request worker.
+# Calls that a request worker doesn't wait for are run straight away so that they stay in order, the rest are run in
+# writer_request_pool so that one request worker can have many calls waiting on the database journal at once
+def run_writer_client_receiver(client):
+    while True:
+        try:
+            request_id, name, args, kwargs = client['connection'].recv()
+        except (EOFError, OSError):
+            break
+        if request_id is None:
+            handle_writer_request(client, request_id, name, args, kwargs)
+        else:
+            writer_request_pool.submit(handle_writer_request, client, request_id, name, args, kwargs)
+    writer_clients.remove(client)
+    client['outgoing'].put(None)
+
+
+# Create a function to start serving a request worker that has connected to the writer process
+def add_writer_client(connection):
+    client = {'connection': connection, 'outgoing': Queue()}
+    # Take the copy of system_state and add the client while nothing can change, so no change is missed or sent twice
+    with system_state_lock, subscription_condition:
+        snapshot = {system_id: copy.deepcopy(state) for system_id, state in system_state.items()}
+        client['outgoing'].put(('change', ('snapshot', snapshot, system_state_version, list(subscription_events),
+                                           subscription_sequence)))
+        writer_clients.append(client)
+    Thread(target=run_writer_client_sender, args=(client,), name='writer_client_sender', daemon=True).start()
+    Thread(target=run_writer_client_receiver, args=(client,), name='writer_client_receiver', daemon=True).start()
+
+
+# Create a function to make sure that another writer process isn't already listening on writer_address, and remove
+# the socket file left behind if the last writer process didn't stop cleanly
+def check_writer_address():
+    try:
+        Client(writer_address, authkey=api_writer_authkey and api_writer_authkey.encode('utf-8')).close()
+    except OSError:
+        if type(writer_address) == str and os.path.exists(writer_address):
+            os.remove(writer_address)
+        return
+    print(f'ERROR:000017 A writer process is already listening on {writer_address}', file=sys.stderr)
+    sys.exit(1)
+
+
+# Create a function to run the writer process, which accepts connections from request workers until it is stopped
+def run_writer_process():
+    global writer_request_pool
+    writer_request_pool = ThreadPoolExecutor(max_workers=api_writer_threads, thread_name_prefix='writer_request')
+    # Create the Unix socket with permissions 0600 from the start, so that other users can never connect to it
+    old_umask = os.umask(0o177)
+    try:
+        listener = Listener(writer_address, authkey=api_writer_authkey and api_writer_authkey.encode('utf-8'))
+    finally:
+        os.umask(old_umask)
+    with listener:
+        system_log(f'Writer process listening on {writer_address}\n')
+        try:
+            while True:
+                try:
+                    add_writer_client(listener.accept())
+                except (OSError, EOFError, AuthenticationError) as e:
+                    # A request worker that fails to authenticate shouldn't stop the writer process
+                    system_log(f'WARN: Failed to accept a request worker: {e}\n')
+        except KeyboardInterrupt:
+            pass
+
+# ###########################
+# ### END PREFORK SERVING ###
+# ###########################
+
+
 # #############################
 # ### BEGIN ADMIN ENDPOINTS ###
 # #############################
 
+# Create a function to check whether a set of credentials is allowed to create credentials with an access level.
+# This returns None if they are, otherwise it returns the error response to send
+def check_new_auth_access(_id, _auth, _access_level):
+    # Owner credentials can only be created by manually editing the database
+    if _access_level not in ['system', 'client', 'admin']:
+        return 'Error: invalid "access_level" value', 400
+    # Only owners can create admin credentials, admins and owners can create system and client credentials
+    if _access_level == 'admin':
+        allowed_access_levels = ['owner']
+    else:
+        allowed_access_levels = ['admin', 'owner']
+    if access_level_allowed(get_access_level(_id, _auth), allowed_access_levels) is False:
+        return 'Error: you do not have the proper credentials', 401
+    return None
+
+
 @app.route(f'{api_base_url}{api_admin_prefix}new_auth', methods=['POST', 'GET'])
 @check_args(required_args=['id', 'auth', 'access_level'])
 def api_admin_new_auth():
@@ -356,23 +3206,115 @@ def api_admin_new_auth():
     _id = request.values['id']
     _auth = request.values['auth']
     _access_level = request.values['access_level']
-    if _access_level == 'admin':
-        if auth(_id, _auth, access_level='owner') is False:
-            return 'Error: you do not have the proper credentials', 401
-    else:
-        if auth(_id, _auth, access_level='admin') is False and auth(_id, _auth, access_level='owner') is False:
-            return 'Error: you do not have the proper credentials', 401
+    error = check_new_auth_access(_id, _auth, _access_level)
+    if error is not None:
+        return error
     new_id, new_auth, hashed_new_auth = generate_new_auth()
-    database_operations_queue.put(['new_row', 'auth', (new_id, hashed_new_auth, _access_level,)])
+    pending_writes = [queue_database_operation(['new_row', 'auth', (new_id, hashed_new_auth, _access_level,)])]
     if _access_level == 'system':
-        database_operations_queue.put(['new_row', 'systems_stats', (new_id, '', None, '{}')])
+        add_system_state(new_id)
+        pending_writes.append(queue_database_operation(['new_row', 'systems_stats', (new_id, '', None, '{}')]))
     if os.path.exists(f'{historical_directory}{new_id}/') is False:
         os.makedirs(f'{historical_directory}{new_id}/')
-    sleep(5)
-    trash, response = api_check_auth(_id=new_id, _auth=new_auth)
-    if response == 200:
-        return jsonify({'id': new_id, 'auth': new_auth}), 200
-    return 'Error', 500
+    # Wait until the new credentials have been committed to the database before returning them
+    try:
+        for pending_write in pending_writes:
+            pending_write.result(timeout=api_database_write_timeout)
+    except FutureTimeoutError:
+        system_log(f'ERROR:000007 Timed out waiting for new credentials {new_id} to be written to the database\n')
+        return 'Error: timed out waiting for the database', 500
+    except (sqlite3.Error, TypeError, ValueError):
+        return 'Error', 500
+    return jsonify({'id': new_id, 'auth': new_auth}), 200
+
+
+@app.route(f'{api_base_url}{api_admin_prefix}new_auth_bulk', methods=['POST', 'GET'])
+@check_args(required_args=['id', 'auth', 'access_level', 'count'])
+def api_admin_new_auth_bulk():
+    _id = request.values['id']
+    _auth = request.values['auth']
+    _access_level = request.values['access_level']
+    error = check_new_auth_access(_id, _auth, _access_level)
+    if error is not None:
+        return error
+    try:
+        _count = int(request.values['count'])
+    except ValueError:
+        return 'Error: invalid "count" value', 400
+    if _count < 1 or _count > api_bulk_new_auth_limit:
+        return f'Error: "count" must be between 1 and {api_bulk_new_auth_limit}', 400
+    new_credentials = [generate_new_credentials() for i in range(0, _count)]
+    # Hash the passwords in parallel, as each hash takes around a tenth of a second
+    hashed_new_auths = hash_passwords([new_auth for new_id, new_auth in new_credentials])
+    # Insert every row in a single transaction, so that either all of the credentials are created or none are
+    new_rows = []
+    for (new_id, new_auth), hashed_new_auth in zip(new_credentials, hashed_new_auths):
+        new_rows.append(['new_row', 'auth', (new_id, hashed_new_auth, _access_level,)])
+        if _access_level == 'system':
+            new_rows.append(['new_row', 'systems_stats', (new_id, '', None, '{}')])
+    pending_write = queue_database_operation(['transaction', new_rows])
+    for new_id, new_auth in new_credentials:
+        if _access_level == 'system':
+            add_system_state(new_id)
+        os.makedirs(f'{historical_directory}{new_id}/', exist_ok=True)
+    # Wait until the new credentials have been committed to the database before returning them
+    try:
+        pending_write.result(timeout=api_database_write_timeout)
+    except FutureTimeoutError:
+        system_log(f'ERROR:000007 Timed out waiting for {_count} new credentials to be written to the database\n')
+        return 'Error: timed out waiting for the database', 500
+    except (sqlite3.Error, TypeError, ValueError):
+        return 'Error', 500
+
+    # Stream the credentials back as a JSON list, rather than building the whole response in memory
+    def generate_response():
+        yield '['
+        for i, (new_id, new_auth) in enumerate(new_credentials):
+            yield f'{"," if i > 0 else ""}{json.dumps({"id": new_id, "auth": new_auth})}'
+        yield ']'
+    return Response(generate_response(), mimetype='application/json'), 200
+
+
+# Create a function to collect the statistics that are returned by admin/stats. In prefork mode these come from the
+# writer process, since that is where the database, logs, historical data and subscriptions are written
+@writer_function()
+def get_server_stats():
+    _writer_stats = dict(database_writer_stats)
+    _writer_stats['queue_depth'] = database_operations_queue.qsize()
+    _writer_stats['request_workers'] = len(writer_clients)
+    _log_stats = dict(log_stats)
+    _log_stats['queue_depth'] = log_queue.qsize()
+    _log_stats['open_files'] = len(log_files)
+    with heartbeat_monitor_lock:
+        _heartbeat_stats = {'tracked_systems': len(heartbeat_deadlines), 'down_systems': len(down_systems),
+                            'deadline_heap_size': len(heartbeat_deadline_heap)}
+    _subscription_stats = dict(subscription_stats)
+    _subscription_stats['open_connections'] = len(subscription_connections)
+    with rate_limit_lock:
+        _rate_limit_stats = {f'rejected_{endpoint_class}': rejected
+                             for endpoint_class, rejected in rate_limit_stats.items()}
+        _rate_limit_stats['buckets'] = len(rate_limit_buckets)
+    return {'database_writer': _writer_stats, 'historical': dict(historical_stats), 'logs': _log_stats,
+            'heartbeat_monitor': _heartbeat_stats, 'subscriptions': _subscription_stats,
+            'rate_limits': _rate_limit_stats}
+
+
+@app.route(f'{api_base_url}{api_admin_prefix}stats', methods=['POST', 'GET'])
+@check_args(required_args=['id', 'auth'])
+@check_auth(access_level=['admin', 'owner'])
+def api_admin_stats():
+    return jsonify(get_server_stats()), 200
+
+
+@app.route(f'{api_base_url}{api_admin_prefix}metrics', methods=['POST', 'GET'])
+@check_args(required_args=['id', 'auth'])
+@check_auth(access_level=['admin', 'owner'])
+def api_admin_metrics():
+    # Send this request worker's histograms first, so that they are included
+    if writer_connection is not None:
+        push_metric_histograms()
+    histograms, stats = get_metric_samples()
+    return Response(format_metrics(histograms, stats), mimetype='text/plain; version=0.0.4'), 200
 
 # ###########################
 # ### END ADMIN ENDPOINTS ###
@@ -408,29 +3350,55 @@ def api_check_auth(_id=None, _auth=None):
 
 @app.route(f'{api_base_url}{api_value_update_prefix}heartbeat', methods=['POST', 'GET'])
 @check_args(required_args=['id', 'auth'])
+@check_rate_limit('heartbeat')
 @check_auth(access_level='system')
+@check_database_queue
 def api_update_heartbeat():
     _id = request.values['id']
     now = time()
-    database_operations_queue.put(['update_row', 'systems_stats', str(_id), 'heartbeat', str(now)])
+    set_system_heartbeat(str(_id), str(now))
     api_historical(_id, 'heartbeat', now)
     return '', 200
 
 
 @app.route(f'{api_base_url}{api_value_update_prefix}logging', methods=['POST'])
 @check_args(required_args=['id', 'auth', 'data'])
+@check_rate_limit('logging')
 @check_auth(access_level='system')
 def api_update_logging():
     _id = request.values['id']
     _data = request.values['data']
-    with open(f"{log_directory}{str(_id)}.txt", 'a') as log_file:
-        log_file.write(f'{time()}: {str(_data)}\n\n\n')
+    if write_log(str(_id), _data) is False:
+        return 'Error: too many log entries are waiting to be written, please try again later', 503, \
+            {'Retry-After': '1'}
+    return '', 200
+
+
+@app.route(f'{api_base_url}{api_value_update_prefix}logging_batch', methods=['POST'])
+@check_args(required_args=['id', 'auth', 'data'])
+@check_rate_limit('logging')
+@check_auth(access_level='system')
+def api_update_logging_batch():
+    _id = request.values['id']
+    try:
+        _data = json.loads(request.values['data'])
+    except ValueError:
+        return 'Error: invalid "data" value', 400
+    if type(_data) != list or any(type(_entry) != str for _entry in _data):
+        return 'Error: "data" must be a JSON list of strings', 400
+    if len(_data) > api_log_batch_max_entries:
+        return f'Error: at most {api_log_batch_max_entries} log entries can be sent at once', 400
+    if _data and write_logs(str(_id), _data) is False:
+        return 'Error: too many log entries are waiting to be written, please try again later', 503, \
+            {'Retry-After': '1'}
     return '', 200
 
 
 @app.route(f'{api_base_url}{api_value_update_prefix}main', methods=['POST'])
 @check_args(required_args=['id', 'auth', 'value', 'data'])
+@check_rate_limit('values')
 @check_auth(access_level='system')
+@check_database_queue
 def api_update_main():
     _id = request.values['id']
     _value = request.values['value']
@@ -438,8 +3406,46 @@ def api_update_main():
         _data = json.loads(request.values['data'])
     except:
         return 'Error: invalid "data" value', 500
-    database_operations_queue.put(['update_system_value', str(_id), str(_value), json.dumps(_data)])
-    api_historical(_id, _value, _data)
+    _patch = request.values.get('patch')
+    if _patch is None:
+        _json_data = json.dumps(_data)
+        set_system_value(str(_id), str(_value), _json_data)
+        _historical_data = _data
+    elif _patch in ['merge', 'json']:
+        # data is a patch of the stored value rather than the new value
+        try:
+            _json_data, _historical_data = patch_system_value(str(_id), str(_value), _patch, _data)
+        except ValueError as e:
+            return f'Error: failed to apply the patch, {e}', 400
+        if api_historical_store_patches is True:
+            _historical_data = {'patch': _patch, 'data': _data}
+    else:
+        return 'Error: "patch" must be "merge" or "json"', 400
+    api_historical(_id, _value, _historical_data)
+    return '', 200
+
+
+@app.route(f'{api_base_url}{api_value_update_prefix}batch', methods=['POST'])
+@check_args(required_args=['id', 'auth', 'data'])
+@check_rate_limit('values', heartbeat_argument=True)
+@check_auth(access_level='system')
+@check_database_queue
+def api_update_batch():
+    _id = request.values['id']
+    try:
+        _data = json.loads(request.values['data'])
+    except ValueError:
+        return 'Error: invalid "data" value', 400
+    if type(_data) != dict:
+        return 'Error: "data" must be a JSON object of value names to data', 400
+    if _data:
+        _values = {str(_value): json.dumps(_value_data) for _value, _value_data in _data.items()}
+        set_system_values(str(_id), _values)
+        api_historical_batch(_id, _data)
+    if request.values.get('heartbeat', 'false').lower() in ['1', 'true', 'yes']:
+        now = time()
+        set_system_heartbeat(str(_id), str(now))
+        api_historical(_id, 'heartbeat', now)
     return '', 200
 
 
@@ -454,28 +3460,20 @@ def api_update_main():
 
 @app.route(f'{api_base_url}{api_value_fetch_prefix}main', methods=['GET', 'POST'])
 @check_args(required_args=['id', 'auth', 'system_id', 'value'])
-@check_auth(access_level='client')
+@check_auth(access_level=['client', 'admin', 'owner'])
 def api_fetch_main():
-    _id = request.values['id']
-    _auth = request.values['auth']
-    if auth(_id, _auth, access_level='client') is False and \
-            auth(_id, _auth, access_level='admin') is False and \
-            auth(_id, _auth, access_level='owner') is False:
-        return 'Error: you do not have the proper credentials', 401
     _value = request.values['value']
     _system_id = request.values['system_id']
-    with closing(sqlite3.connect(database_path)) as _db, closing(_db.cursor()) as _cur:
-        if (str(_system_id),) not in _cur.execute('SELECT id FROM auth').fetchall():
-            return 'Error: that system ID does not exist', 400
-    with closing(sqlite3.connect(database_path)) as _db, closing(_db.cursor()) as _cur:
-        _temp = json.loads(_cur.execute(
-            'SELECT system_data FROM systems_stats WHERE id = ?',
-            (_system_id,)
-        ).fetchone()[0])
-    try:
-        return jsonify(_temp[_value])
-    except KeyError:
+    if id_exists(_system_id) is False:
+        return 'Error: that system ID does not exist', 400
+    _temp, _version = get_system_value(_system_id, _value)
+    if _temp is None:
         return 'Error: that value name does not exist yet for that system', 400
+    # The version of the value is its ETag, so a client that already has this version doesn't need it sent again
+    _etag = str(_version)
+    if request.if_none_match.contains(_etag):
+        return '', 304, {'ETag': f'"{_etag}"'}
+    return app.response_class(_temp, mimetype='application/json', headers={'ETag': f'"{_etag}"'})
 
 
 @app.route(f'{api_base_url}{api_value_fetch_prefix}heartbeat', methods=['GET', 'POST'])
@@ -484,13 +3482,169 @@ def api_fetch_main():
 def api_fetch_heartbeat():
     _id = request.values['id']
     _system_id = request.values['system_id']
-    with closing(sqlite3.connect(database_path)) as _db, closing(_db.cursor()) as _cur:
-        if (str(_system_id),) not in _cur.execute('SELECT id FROM auth').fetchall():
-            return 'Error: that system ID does not exist', 400
-    with closing(sqlite3.connect(database_path)) as _db, closing(_db.cursor()) as _cur:
-        _temp = _cur.execute('SELECT heartbeat FROM systems_stats WHERE id = ?', (_system_id,)).fetchone()[0]
+    if id_exists(_system_id) is False:
+        return 'Error: that system ID does not exist', 400
+    _temp = get_system_heartbeat(_system_id)
+    if _temp is None:
+        return 'Error: that system has not sent a heartbeat yet', 400
     return _temp
 
+
+@app.route(f'{api_base_url}{api_value_fetch_prefix}down_systems', methods=['GET', 'POST'])
+@check_args(required_args=['id', 'auth'])
+@check_auth(access_level=['client', 'admin', 'owner'])
+def api_fetch_down_systems():
+    if api_heartbeat_timeout <= 0:
+        return 'Error: heartbeat monitoring is disabled', 400
+    try:
+        _since = float(request.values['since']) if 'since' in request.values else None
+    except ValueError:
+        return 'Error: "since" must be a number', 400
+    systems, transitions = get_down_systems(_since)
+    return jsonify({'timeout': api_heartbeat_timeout,
+                    'down': [{'system_id': system_id, 'since': since, 'last_heartbeat': since - api_heartbeat_timeout}
+                             for system_id, since in systems],
+                    'transitions': transitions}), 200
+
+
+@app.route(f'{api_base_url}{api_value_fetch_prefix}subscribe', methods=['GET', 'POST'])
+@check_args(required_args=['id', 'auth'])
+@check_auth(access_level=['client', 'admin', 'owner'])
+def api_fetch_subscribe():
+    global subscription_waiters
+    _system_ids = list_argument('system_ids')
+    _values = list_argument('values')
+    _system_ids = None if _system_ids is None else set(_system_ids)
+    _values = None if _values is None else set(_values)
+    try:
+        _cursor = int(request.values['cursor']) if 'cursor' in request.values else None
+        _timeout = float(request.values.get('timeout', api_subscribe_poll_timeout))
+    except ValueError:
+        return 'Error: "cursor" and "timeout" must be numbers', 400
+    _timeout = min(max(_timeout, 0), api_subscribe_poll_timeout)
+    with subscription_condition:
+        # Without a cursor just return the current one, so that the next request waits for anything after it
+        if _cursor is None:
+            events, _cursor, missed = [], subscription_sequence, False
+        else:
+            deadline = time() + _timeout
+            events, new_cursor, missed = get_subscription_events(_cursor, _system_ids, _values)
+            if not events and missed is False and _timeout > 0:
+                if subscription_waiters >= api_subscribe_max_waiters:
+                    count_rejected_subscription_poll()
+                    return 'Error: too many subscribers are waiting, please try again later', 503, \
+                        {'Retry-After': '1'}
+                subscription_waiters += 1
+                try:
+                    # Wait until there is an event that was asked for, or the timeout has passed
+                    while not events and missed is False and deadline - time() > 0:
+                        subscription_condition.wait(deadline - time())
+                        events, new_cursor, missed = get_subscription_events(_cursor, _system_ids, _values)
+                finally:
+                    subscription_waiters -= 1
+            _cursor = new_cursor
+    return app.response_class(
+        f'{{"cursor":{_cursor},"missed":{json.dumps(missed)},"events":[{",".join(event[3] for event in events)}]}}',
+        mimetype='application/json')
+
+
+@app.route(f'{api_base_url}{api_value_fetch_prefix}bulk', methods=['GET', 'POST'])
+@check_args(required_args=['id', 'auth'])
+@check_auth(access_level=['client', 'admin', 'owner'])
+def api_fetch_bulk():
+    _system_ids = list_argument('system_ids')
+    _values = list_argument('values')
+    try:
+        _since_version = int(request.values['since_version']) if 'since_version' in request.values else None
+    except ValueError:
+        return 'Error: "since_version" must be a number', 400
+    # If no system IDs were supplied then return every system
+    if _system_ids is None or _system_ids == ['all']:
+        _system_ids = get_system_ids()
+    # Nothing can have changed if the latest version is the one the client already has. The version is fetched before
+    # any system is read, so a change made while the response is being sent is always included in the next one
+    _version = str(get_system_state_version())
+    if request.if_none_match.contains(_version):
+        return '', 304, {'ETag': f'"{_version}"', 'X-Version': _version}
+
+    # Stream the response one system at a time, so large fleets don't need the whole document to be built in memory.
+    # Values are already stored as JSON strings so they are copied into the response as they are
+    def generate_response():
+        yield '{'
+        first = True
+        for _system_id in _system_ids:
+            snapshot = get_system_snapshot(_system_id, _values, _since_version)
+            if _since_version is not None:
+                # Only include systems that have changed
+                if snapshot is None or (not snapshot['values'] and 'heartbeat' not in snapshot):
+                    continue
+            yield f'{"" if first else ","}{json.dumps(_system_id)}:'
+            first = False
+            if snapshot is None:
+                yield 'null'
+                continue
+            values = ','.join(f'{json.dumps(value_name)}:{data}' for value_name, data in snapshot['values'].items())
+            heartbeat = f'"heartbeat":{json.dumps(snapshot["heartbeat"])},' if 'heartbeat' in snapshot else ''
+            yield f'{{{heartbeat}"values":{{{values}}}}}'
+        yield '}'
+    return Response(generate_response(), mimetype='application/json',
+                    headers={'ETag': f'"{_version}"', 'X-Version': _version}), 200
+
+
+@app.route(f'{api_base_url}{api_value_fetch_prefix}history', methods=['GET', 'POST'])
+@check_args(required_args=['id', 'auth', 'system_id', 'value'])
+@check_auth(access_level=['client', 'admin', 'owner'])
+def api_fetch_history():
+    _system_id = request.values['system_id']
+    _value = request.values['value']
+    if id_exists(_system_id) is False:
+        return 'Error: that system ID does not exist', 400
+    try:
+        _end = float(request.values.get('end', time()))
+        _start = float(request.values.get('start', _end - 86400))
+        _bucket = float(request.values['bucket']) if 'bucket' in request.values else None
+    except ValueError:
+        return 'Error: "start", "end" and "bucket" must be numbers', 400
+    if not all(math.isfinite(_number) for _number in [_start, _end, _bucket] if _number is not None):
+        return 'Error: "start", "end" and "bucket" must be finite numbers', 400
+    if _bucket is not None and _bucket <= 0:
+        return 'Error: "bucket" must be greater than 0', 400
+    if _end <= _start:
+        return 'Error: "end" must be after "start"', 400
+    # If no bucket size was supplied then pick one that keeps the response under the maximum number of buckets,
+    # rounded up to a multiple of the coarsest rollup resolution that fits so that the rollups can be used
+    if _bucket is None:
+        _bucket = max(math.ceil((_end - _start) / api_history_max_buckets), 1)
+        for resolution in reversed(historical_rollup_resolutions):
+            if _bucket >= resolution:
+                _bucket = math.ceil(_bucket / resolution) * resolution
+                break
+    elif (_end - _start) / _bucket > api_history_max_buckets:
+        return f'Error: "bucket" must be large enough to give at most {api_history_max_buckets} buckets', 400
+    buckets = query_historical_buckets(_system_id, _value, _start, _end, _bucket)
+    return jsonify({'start': _start, 'end': _end, 'bucket': _bucket,
+                    'buckets': format_historical_buckets(buckets)}), 200
+
+
+@app.route(f'{api_base_url}{api_value_fetch_prefix}logs', methods=['GET', 'POST'])
+@check_args(required_args=['id', 'auth', 'system_id'])
+@check_auth(access_level=['client', 'admin', 'owner'])
+def api_fetch_logs():
+    _system_id = request.values['system_id']
+    if id_exists(_system_id) is False:
+        return 'Error: that system ID does not exist', 400
+    try:
+        _start = float(request.values['start']) if 'start' in request.values else None
+        _end = float(request.values['end']) if 'end' in request.values else None
+        _tail = int(request.values['tail']) if 'tail' in request.values else None
+    except ValueError:
+        return 'Error: "start", "end" and "tail" must be numbers', 400
+    if _tail is not None and (_tail < 1 or _tail > api_log_fetch_max_entries):
+        return f'Error: "tail" must be between 1 and {api_log_fetch_max_entries}', 400
+    _search = request.values.get('search') or None
+    entries = search_log(str(_system_id), _start, _end, _search, _tail)
+    return jsonify([{'time': timestamp, 'data': data} for timestamp, data in entries]), 200
+
 # ############################
 # ### END CLIENT ENDPOINTS ###
 # ############################
@@ -500,18 +3654,103 @@ def api_fetch_heartbeat():
 # ### BEGIN GENERAL STARTUP ###
 # #############################
 
+# Work out whether this process writes to the database itself, or is a request worker that sends every write to a
+# separate writer process. In prefork mode the writer process is started with "python main.py writer"
+if api_server_mode == 'prefork' and not (__name__ == '__main__' and sys.argv[1:2] == ['writer']):
+    server_role = 'worker'
+else:
+    server_role = 'writer'
+
 # Create a queue to store write operations for the database in
 database_operations_queue = Queue(maxsize=0)
 
-# Create a Timer object to enable the function run_queue() to run asynchronously to the main program
-t = Timer(0, run_queue)
+# A request worker gets its copy of system_state from the writer process, and has no database or log threads of its
+# own, but keeps its own heartbeat deadlines so that it can answer fetch/down_systems
+if server_role == 'worker':
+    connect_to_writer()
+    load_known_ids()
+    load_heartbeat_deadlines()
+    heartbeat_monitor_thread = Thread(target=run_heartbeat_monitor, name='heartbeat_monitor', daemon=True)
+    if api_heartbeat_timeout > 0:
+        heartbeat_monitor_thread.start()
+        atexit.register(stop_heartbeat_monitor)
+    # Send this request worker's latency histograms to the writer process, so that admin/metrics covers every process
+    metrics_pusher_thread = Thread(target=run_metrics_pusher, name='metrics_pusher', daemon=True)
+    metrics_pusher_thread.start()
+
+elif server_role == 'writer':
+    # Make sure that no other writer process is using the database before touching it
+    if api_server_mode == 'prefork':
+        check_writer_address()
+
+    # Create a Thread object to write log entries asynchronously to the main program
+    log_writer_thread = Thread(target=run_log_writer, name='log_writer', daemon=True)
+
+    # Start the Thread object, and make sure that every queued entry is written before the program exits
+    log_writer_thread.start()
+    atexit.register(stop_log_writer)
+
+    # Add any missing tables to the database and move stored values into the configured layout
+    create_database_tables()
+    migrate_value_storage()
+
+    # Commit any operations that were accepted but not written before the server last stopped
+    if api_database_journal is True:
+        replay_database_journal()
+
+    # Load the latest heartbeat and values of every system into memory
+    load_system_state()
+
+    # Load every ID into memory so that existence checks don't need to scan the auth table
+    load_known_ids()
+
+    # Give every system that has sent a heartbeat a deadline, then start a Thread object to mark systems as down when
+    # their deadline passes
+    load_heartbeat_deadlines()
+    heartbeat_monitor_thread = Thread(target=run_heartbeat_monitor, name='heartbeat_monitor', daemon=True)
+    if api_heartbeat_timeout > 0:
+        heartbeat_monitor_thread.start()
+        atexit.register(stop_heartbeat_monitor)
+
+    # Create a Thread object to enable the function run_queue() to run asynchronously to the main program
+    database_writer_thread = Thread(target=run_queue, name='database_writer', daemon=True)
+
+    # Start the Thread object
+    database_writer_thread.start()
+
+    # Make sure that every queued operation is written before the program exits
+    atexit.register(stop_queue)
+
+    # Create a Thread object to flush historical data to disk asynchronously to the main program
+    historical_flusher_stopping = False
+    historical_flusher_thread = Thread(target=run_historical_flusher, name='historical_flusher', daemon=True)
+
+    # Start the Thread object, and make sure that every buffered sample is written before the program exits
+    historical_flusher_thread.start()
+    atexit.register(stop_historical_flusher)
+
+    # Create a Thread object to roll up and remove old historical data asynchronously to the main program
+    historical_compactor_thread = Thread(target=run_historical_compactor, name='historical_compactor', daemon=True)
+
+    # Start the Thread object if historical data is enabled
+    if api_enable_historical is True:
+        historical_compactor_thread.start()
+        atexit.register(stop_historical_compactor)
 
-# Start the Timer object
-t.start()
+    # Create a Thread object to publish held heartbeats and serve subscriptions asynchronously to the main program
+    subscription_server_thread = Thread(target=run_subscription_server, name='subscription_server', daemon=True)
 
-# If the script has being executed with no special arguments using "python main.py", start the Flask server
+    # Start the Thread object
+    subscription_server_thread.start()
+    atexit.register(stop_subscription_server)
+
+# If the script has being executed with no special arguments using "python main.py", start the Flask server. In
+# prefork mode "python main.py writer" runs the writer process instead
 if __name__ == '__main__':
-    app.run(api_config['flask_address'], api_config['flask_port'])
+    if server_role == 'writer' and api_server_mode == 'prefork':
+        run_writer_process()
+    else:
+        app.run(api_config['flask_address'], api_config['flask_port'])
 
 # ###########################
 # ### END GENERAL STARTUP ###
@@ -0,0 +1,12 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# The password hash used by main.py. The processes of main.password_hash_pool run pbkdf2_hash() from here, this module
+# only imports hashlib so that starting one of those processes doesn't load the rest of the server
+
+import hashlib
+
+
+# Create a function to hash a password with a salt, both are bytes
+def pbkdf2_hash(password, salt):
+    return hashlib.pbkdf2_hmac('sha512', password, salt, 100000)
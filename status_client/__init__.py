@@ -0,0 +1,7 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# A Python client for the Status Server API v2, see docs/client.md
+from .client import StatusClient, StatusServerError
+
+__all__ = ['StatusClient', 'StatusServerError']
@@ -0,0 +1,315 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+import json
+import logging
+import os
+import random
+import threading
+from collections import deque
+from itertools import islice
+from time import sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class StatusServerError(Exception):
+    """Raised when the server rejects a request, or can't be reached after every retry."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class StatusClient:
+    """A client for the Status Server API v2.
+
+    Heartbeats, values and log entries are buffered in memory and sent by a background thread every flush_interval
+    seconds, or as soon as max_values values or max_log_entries log entries are waiting. Only the latest data of each
+    value name is kept, and a heartbeat and several values are sent together as a single update/batch request. Log
+    entries are sent log_batch_size at a time as update/logging_batch requests.
+    Requests are sent over a pool of keep-alive connections, and are retried with jittered exponential backoff if the
+    server can't be reached or asks the client to slow down. If buffer_path is set then anything that couldn't be sent
+    is saved there when the client is closed, and sent the next time a client is created with the same buffer_path.
+
+    The fetch methods are sent straight away, and need client, admin or owner credentials.
+    """
+
+    def __init__(self, base_url, _id, auth, flush_interval=5, max_values=100, max_log_entries=1000,
+                 log_batch_size=500, buffer_path=None, retries=5, backoff=0.5, max_backoff=30, timeout=10, pool_size=4,
+                 start_thread=True):
+        # base_url is the URL of the API including the version, for example https://status.example.com/api/v2/
+        self.base_url = base_url if base_url.endswith('/') else f'{base_url}/'
+        self.id = _id
+        self.auth = auth
+        self.flush_interval = flush_interval
+        self.max_values = max_values
+        self.max_log_entries = max_log_entries
+        self.log_batch_size = log_batch_size
+        # Set to False if the server doesn't have update/logging_batch, so that log entries are sent one at a time
+        self.log_batches = True
+        self.buffer_path = buffer_path
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Buffered updates waiting to be sent, guarded by lock
+        self.lock = threading.Lock()
+        self.heartbeat_pending = False
+        self.values = {}
+        self.log_entries = deque()
+        # Only one thread sends buffered updates at a time, so that they arrive in order
+        self.flush_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.stopping = False
+        self.stats = {'requests': 0, 'retries': 0, 'failed_flushes': 0, 'dropped_log_entries': 0,
+                      'rejected_updates': 0}
+        if buffer_path is not None:
+            self.load_buffer()
+        self.thread = None
+        if start_thread is True:
+            self.thread = threading.Thread(target=self.run_flusher, name='status_client_flusher', daemon=True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # ### Buffered updates ###
+
+    def heartbeat(self):
+        """Send a heartbeat with the next flush."""
+        with self.lock:
+            self.heartbeat_pending = True
+
+    def set_value(self, value_name, data):
+        """Send data (anything that can be converted to JSON) as the latest data of value_name with the next flush.
+
+        This replaces any data for value_name that hasn't been sent yet.
+        """
+        with self.lock:
+            self.values[str(value_name)] = data
+            full = len(self.values) >= self.max_values
+        if full:
+            self.flush_event.set()
+
+    def log(self, data):
+        """Add an entry to the system's log with the next flush.
+
+        If max_log_entries entries are already waiting then the oldest is dropped.
+        """
+        with self.lock:
+            if len(self.log_entries) >= self.max_log_entries:
+                self.log_entries.popleft()
+                self.stats['dropped_log_entries'] += 1
+            self.log_entries.append(str(data))
+            full = len(self.log_entries) >= self.max_log_entries
+        if full:
+            self.flush_event.set()
+
+    def flush(self):
+        """Send everything that is buffered, returning True if all of it was sent.
+
+        Anything that couldn't be sent because the server was unavailable is kept in the buffer for the next flush.
+        """
+        with self.flush_lock:
+            with self.lock:
+                heartbeat, values = self.heartbeat_pending, self.values
+                log_entries = self.log_entries
+                self.heartbeat_pending, self.values = False, {}
+                self.log_entries = deque()
+            try:
+                if values or heartbeat:
+                    self.send_values(values, heartbeat)
+                    heartbeat, values = False, {}
+                while log_entries:
+                    for i in range(0, self.send_logs(log_entries)):
+                        log_entries.popleft()
+            except StatusServerError as e:
+                if e.status_code is not None and e.status_code not in [429, 503] and e.status_code < 500:
+                    # The server rejected the update itself, so sending it again won't help. Anything after it is
+                    # sent with the next flush
+                    logger.warning(f'Status server rejected an update: {e}')
+                    self.stats['rejected_updates'] += 1
+                    if values or heartbeat:
+                        heartbeat, values = False, {}
+                    else:
+                        for i in range(0, min(len(log_entries), self.log_batch_size if self.log_batches else 1)):
+                            log_entries.popleft()
+                else:
+                    logger.warning(f'Failed to send updates to the status server, they will be retried: {e}')
+                    self.stats['failed_flushes'] += 1
+                self.restore(heartbeat, values, log_entries)
+                return False
+            return True
+
+    def restore(self, heartbeat, values, log_entries):
+        # Put updates that weren't sent back in front of anything buffered since, without replacing newer values
+        with self.lock:
+            self.heartbeat_pending = self.heartbeat_pending or heartbeat
+            values.update(self.values)
+            self.values = values
+            self.log_entries.extendleft(reversed(log_entries))
+            while len(self.log_entries) > self.max_log_entries:
+                self.log_entries.popleft()
+                self.stats['dropped_log_entries'] += 1
+
+    def send_values(self, values, heartbeat):
+        # A single value or heartbeat uses its own endpoint, anything more is sent as one update/batch request
+        if len(values) == 1 and heartbeat is False:
+            value_name, data = next(iter(values.items()))
+            self.send_update('update/main', {'value': value_name, 'data': json.dumps(data)})
+        elif not values:
+            self.send_update('update/heartbeat', {})
+        else:
+            self.send_update('update/batch', {'data': json.dumps(values), 'heartbeat': str(heartbeat).lower()})
+
+    def send_logs(self, log_entries):
+        # Send the oldest log entries, returning how many were sent. Servers without update/logging_batch respond 404,
+        # after which log entries are sent one at a time with update/logging
+        if self.log_batches is True:
+            batch = list(islice(log_entries, 0, self.log_batch_size))
+            try:
+                self.send_update('update/logging_batch', {'data': json.dumps(batch)})
+                return len(batch)
+            except StatusServerError as e:
+                if e.status_code != 404:
+                    raise
+                self.log_batches = False
+        self.send_update('update/logging', {'data': log_entries[0]})
+        return 1
+
+    def send_update(self, path, data):
+        return self.request('POST', path, dict(data, id=self.id, auth=self.auth))
+
+    def run_flusher(self):
+        while self.stopping is False:
+            self.flush_event.wait(self.flush_interval)
+            self.flush_event.clear()
+            if self.stopping is False:
+                self.flush()
+
+    def close(self):
+        """Stop the background thread, send anything that is buffered, and save anything that couldn't be sent."""
+        self.stopping = True
+        self.flush_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        # Don't keep retrying while closing, anything that isn't sent is saved to buffer_path instead
+        retries, self.retries = self.retries, 0
+        self.flush()
+        self.retries = retries
+        if self.buffer_path is not None:
+            self.save_buffer()
+        self.session.close()
+
+    # ### On-disk buffer ###
+
+    def save_buffer(self):
+        with self.lock:
+            buffer = {'heartbeat': self.heartbeat_pending, 'values': self.values, 'logs': list(self.log_entries)}
+        if not buffer['heartbeat'] and not buffer['values'] and not buffer['logs']:
+            if os.path.exists(self.buffer_path):
+                os.remove(self.buffer_path)
+            return
+        # Write to a temporary file first so that a crash while saving doesn't lose the previous buffer
+        with open(f'{self.buffer_path}.tmp', 'w') as f:
+            json.dump(buffer, f)
+        os.replace(f'{self.buffer_path}.tmp', self.buffer_path)
+
+    def load_buffer(self):
+        try:
+            with open(self.buffer_path) as f:
+                buffer = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logger.warning(f'Ignoring unreadable status client buffer {self.buffer_path}: {e}')
+            return
+        self.restore(buffer.get('heartbeat', False), buffer.get('values', {}), buffer.get('logs', []))
+
+    # ### Requests ###
+
+    def request(self, method, path, data):
+        """Send a request to the API, retrying with jittered exponential backoff if the server can't be reached or
+        responds with 429, 503 or another 5xx status. Returns the response, or raises StatusServerError."""
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, f'{self.base_url}{path}', data=data, timeout=self.timeout)
+                self.stats['requests'] += 1
+            except requests.RequestException as e:
+                response, error = None, StatusServerError(f'Failed to connect to the status server: {e}')
+            else:
+                if response.status_code < 400 or response.status_code == 304:
+                    return response
+                error = StatusServerError(f'{path} returned {response.status_code}: {response.text.strip()}',
+                                          response.status_code)
+                if response.status_code not in [429, 503] and response.status_code < 500:
+                    raise error
+            if attempt >= self.retries:
+                raise error
+            attempt += 1
+            self.stats['retries'] += 1
+            # Full jitter, so that many clients that failed at once don't all retry at once
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if response is not None and response.headers.get('Retry-After', '').isdigit():
+                delay = max(delay, int(response.headers['Retry-After']))
+            sleep(delay)
+
+    def fetch(self, path, **arguments):
+        arguments = {key: value for key, value in arguments.items() if value is not None}
+        return self.request('POST', path, dict(arguments, id=self.id, auth=self.auth))
+
+    def fetch_value(self, system_id, value_name):
+        """Fetch the latest data of a value of a system."""
+        return self.fetch('fetch/main', system_id=system_id, value=value_name).json()
+
+    def fetch_heartbeat(self, system_id):
+        """Fetch the time of the latest heartbeat of a system, as a float."""
+        return float(self.fetch('fetch/heartbeat', system_id=system_id).text)
+
+    def fetch_bulk(self, system_ids=None, value_names=None, since_version=None):
+        """Fetch the heartbeat and values of many systems at once.
+
+        Returns the dictionary returned by fetch/bulk and the version to pass as since_version next time. The dictionary
+        is None if the server responded 304 Not Modified.
+        """
+        response = self.fetch('fetch/bulk', system_ids=system_ids and json.dumps(list(system_ids)),
+                              values=value_names and json.dumps(list(value_names)), since_version=since_version)
+        version = response.headers.get('X-Version', since_version)
+        if response.status_code == 304:
+            return None, version
+        return response.json(), version
+
+    def fetch_history(self, system_id, value_name, start=None, end=None, bucket=None):
+        """Fetch the history of a value of a system, as returned by fetch/history."""
+        return self.fetch('fetch/history', system_id=system_id, value=value_name, start=start, end=end,
+                          bucket=bucket).json()
+
+    def fetch_logs(self, system_id, start=None, end=None, tail=None, search=None):
+        """Fetch log entries of a system, as a list of dictionaries with the keys time and data."""
+        return self.fetch('fetch/logs', system_id=system_id, start=start, end=end, tail=tail, search=search).json()
+
+    def fetch_down_systems(self, since=None):
+        """Fetch the systems that are down, as returned by fetch/down_systems."""
+        return self.fetch('fetch/down_systems', since=since).json()
+
+    def check_auth(self):
+        """Return True if the server accepts this client's credentials."""
+        try:
+            self.request('POST', 'general/check_auth', {'id': self.id, 'auth': self.auth})
+        except StatusServerError as e:
+            if e.status_code in [400, 401]:
+                return False
+            raise
+        return True
@@ -0,0 +1,138 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Shared fixtures for the tests in this directory.
+# main.py reads conf.yaml and starts its background threads when it is imported, so every test in a pytest run shares
+# one throwaway server created with test_api_config. Tests that need a restart or other settings run main.py in a
+# subprocess with the run_server_script or start_server_script fixtures
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import pytest
+
+repo_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+benchmarks_directory = os.path.join(repo_directory, 'benchmarks')
+if benchmarks_directory not in sys.path:
+    sys.path.insert(0, benchmarks_directory)
+
+import common
+
+api_base_url = '/api/v2/'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+test_api_config = {
+    'historical_flush_interval': 0.2,
+    'historical_segment_size': 20000,
+    'historical_segment_age': 3600,
+    'historical_retention': 86400,
+    # The tests run compaction themselves with a fixed time, so the background compactor only runs once at startup
+    'historical_compaction_interval': 3600,
+    'log_rotate_size': 20000,
+    'log_index_interval': 1000,
+    'rate_limit_heartbeat': 1,
+    'rate_limit_burst': 5,
+    'subscribe_address': '127.0.0.1',
+    'subscribe_port': free_port()
+}
+
+
+@pytest.fixture(scope='session')
+def server():
+    """Bootstrap the shared throwaway server, returning (main module, base directory, owner ID, owner auth)."""
+    base_directory, owner_id, owner_pass = common.bootstrap(test_api_config)
+    import main
+    # Wait for the startup compaction, so that it doesn't run at the same time as the historical data tests
+    main.historical_import_done.wait(10)
+    while main.historical_stats['compactions'] == 0:
+        main.historical_compactor_stop.wait(0.05)
+    return main, base_directory, owner_id, owner_pass
+
+
+@pytest.fixture
+def main(server):
+    return server[0]
+
+
+@pytest.fixture
+def owner(server):
+    return server[2], server[3]
+
+
+@pytest.fixture
+def client(main):
+    return main.app.test_client()
+
+
+@pytest.fixture
+def new_credentials(client, owner):
+    """Return a function that creates credentials with an access level, returning (id, auth)."""
+    def create(access_level='system'):
+        response = client.post(f'{api_base_url}admin/new_auth',
+                               data={'id': owner[0], 'auth': owner[1], 'access_level': access_level})
+        assert response.status_code == 200
+        credentials = json.loads(response.data)
+        return credentials['id'], credentials['auth']
+    return create
+
+
+def script_command(script, api_config=None, base_directory=None):
+    setup = (f'import json, os, sys\n'
+             f'sys.path.insert(0, {benchmarks_directory!r})\n'
+             f'import common\n')
+    if base_directory is None:
+        setup += (f'base_directory, owner_id, owner_pass = common.bootstrap({api_config or {}!r})\n'
+                  f'systems = common.provision(base_directory, 1)\n')
+    else:
+        setup += (f'base_directory, owner_id, owner_pass = {base_directory!r}, None, None\n'
+                  f'systems = []\n'
+                  f'os.environ["CONF_FILE"] = base_directory + "conf.yaml"\n')
+    return [sys.executable, '-c', setup + script]
+
+
+def script_result(returncode, stdout, stderr):
+    assert returncode == 0, stderr.decode()
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+
+def run_script(script, api_config=None, base_directory=None):
+    """Run script in a new Python process after creating a throwaway server, or reusing base_directory.
+
+    The variables base_directory, owner_id and owner_pass are defined before script runs, along with a list of
+    credentials for one system in systems. Returns the JSON that the script prints on its last line of output.
+    """
+    result = subprocess.run(script_command(script, api_config, base_directory), stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, timeout=120)
+    return script_result(result.returncode, result.stdout, result.stderr)
+
+
+def start_script(script, api_config=None, base_directory=None):
+    """Start script in the same way as run_script without waiting for it.
+
+    Returns a function that waits for the script to finish and returns what run_script would have.
+    """
+    process = subprocess.Popen(script_command(script, api_config, base_directory), stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+
+    def wait():
+        stdout, stderr = process.communicate(timeout=120)
+        return script_result(process.returncode, stdout, stderr)
+    return wait
+
+
+@pytest.fixture
+def run_server_script():
+    return run_script
+
+
+@pytest.fixture
+def start_server_script():
+    return start_script
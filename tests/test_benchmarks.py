@@ -0,0 +1,32 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for the load test in benchmarks/, run for a second so that it is quick to check that it still works
+
+import json
+import os
+import subprocess
+import sys
+from conftest import benchmarks_directory
+
+
+def run_load_test(*arguments):
+    command = [sys.executable, os.path.join(benchmarks_directory, 'load_test.py'), '--duration', '1', '--systems', '3',
+               '--clients', '1', '--threads', '2']
+    result = subprocess.run(command + list(arguments), stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120)
+    assert result.returncode == 0, result.stderr.decode()
+    return result.stdout.decode()
+
+
+def test_load_test_writes_results_that_can_be_compared(tmp_path):
+    output = run_load_test('--mix', 'heartbeat=1,main=1,fetch=1', '--output', f'{tmp_path}/first.json')
+    assert 'visibility lag' in output
+    with open(f'{tmp_path}/first.json') as f:
+        results = json.load(f)
+    assert set(results['requests']) == {'heartbeat', 'main', 'fetch'}
+    assert results['total']['requests'] > 0 and results['total']['errors'] == 0
+    assert results['total']['p50_ms'] <= results['total']['p99_ms'] <= results['total']['max_ms']
+    assert results['visibility_lag']['requests'] > 0
+    assert 'queue_depth' in results['database_writer']
+    output = run_load_test('--mix', 'heartbeat=1,main=1,fetch=1', '--compare', f'{tmp_path}/first.json')
+    assert f'Compared with {tmp_path}/first.json' in output and 'throughput x' in output
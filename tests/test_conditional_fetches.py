@@ -0,0 +1,77 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for the version ETags of fetch/main and the since_version argument of fetch/bulk
+
+import json
+from conftest import api_base_url
+
+
+def test_fetch_main_returns_304_for_the_current_version(client, new_credentials):
+    system_id, system_auth = new_credentials('system')
+    client_id, client_auth = new_credentials('client')
+    fetch_arguments = {'id': client_id, 'auth': client_auth, 'system_id': system_id, 'value': 'cpu'}
+    client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu', 'data': '1'})
+    response = client.post(f'{api_base_url}fetch/main', data=fetch_arguments)
+    etag = response.headers['ETag']
+    assert response.status_code == 200 and json.loads(response.data) == 1
+    response = client.post(f'{api_base_url}fetch/main', data=fetch_arguments, headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.data == b'' and response.headers['ETag'] == etag
+    # Every update changes the version, even if the data is the same
+    client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu', 'data': '1'})
+    response = client.post(f'{api_base_url}fetch/main', data=fetch_arguments, headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+
+
+def test_fetch_bulk_only_returns_changes_since_a_version(client, new_credentials):
+    systems = [new_credentials('system') for i in range(0, 3)]
+    client_id, client_auth = new_credentials('client')
+    system_ids = json.dumps([system_id for system_id, system_auth in systems])
+    for system_id, system_auth in systems:
+        client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'a',
+                                                        'data': '1'})
+        client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'b',
+                                                        'data': '2'})
+
+    def fetch_bulk(**arguments):
+        return client.post(f'{api_base_url}fetch/bulk', data=dict(arguments, id=client_id, auth=client_auth,
+                                                                  system_ids=system_ids))
+    response = fetch_bulk()
+    version = response.headers['X-Version']
+    assert json.loads(response.data) == {system_id: {'heartbeat': None, 'values': {'a': 1, 'b': 2}}
+                                         for system_id, system_auth in systems}
+    assert fetch_bulk(since_version=version).data == b'{}'
+    assert response.headers['ETag'] == f'"{version}"'
+
+    (first_id, first_auth), (second_id, second_auth) = systems[:2]
+    client.post(f'{api_base_url}update/main', data={'id': first_id, 'auth': first_auth, 'value': 'b', 'data': '3'})
+    client.post(f'{api_base_url}update/heartbeat', data={'id': second_id, 'auth': second_auth})
+    response = fetch_bulk(since_version=version)
+    changes = json.loads(response.data)
+    assert list(changes) == [first_id, second_id]
+    assert changes[first_id] == {'values': {'b': 3}}
+    assert list(changes[second_id]['values']) == [] and changes[second_id]['heartbeat'] is not None
+    assert int(response.headers['X-Version']) > int(version)
+    assert fetch_bulk(since_version='latest').status_code == 400
+
+
+def test_fetch_bulk_returns_304_when_nothing_has_changed(client, new_credentials):
+    client_id, client_auth = new_credentials('client')
+    response = client.post(f'{api_base_url}fetch/bulk', data={'id': client_id, 'auth': client_auth})
+    etag = response.headers['ETag']
+    response = client.post(f'{api_base_url}fetch/bulk', data={'id': client_id, 'auth': client_auth},
+                           headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.headers['X-Version'] == etag.strip('"')
+
+
+def test_fetch_bulk_reports_new_systems(client, new_credentials):
+    client_id, client_auth = new_credentials('client')
+    response = client.post(f'{api_base_url}fetch/bulk', data={'id': client_id, 'auth': client_auth})
+    etag, version = response.headers['ETag'], response.headers['X-Version']
+    system_id, system_auth = new_credentials('system')
+    response = client.post(f'{api_base_url}fetch/bulk', data={'id': client_id, 'auth': client_auth},
+                           headers={'If-None-Match': etag})
+    assert response.status_code == 200 and system_id in json.loads(response.data)
+    response = client.post(f'{api_base_url}fetch/bulk', data={'id': client_id, 'auth': client_auth,
+                                                              'since_version': version})
+    assert json.loads(response.data) == {system_id: {'heartbeat': None, 'values': {}}}
@@ -0,0 +1,138 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for creating credentials and checking them
+
+import json
+import sqlite3
+from contextlib import closing
+from time import time
+import pytest
+from conftest import api_base_url
+
+
+@pytest.fixture
+def count_password_hashes(main, monkeypatch):
+    """Count the calls to verify_password(), returning a list that has an entry added for each call."""
+    calls = []
+    verify_password = main.verify_password
+
+    def record_verify_password(stored_password, provided_password):
+        calls.append(provided_password)
+        return verify_password(stored_password, provided_password)
+    monkeypatch.setattr(main, 'verify_password', record_verify_password)
+    return calls
+
+
+@pytest.mark.parametrize('access_level, allowed', [('client', True), ('admin', True), ('system', False)])
+def test_fetch_main_is_only_allowed_for_clients_admins_and_owners(client, new_credentials, access_level, allowed):
+    system_id, system_auth = new_credentials('system')
+    client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu', 'data': '1'})
+    _id, _auth = new_credentials(access_level)
+    response = client.post(f'{api_base_url}fetch/main', data={'id': _id, 'auth': _auth, 'system_id': system_id,
+                                                              'value': 'cpu'})
+    assert response.status_code == (200 if allowed else 401)
+    response = client.post(f'{api_base_url}fetch/main', data={'id': _id, 'auth': 'wrong', 'system_id': system_id,
+                                                              'value': 'cpu'})
+    assert response.status_code == 401
+
+
+@pytest.mark.parametrize('creator_level, access_level, allowed', [
+    ('owner', 'admin', True), ('admin', 'admin', False), ('admin', 'client', True), ('admin', 'system', True),
+    ('client', 'client', False), ('system', 'system', False), ('owner', 'owner', False)
+])
+def test_new_auth_access_levels(client, owner, new_credentials, creator_level, access_level, allowed):
+    _id, _auth = owner if creator_level == 'owner' else new_credentials(creator_level)
+    response = client.post(f'{api_base_url}admin/new_auth', data={'id': _id, 'auth': _auth,
+                                                                  'access_level': access_level})
+    assert response.status_code == (200 if allowed else 400 if access_level == 'owner' else 401)
+
+
+def test_each_request_hashes_the_password_at_most_once(client, new_credentials, count_password_hashes):
+    system_id, system_auth = new_credentials('system')
+    client_id, client_auth = new_credentials('client')
+    admin_id, admin_auth = new_credentials('admin')
+    del count_password_hashes[:]
+    client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu', 'data': '1'})
+    assert len(count_password_hashes) == 1
+    # fetch/main allows several access levels, the stored one is checked against all of them with a single hash
+    for i in range(0, 2):
+        assert client.post(f'{api_base_url}fetch/main', data={'id': client_id, 'auth': client_auth,
+                                                               'system_id': system_id, 'value': 'cpu'}).status_code \
+            == 200
+    assert len(count_password_hashes) == 2
+    assert client.post(f'{api_base_url}admin/new_auth', data={'id': admin_id, 'auth': admin_auth,
+                                                              'access_level': 'client'}).status_code == 200
+    assert len(count_password_hashes) == 3
+
+
+def test_reserved_id_is_released_when_its_auth_row_fails_to_insert(main):
+    assert main.reserve_id('failed_insert') is True
+    assert main.id_exists('failed_insert') is True
+    # auth has three columns, so this insert fails
+    future = main.queue_database_operation(['new_row', 'auth', ('failed_insert', 'password')])
+    with pytest.raises(sqlite3.Error):
+        future.result(timeout=5)
+    assert main.id_exists('failed_insert') is False
+    assert main.reserve_id('failed_insert') is True
+
+
+def test_credentials_changed_while_being_checked_are_not_cached(main, new_credentials, monkeypatch):
+    client_id, client_auth = new_credentials('client')
+    verify_password = main.verify_password
+
+    # Change the credentials after their auth row has been read, but before they are cached
+    def verify_then_change(stored_password, provided_password):
+        main.invalidate_cached_credentials(client_id)
+        return verify_password(stored_password, provided_password)
+    monkeypatch.setattr(main, 'verify_password', verify_then_change)
+    assert main.get_access_level(client_id, client_auth) == 'client'
+    assert main.get_cached_credentials(main.credentials_cache_key(client_id, client_auth)) is None
+
+    monkeypatch.setattr(main, 'verify_password', verify_password)
+    assert main.get_access_level(client_id, client_auth) == 'client'
+    assert main.get_cached_credentials(main.credentials_cache_key(client_id, client_auth)) == 'client'
+
+
+def test_new_credentials_can_be_used_as_soon_as_they_are_returned(main, client, owner):
+    for access_level in ['system', 'client']:
+        start = time()
+        response = client.post(f'{api_base_url}admin/new_auth', data={'id': owner[0], 'auth': owner[1],
+                                                                      'access_level': access_level})
+        # admin/new_auth waits for the insert to be committed, not for a fixed amount of time
+        assert response.status_code == 200 and time() - start < 2
+        credentials = json.loads(response.data)
+        assert client.post(f'{api_base_url}general/check_auth', data=credentials).status_code == 200
+        assert (credentials['id'] in main.system_state) is (access_level == 'system')
+        with closing(sqlite3.connect(main.database_path)) as con:
+            assert con.execute('SELECT access_level FROM auth WHERE id = ?', (credentials['id'],)).fetchone() == \
+                (access_level,)
+
+
+def test_new_auth_bulk(client, owner):
+    response = client.post(f'{api_base_url}admin/new_auth_bulk', data={'id': owner[0], 'auth': owner[1],
+                                                                       'access_level': 'client', 'count': 5})
+    assert response.status_code == 200
+    credentials = json.loads(response.data)
+    assert len({new_credentials['id'] for new_credentials in credentials}) == 5
+    for new_credentials in credentials:
+        assert client.post(f'{api_base_url}general/check_auth', data=new_credentials).status_code == 200
+    assert client.post(f'{api_base_url}admin/new_auth_bulk', data={'id': owner[0], 'auth': owner[1],
+                                                                   'access_level': 'client', 'count': 0}) \
+        .status_code == 400
+
+
+def test_id_collisions_are_retried_without_waiting(main, monkeypatch):
+    attempts = []
+    reserve_id = main.reserve_id
+
+    # Pretend that the first three IDs generated are already in use
+    def collide_three_times(_id):
+        attempts.append(_id)
+        return False if len(attempts) <= 3 else reserve_id(_id)
+    monkeypatch.setattr(main, 'reserve_id', collide_three_times)
+    start = time()
+    new_id, new_auth = main.generate_new_credentials()
+    assert time() - start < 1
+    assert len(attempts) == 4 and new_id == attempts[-1]
+    assert main.id_exists(new_id) is True
@@ -0,0 +1,65 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for the batched database writer
+
+import json
+import sqlite3
+from concurrent.futures import Future
+from contextlib import closing
+from time import time
+import pytest
+from conftest import api_base_url
+
+
+def test_merge_keeps_the_last_update_to_each_row_in_order(main):
+    batch = [(operation, Future(), None, time()) for operation in [
+        ['update_row', 'systems_stats', 'a', 'heartbeat', '1'],
+        ['new_row', 'systems_stats', ('b', '', None, '{}')],
+        ['update_row', 'systems_stats', 'a', 'heartbeat', '2'],
+        ['update_row', 'systems_stats', 'a', 'system_name', 'first'],
+        ['update_system_value', 'a', 'cpu', '1'],
+        ['update_row', 'systems_stats', 'b', 'heartbeat', '3'],
+        ['update_row', 'systems_stats', 'a', 'heartbeat', '4'],
+        ['update_system_value', 'a', 'cpu', '2']
+    ]]
+    assert [operation for operation, future, sequence, queued in main.merge_database_operations(batch)] == [
+        ['new_row', 'systems_stats', ('b', '', None, '{}')],
+        ['update_row', 'systems_stats', 'a', 'system_name', 'first'],
+        ['update_system_value', 'a', 'cpu', '1'],
+        ['update_row', 'systems_stats', 'b', 'heartbeat', '3'],
+        ['update_row', 'systems_stats', 'a', 'heartbeat', '4'],
+        ['update_system_value', 'a', 'cpu', '2']
+    ]
+
+
+def test_batch_is_written_in_one_transaction_and_completes_every_future(main, new_credentials):
+    system_id, system_auth = new_credentials('system')
+    batch = [(['update_row', 'systems_stats', system_id, 'heartbeat', str(i)], Future(), None, time())
+             for i in range(0, 5)]
+    batch.append((['update_row', 'missing_table', system_id, 'heartbeat', '5'], Future(), None, time()))
+    stats = dict(main.database_writer_stats)
+    with closing(sqlite3.connect(main.database_path)) as con:
+        main.write_database_batch(con, batch)
+        assert con.execute('SELECT heartbeat FROM systems_stats WHERE id = ?', (system_id,)).fetchone()[0] == '4'
+    assert [future.result(timeout=0) for operation, future, sequence, queued in batch[:5]] == [True] * 5
+    # A failed operation doesn't stop the rest of the batch from being committed
+    with pytest.raises(sqlite3.Error):
+        batch[5][1].result(timeout=0)
+    assert main.database_writer_stats['merged_operations'] - stats['merged_operations'] == 4
+    assert main.database_writer_stats['failed_operations'] - stats['failed_operations'] == 1
+    assert main.database_writer_stats['batches'] - stats['batches'] == 1
+
+
+def test_queued_operations_are_committed_by_the_writer(main, client, owner, new_credentials):
+    system_id, system_auth = new_credentials('system')
+    batches = main.database_writer_stats['batches']
+    future = main.queue_database_operation(['update_row', 'systems_stats', system_id, 'system_name', 'queued'])
+    assert future.result(timeout=5) is True
+    assert main.database_writer_stats['batches'] > batches
+    with closing(sqlite3.connect(main.database_path)) as con:
+        assert con.execute('SELECT system_name FROM systems_stats WHERE id = ?', (system_id,)).fetchone()[0] == \
+            'queued'
+    stats = json.loads(client.post(f'{api_base_url}admin/stats', data={'id': owner[0], 'auth': owner[1]}).data)
+    assert {'queue_depth', 'batches', 'last_batch_size', 'max_batch_size', 'last_commit_latency',
+            'merged_operations'} <= set(stats['database_writer'])
@@ -0,0 +1,53 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for fetching the heartbeats and values of many systems at once with fetch/bulk
+
+import json
+import pytest
+from conftest import api_base_url
+
+
+@pytest.fixture
+def fleet(client, new_credentials):
+    """Create two systems that have sent values a, b and c, one of which has sent a heartbeat. Returns their IDs."""
+    systems = [new_credentials('system') for i in range(0, 2)]
+    for i, (system_id, system_auth) in enumerate(systems):
+        client.post(f'{api_base_url}update/batch', data={'id': system_id, 'auth': system_auth,
+                                                         'data': json.dumps({'a': i, 'b': [i], 'c': {'i': i}}),
+                                                         'heartbeat': 'true' if i == 0 else 'false'})
+    return [system_id for system_id, system_auth in systems]
+
+
+@pytest.fixture
+def fetch_bulk(client, new_credentials):
+    client_id, client_auth = new_credentials('client')
+
+    def fetch(**arguments):
+        response = client.post(f'{api_base_url}fetch/bulk', data=dict(arguments, id=client_id, auth=client_auth))
+        assert response.status_code == 200 and response.mimetype == 'application/json'
+        return json.loads(response.data)
+    return fetch
+
+
+def test_fetch_bulk_returns_every_requested_system(main, fleet, fetch_bulk):
+    result = fetch_bulk(system_ids=json.dumps(fleet + ['missing']))
+    assert result == {
+        fleet[0]: {'heartbeat': main.get_system_heartbeat(fleet[0]), 'values': {'a': 0, 'b': [0], 'c': {'i': 0}}},
+        fleet[1]: {'heartbeat': None, 'values': {'a': 1, 'b': [1], 'c': {'i': 1}}},
+        'missing': None
+    }
+    # The IDs can also be a comma separated list
+    assert fetch_bulk(system_ids=','.join(fleet)) == {system_id: result[system_id] for system_id in fleet}
+
+
+def test_fetch_bulk_without_system_ids_returns_every_system(main, fleet, fetch_bulk):
+    for arguments in [{}, {'system_ids': 'all'}]:
+        result = fetch_bulk(**arguments)
+        assert set(result) == set(main.get_system_ids())
+        assert result[fleet[1]]['values'] == {'a': 1, 'b': [1], 'c': {'i': 1}}
+
+
+def test_fetch_bulk_only_returns_the_requested_values(fleet, fetch_bulk):
+    result = fetch_bulk(system_ids=json.dumps(fleet), values='a,c,missing')
+    assert [result[system_id]['values'] for system_id in fleet] == [{'a': 0, 'c': {'i': 0}}, {'a': 1, 'c': {'i': 1}}]
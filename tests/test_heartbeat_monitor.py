@@ -0,0 +1,55 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for the heartbeat monitor and fetch/down_systems, using heartbeats from before heartbeat_timeout
+
+import json
+from time import sleep, time
+from conftest import api_base_url
+
+
+def wait_until_down(main, system_id):
+    deadline = time() + 5
+    while system_id not in dict(main.get_down_systems()[0]) and time() < deadline:
+        sleep(0.01)
+    return dict(main.get_down_systems()[0]).get(system_id)
+
+
+def test_system_is_down_after_heartbeat_timeout_and_up_after_a_heartbeat(main, client, new_credentials):
+    system_id, system_auth = new_credentials('system')
+    client_id, client_auth = new_credentials('client')
+    last_heartbeat = time() - main.api_heartbeat_timeout - 10
+    main.record_system_heartbeat(system_id, last_heartbeat)
+    assert wait_until_down(main, system_id) == last_heartbeat + main.api_heartbeat_timeout
+
+    def fetch_down_systems(**arguments):
+        return json.loads(client.post(f'{api_base_url}fetch/down_systems',
+                                      data=dict(arguments, id=client_id, auth=client_auth)).data)
+    down_systems = fetch_down_systems()
+    assert down_systems['timeout'] == main.api_heartbeat_timeout
+    assert {'system_id': system_id, 'since': last_heartbeat + main.api_heartbeat_timeout,
+            'last_heartbeat': last_heartbeat} in down_systems['down']
+
+    since = time()
+    response = client.post(f'{api_base_url}update/heartbeat', data={'id': system_id, 'auth': system_auth})
+    assert response.status_code == 200
+    down_systems = fetch_down_systems(since=since)
+    assert system_id not in [system['system_id'] for system in down_systems['down']]
+    assert [transition['state'] for transition in down_systems['transitions']
+            if transition['system_id'] == system_id] == ['up']
+    assert [transition['state'] for transition in fetch_down_systems()['transitions']
+            if transition['system_id'] == system_id] == ['down', 'up']
+
+
+def test_only_the_latest_deadline_counts(main):
+    # The first heartbeat's deadline has passed, but the second one replaced it
+    main.record_system_heartbeat('replaced_deadline', time() - main.api_heartbeat_timeout - 10)
+    main.record_system_heartbeat('replaced_deadline', time())
+    main.check_heartbeat_deadlines()
+    assert 'replaced_deadline' not in dict(main.get_down_systems()[0])
+
+
+def test_deadline_heap_does_not_grow_with_every_heartbeat(main):
+    for i in range(0, 5000):
+        main.record_system_heartbeat('frequent_heartbeats', time())
+    assert len(main.heartbeat_deadline_heap) <= 2 * len(main.heartbeat_deadlines) + 1025
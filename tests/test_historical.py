@@ -0,0 +1,186 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for historical segments, rollups and retention, checked against the raw samples that were written
+
+import json
+import os
+from time import time
+import pytest
+from conftest import api_base_url
+
+day = 86400
+
+
+@pytest.fixture(scope='module')
+def rolled_up_series(server):
+    """Write 5 days of samples every 30 seconds to a series and compact it, returning (main, id, name, samples, now).
+
+    With historical_retention set to 1 day, the raw samples of the first 4 days are removed once they are rolled up.
+    """
+    main = server[0]
+    now = time()
+    first_day = (int(now) // day - 5) * day
+    # Every 97th sample isn't a number, it is counted but left out of min, max and mean
+    samples = [(first_day + i * 30.0, json.dumps('text' if i % 97 == 0 else i % 100)) for i in range(0, 5 * 2880)]
+    main.write_historical_samples('rollup_test', 'temp', samples)
+    # Each run rolls up at most historical_rollup_batch buckets of each resolution
+    for i in range(0, 10):
+        main.compact_historical_series('rollup_test', 'temp', now)
+    return main, 'rollup_test', 'temp', samples, now
+
+
+def expected_buckets(main, samples, start, end, bucket_size):
+    return main.format_historical_buckets(main.aggregate_historical_samples(
+        [sample for sample in samples if start <= sample[0] <= end], bucket_size))
+
+
+def test_rollups_cover_every_complete_bucket(rolled_up_series):
+    main, _id, _val_name, samples, now = rolled_up_series
+    for resolution in main.historical_rollup_resolutions:
+        watermark = main.get_historical_rollup_watermark(_id, _val_name, resolution)
+        assert watermark > samples[-1][0]
+        rollups = list(main.read_historical_rollups(_id, _val_name, resolution, samples[0][0], watermark))
+        assert sum(rollup['count'] for rollup in rollups) == \
+            len([sample for sample in samples if sample[0] < watermark])
+
+
+def test_retention_removes_raw_samples_that_were_rolled_up(rolled_up_series):
+    main, _id, _val_name, samples, now = rolled_up_series
+    raw_samples = list(main.read_historical_samples(_id, _val_name))
+    assert raw_samples[-1] == samples[-1]
+    # Segments are removed whole, so up to historical_segment_age seconds of samples older than the retention are kept
+    assert raw_samples[0][0] > now - main.api_historical_retention - main.api_historical_segment_age - 60
+    assert raw_samples == [sample for sample in samples if sample[0] >= raw_samples[0][0]]
+    assert main.historical_stats['removed_segments'] > 0
+
+
+@pytest.mark.parametrize('bucket_size', [60, 3600, day, 7200, 600])
+def test_rollup_buckets_match_raw_buckets(rolled_up_series, bucket_size):
+    main, _id, _val_name, samples, now = rolled_up_series
+    # Ranges start on a whole day, as the first bucket can include samples from up to one rollup before start
+    for start, end in [(samples[0][0], samples[-1][0]), (samples[0][0], samples[0][0] + 3 * day - 1),
+                       (samples[0][0] + 4 * day, now)]:
+        assert main.format_historical_buckets(main.query_historical_buckets(_id, _val_name, start, end, bucket_size)) \
+            == expected_buckets(main, samples, start, end, bucket_size), (start, end)
+
+
+@pytest.mark.parametrize('bucket_size', [7, 90, 3601])
+def test_other_bucket_sizes_count_every_sample(rolled_up_series, bucket_size):
+    # Older samples come from the 1 minute rollups, so each minute is counted in the bucket that it starts in
+    main, _id, _val_name, samples, now = rolled_up_series
+    buckets = main.format_historical_buckets(main.query_historical_buckets(_id, _val_name, samples[0][0],
+                                                                           samples[-1][0], bucket_size))
+    assert sum(bucket['count'] for bucket in buckets) == len(samples)
+    assert min(bucket['min'] for bucket in buckets if bucket['min'] is not None) == 0
+    assert max(bucket['max'] for bucket in buckets if bucket['max'] is not None) == 99
+    assert buckets[-1]['last'] == json.loads(samples[-1][1])
+    # The buckets that only contain raw samples are exact
+    raw_start = next(iter(main.read_historical_samples(_id, _val_name)))[0]
+    raw_buckets = [bucket for bucket in buckets if bucket['start'] >= raw_start + 60]
+    assert raw_buckets == [bucket for bucket in expected_buckets(main, samples, samples[0][0], samples[-1][0],
+                                                                 bucket_size) if bucket['start'] >= raw_start + 60]
+
+
+def test_newest_segment_is_removed_once_it_is_stale(main):
+    now = time()
+    first_day = (int(now) // day - 3) * day
+    samples = [(first_day + i * 600.0, json.dumps(i)) for i in range(0, 144)]
+    main.write_historical_samples('stale_test', 'temp', samples)
+    series_directory = main.historical_series_directory('stale_test', 'temp')
+    # The series stopped receiving samples a day before its retention ended
+    for segment_start in main.list_historical_segments(series_directory):
+        os.utime(f'{series_directory}{segment_start:016d}.seg', (samples[-1][0], samples[-1][0]))
+    for i in range(0, 10):
+        main.compact_historical_series('stale_test', 'temp', now)
+    assert main.list_historical_segments(series_directory) == []
+    assert sum(bucket['count'] for bucket in main.query_historical_buckets(
+        'stale_test', 'temp', samples[0][0], samples[-1][0], 3600)) == len(samples)
+    # The next sample starts a new segment
+    main.write_historical_samples('stale_test', 'temp', [(now, '1')])
+    assert len(main.list_historical_segments(series_directory)) == 1
+
+
+@pytest.mark.parametrize('arguments', [{'start': 'nan'}, {'start': '-inf'}, {'end': 'inf'}, {'end': 'nan'},
+                                       {'bucket': 'nan'}, {'bucket': 'inf'}, {'bucket': '0'}, {'bucket': '-60'},
+                                       {'start': 'yesterday'}, {'start': '100', 'end': '50'},
+                                       {'start': '0', 'end': '100000', 'bucket': '1'}])
+def test_fetch_history_rejects_invalid_arguments(client, new_credentials, arguments):
+    system_id, system_auth = new_credentials('system')
+    client_id, client_auth = new_credentials('client')
+    response = client.post(f'{api_base_url}fetch/history', data=dict(arguments, id=client_id, auth=client_auth,
+                                                                      system_id=system_id, value='temp'))
+    assert response.status_code == 400
+
+
+def test_fetch_history(client, new_credentials):
+    system_id, system_auth = new_credentials('system')
+    client_id, client_auth = new_credentials('client')
+    for i in range(0, 3):
+        client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'temp',
+                                                        'data': str(i)})
+    response = client.post(f'{api_base_url}fetch/history', data={'id': client_id, 'auth': client_auth,
+                                                                 'system_id': system_id, 'value': 'temp',
+                                                                 'bucket': '86400'})
+    assert response.status_code == 200
+    history = json.loads(response.data)
+    assert history['bucket'] == 86400
+    assert sum(bucket['count'] for bucket in history['buckets']) == 3
+    assert history['buckets'][-1]['last'] == 2
+
+
+def test_segments_are_split_by_size_and_read_with_the_index(main):
+    now = time()
+    samples = [(now - 3000 + i, json.dumps({'i': i})) for i in range(0, 3000)]
+    main.write_historical_samples('segment_test', 'temp', samples)
+    series_directory = main.historical_series_directory('segment_test', 'temp')
+    segments = main.list_historical_segments(series_directory)
+    assert len(segments) > 1
+    # A segment is full once it reaches historical_segment_size, so it can go over by the last sample written to it
+    assert all(os.path.getsize(f'{series_directory}{segment_start:016d}.seg') < main.api_historical_segment_size + 64
+               for segment_start in segments)
+    assert list(main.read_historical_samples('segment_test', 'temp')) == samples
+    for start, end in [(samples[300][0], samples[2700][0]), (samples[1000][0] + 0.5, samples[1001][0]),
+                       (now, now + 10)]:
+        assert list(main.read_historical_samples('segment_test', 'temp', start, end)) == \
+            [sample for sample in samples if start <= sample[0] <= end]
+    # Overwrite the samples before the second index entry of the first segment, a read that starts after it must seek
+    # past them
+    segment_path = f'{series_directory}{segments[0]:016d}'
+    with open(f'{segment_path}.idx', 'rb') as index_file:
+        index_entries = list(main.historical_index_struct.iter_unpack(index_file.read()))
+    assert len(index_entries) > 1
+    with open(f'{segment_path}.seg', 'r+b') as segment_file:
+        segment_file.seek(len(main.historical_segment_header))
+        segment_file.write(b'\xff' * (index_entries[1][1] - len(main.historical_segment_header)))
+    start = index_entries[1][0]
+    assert list(main.read_historical_samples('segment_test', 'temp', start, samples[-1][0])) == \
+        [sample for sample in samples if sample[0] >= start]
+
+
+def test_buffered_samples_are_written_when_flushed(main):
+    main.buffer_historical_samples('buffer_test', {'temp': '1', 'load': '[2]'})
+    assert list(main.read_historical_samples('buffer_test', 'temp')) == []
+    assert [data for timestamp, data in main.read_buffered_historical_samples('buffer_test', 'temp', 0, time())] == \
+        ['1']
+    main.flush_historical_buffer()
+    assert [data for timestamp, data in main.read_historical_samples('buffer_test', 'load')] == ['[2]']
+    assert [data for timestamp, data in main.read_historical_samples('buffer_test', 'temp')] == ['1']
+
+
+def test_text_files_from_older_versions_are_imported(main):
+    main.write_historical_samples('import_test', 'temp', [(1500.0, '"stored"')])
+    text_path = f'{main.historical_directory}import_test/temp.txt'
+    with open(text_path, 'w') as text_file:
+        # Older versions wrote str() of the data, so it can be JSON, a Python literal or plain text
+        text_file.write('"1000.5": "12"\n'
+                        '"2000": "{\'a\': [1, True, None]}"\n'
+                        '"1200": "some text"\n'
+                        'not a sample\n'
+                        '"1700.25": "{"b": 2}"\n')
+    main.import_historical_text_file('import_test', 'temp')
+    assert list(main.read_historical_samples('import_test', 'temp')) == [
+        (1000.5, '12'), (1200.0, '"some text"'), (1500.0, '"stored"'), (1700.25, '{"b": 2}'),
+        (2000.0, '{"a": [1, true, null]}')
+    ]
+    assert os.path.exists(text_path) is False and os.path.exists(f'{text_path}.imported') is True
@@ -0,0 +1,119 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for the database journal. Each server runs in its own process, so that it can be stopped without writing its
+# queued operations to the database and then started again
+
+# Commit 30 updates, then hold an exclusive lock on the database so that the next 20 updates are accepted but never
+# committed, and stop the process without letting the database writer finish
+write_then_crash = '''
+import sqlite3
+from time import sleep, time
+import main
+system_id, system_auth = systems[0]
+client = main.app.test_client()
+for i in range(0, 30):
+    client.post('/api/v2/update/main', data={'id': system_id, 'auth': system_auth, 'value': f'committed{i}',
+                                             'data': str(i)})
+deadline = time() + 10
+while (main.database_writer_stats['checkpoint'] < 30 or len(main.database_journal_segments) > 1) and time() < deadline:
+    sleep(0.05)
+committed = {'checkpoint': main.database_writer_stats['checkpoint'],
+             'segments': sorted(os.listdir(f'{base_directory}journal'))}
+blocker = sqlite3.connect(main.database_path, timeout=0)
+blocker.execute('BEGIN EXCLUSIVE')
+statuses = [client.post('/api/v2/update/main', data={'id': system_id, 'auth': system_auth, 'value': f'pending{i}',
+                                                     'data': str(i)}).status_code for i in range(0, 20)]
+print(json.dumps({'base_directory': base_directory, 'system_id': system_id, 'committed': committed,
+                  'statuses': statuses, 'segments': sorted(os.listdir(f'{base_directory}journal'))}), flush=True)
+os._exit(0)
+'''
+
+restart = '''
+import sqlite3
+import main
+with sqlite3.connect(main.database_path) as con:
+    values = dict(con.execute('SELECT value_name, data FROM system_values'))
+    checkpoint = con.execute('SELECT sequence FROM database_journal_checkpoint').fetchone()
+print(json.dumps({'replayed': main.database_writer_stats['replayed_operations'], 'values': values,
+                  'checkpoint': checkpoint and checkpoint[0],
+                  'segments': sorted(os.listdir(f'{base_directory}journal'))}), flush=True)
+os._exit(0)
+'''
+
+
+def test_committed_segments_are_removed_and_accepted_operations_replayed(run_server_script):
+    crashed = run_server_script(write_then_crash, {'database_journal_segment_size': 1000})
+    # Every operation was committed, so only the segment being appended to is kept
+    assert crashed['committed']['checkpoint'] == 30
+    assert len(crashed['committed']['segments']) == 1
+    assert crashed['statuses'] == [200] * 20
+    # A torn write at the end of the journal was never accepted, so it is ignored
+    with open(f'{crashed["base_directory"]}journal/{crashed["segments"][-1]}', 'ab') as f:
+        f.write(b'[51, {"sql": "INSERT')
+
+    restarted = run_server_script(restart, base_directory=crashed['base_directory'])
+    assert restarted['replayed'] == 20
+    assert restarted['checkpoint'] == 50
+    assert restarted['values'] == dict([(f'committed{i}', str(i)) for i in range(0, 30)] +
+                                       [(f'pending{i}', str(i)) for i in range(0, 20)])
+    # The replayed segments are removed and a new one is started after the last sequence number
+    assert restarted['segments'] == [f'{51:020d}.jsonl']
+
+
+def test_replay_is_skipped_when_the_journal_is_empty(run_server_script):
+    restarted = run_server_script(restart)
+    assert restarted['replayed'] == 0
+    assert restarted['values'] == {}
+    assert restarted['checkpoint'] is None
+    assert restarted['segments'] == [f'{1:020d}.jsonl']
+
+
+# Make a batch fail to commit by dropping the checkpoint table that every batch writes to, then check that the batches
+# committed after it don't move the checkpoint past it
+fail_batch_then_crash = '''
+import sqlite3
+from time import sleep, time
+import main
+system_id, system_auth = systems[0]
+client = main.app.test_client()
+
+
+def update(value_name):
+    client.post('/api/v2/update/main', data={'id': system_id, 'auth': system_auth, 'value': value_name, 'data': '1'})
+
+
+def wait_for_writer():
+    deadline = time() + 10
+    while main.database_operations_queue.qsize() > 0 and time() < deadline:
+        sleep(0.05)
+    sleep(0.5)
+
+
+for i in range(0, 10):
+    update(f'committed{i}')
+wait_for_writer()
+with sqlite3.connect(main.database_path) as con:
+    con.execute('ALTER TABLE database_journal_checkpoint RENAME TO moved_checkpoint')
+update('failed')
+wait_for_writer()
+with sqlite3.connect(main.database_path) as con:
+    con.execute('ALTER TABLE moved_checkpoint RENAME TO database_journal_checkpoint')
+for i in range(0, 10):
+    update(f'later{i}')
+wait_for_writer()
+print(json.dumps({'base_directory': base_directory, 'checkpoint': main.database_writer_stats['checkpoint']}),
+      flush=True)
+os._exit(0)
+'''
+
+
+def test_batches_that_fail_to_commit_are_replayed(run_server_script):
+    crashed = run_server_script(fail_batch_then_crash)
+    # The checkpoint stays before the failed operation
+    assert crashed['checkpoint'] == 10
+
+    restarted = run_server_script(restart, base_directory=crashed['base_directory'])
+    assert restarted['replayed'] == 11
+    assert restarted['checkpoint'] == 21
+    assert 'failed' in restarted['values']
@@ -0,0 +1,155 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for searching logs with fetch/logs, checked against a search of every entry in every log file
+
+import json
+from time import sleep, time
+import pytest
+from conftest import api_base_url
+
+
+def read_all_entries(main, name):
+    entries = []
+    for segment_start, log_path, index_path in main.list_log_segments(name):
+        entries.extend(main.read_log_segment(log_path, 0))
+    return entries
+
+
+# Create a function to wait until a log has count entries written to it, returning every entry in the log
+def wait_for_entries(main, name, count):
+    deadline = time() + 10
+    while len(read_all_entries(main, name)) < count and time() < deadline:
+        sleep(0.05)
+    return read_all_entries(main, name)
+
+
+def write_entries(main, name, entries):
+    for i, data in enumerate(entries):
+        assert main.write_log(name, data) is True
+        # Spread the entries out so that index entries and rotated files have different times
+        if i % 100 == 0:
+            sleep(0.01)
+    return wait_for_entries(main, name, len(entries))
+
+
+def brute_force_search(main, entries, start=None, end=None, search=None, tail=None):
+    matches = [entry for entry in entries if (start is None or entry[0] >= start) and (end is None or entry[0] <= end)
+               and (search is None or search in entry[1])]
+    return matches[-tail:] if tail is not None else matches[:main.api_log_fetch_max_entries]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_search_log_matches_a_search_of_every_entry(main, monkeypatch, compress):
+    monkeypatch.setattr(main, 'api_log_compress', compress)
+    name = f'search_test_{compress}'
+    # Entries can contain the blank lines that separate entries
+    sent = [f'entry {i} ' + ('needle' if i % 7 == 0 else 'hay') + ('\n\n\nsecond line' if i % 50 == 0 else '')
+            for i in range(0, 2000)]
+    entries = write_entries(main, name, sent)
+    assert [data for timestamp, data in entries] == sent
+    assert len(main.list_log_segments(name)) > 2
+    assert any(log_path.endswith('.gz') for segment_start, log_path, index_path in main.list_log_segments(name)) \
+        is compress
+    times = [timestamp for timestamp, data in entries]
+    for arguments in [{}, {'start': times[500], 'end': times[1500]}, {'tail': 10}, {'tail': 10, 'search': 'needle'},
+                      {'end': times[1500], 'tail': 37}, {'start': times[500], 'end': times[1500], 'search': 'needle'},
+                      {'start': times[1990], 'tail': 100}, {'search': 'second line', 'tail': 3},
+                      {'start': times[-1] + 1}, {'search': 'not in any entry'}]:
+        assert main.search_log(name, **arguments) == brute_force_search(main, entries, **arguments), arguments
+
+
+def test_fetch_logs(main, client, new_credentials):
+    system_id, system_auth = new_credentials('system')
+    client_id, client_auth = new_credentials('client')
+    for i in range(0, 5):
+        assert client.post(f'{api_base_url}update/logging', data={'id': system_id, 'auth': system_auth,
+                                                                  'data': f'entry {i}'}).status_code == 200
+    wait_for_entries(main, system_id, 5)
+
+    def fetch(**arguments):
+        response = client.post(f'{api_base_url}fetch/logs', data=dict(arguments, id=client_id, auth=client_auth))
+        return response.status_code, json.loads(response.data) if response.status_code == 200 else None
+    status, entries = fetch(system_id=system_id)
+    assert status == 200 and [entry['data'] for entry in entries] == [f'entry {i}' for i in range(0, 5)]
+    status, entries = fetch(system_id=system_id, tail=2)
+    assert [entry['data'] for entry in entries] == ['entry 3', 'entry 4']
+    status, entries = fetch(system_id=system_id, search='entry 1')
+    assert [entry['data'] for entry in entries] == ['entry 1']
+    assert fetch(system_id=system_id, tail=0)[0] == 400
+    assert fetch(system_id=system_id, start='yesterday')[0] == 400
+    assert fetch(system_id='missing')[0] == 400
+
+
+def test_update_logging_batch(main, client, new_credentials):
+    system_id, system_auth = new_credentials('system')
+
+    def send(data):
+        return client.post(f'{api_base_url}update/logging_batch', data={'id': system_id, 'auth': system_auth,
+                                                                         'data': data}).status_code
+    assert send(json.dumps([f'entry {i}' for i in range(0, 10)])) == 200
+    assert send(json.dumps(['last entry'])) == 200
+    assert send(json.dumps(['entry', 1])) == 400
+    assert send(json.dumps({'data': 'entry'})) == 400
+    assert send(json.dumps(['entry'] * (main.api_log_batch_max_entries + 1))) == 400
+    assert [data for timestamp, data in wait_for_entries(main, system_id, 11)] == \
+        [f'entry {i}' for i in range(0, 10)] + ['last entry']
+
+
+def test_log_batch_is_only_queued_if_every_entry_fits(main, monkeypatch):
+    # The log writer is waiting on the real queue, so nothing is taken out of this one
+    monkeypatch.setattr(main, 'log_queue', main.Queue(maxsize=3))
+    monkeypatch.setattr(main, 'api_log_overflow', 'drop')
+    dropped = main.log_stats['dropped_entries']
+    assert main.write_logs('batch_test', ['a', 'b']) is True
+    assert main.write_logs('batch_test', ['c', 'd']) is False
+    assert main.write_log('batch_test', 'c') is True
+    assert [main.log_queue.get_nowait()[2] for i in range(0, 3)] == ['a', 'b', 'c']
+    assert main.log_stats['dropped_entries'] == dropped + 2
+
+
+def test_log_writer_batches_are_limited_to_log_batch_size(main, client, new_credentials, monkeypatch):
+    system_id, system_auth = new_credentials('system')
+    batch_sizes = []
+    write_log_batch = main.write_log_batch
+
+    def record_batch(batch):
+        batch_sizes.append(len(batch))
+        write_log_batch(batch)
+    monkeypatch.setattr(main, 'write_log_batch', record_batch)
+    monkeypatch.setattr(main, 'api_log_batch_size', 3)
+    assert main.write_logs(system_id, [f'entry {i}' for i in range(0, 10)]) is True
+    assert [data for timestamp, data in wait_for_entries(main, system_id, 10)] == [f'entry {i}' for i in range(0, 10)]
+    assert batch_sizes and max(batch_sizes) <= 3
+
+
+def test_fetch_logs_from_a_compressed_segment_only_decompresses_the_chunks_it_reads(main, client, new_credentials,
+                                                                                   monkeypatch):
+    monkeypatch.setattr(main, 'api_log_compress', True)
+    system_id, system_auth = new_credentials('system')
+    client_id, client_auth = new_credentials('client')
+    entries = write_entries(main, system_id, [f'entry {i}' for i in range(0, 800)])
+    segments = main.list_log_segments(system_id)
+    compressed_path, compressed_index_path = segments[0][1:]
+    assert compressed_path.endswith('.txt.gz') and compressed_index_path.endswith('.gz.idx')
+    timestamps, offsets = main.read_log_index(compressed_path, compressed_index_path)
+    assert len(offsets) > 2
+    # Each chunk is a separate gzip member, so the compressed file can still be read as a whole
+    with main.gzip.open(compressed_path, 'rb') as compressed_file:
+        assert compressed_file.read().decode('utf-8').startswith(f'{entries[0][0]}: entry 0\n\n\n')
+
+    decompressed = []
+    decompress = main.gzip.decompress
+
+    def record_decompress(data):
+        decompressed.append(len(data))
+        return decompress(data)
+    monkeypatch.setattr(main.gzip, 'decompress', record_decompress)
+    response = client.post(f'{api_base_url}fetch/logs', data={'id': client_id, 'auth': client_auth,
+                                                              'system_id': system_id, 'start': timestamps[2],
+                                                              'end': timestamps[2]})
+    assert response.status_code == 200
+    assert [entry['data'] for entry in json.loads(response.data)] == \
+        [data for timestamp, data in entries if timestamp == timestamps[2]]
+    # Only the chunk that contains the time range was decompressed
+    assert decompressed == [offsets[3] - offsets[2]]
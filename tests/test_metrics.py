@@ -0,0 +1,72 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for the latency histograms returned by admin/metrics and the request profiler
+
+import os
+import pstats
+from conftest import api_base_url
+
+
+# Create a function to parse the Prometheus text format into a dictionary of series to values, ignoring comments
+def parse_metrics(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            series, separator, value = line.rpartition(' ')
+            samples[series] = float(value)
+    return samples
+
+
+def test_metrics_include_request_latencies_and_writer_stats(client, owner, new_credentials):
+    system_id, system_auth = new_credentials('system')
+    client_id, client_auth = new_credentials('client')
+    client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu', 'data': '1'})
+    for i in range(0, 2):
+        client.post(f'{api_base_url}fetch/main', data={'id': client_id, 'auth': client_auth, 'system_id': system_id,
+                                                       'value': 'cpu'})
+    response = client.post(f'{api_base_url}admin/metrics', data={'id': owner[0], 'auth': owner[1]})
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    text = response.data.decode('utf-8')
+    assert '# TYPE status_server_http_request_duration_seconds histogram' in text
+    samples = parse_metrics(text)
+    labels = 'endpoint="api_fetch_main",method="POST",status="200"'
+    count = samples[f'status_server_http_request_duration_seconds_count{{{labels}}}']
+    assert count >= 2
+    # Buckets are cumulative, so the last one counts every request
+    buckets = [value for series, value in samples.items()
+               if series.startswith(f'status_server_http_request_duration_seconds_bucket{{{labels},le=')]
+    assert buckets == sorted(buckets) and buckets[-1] == count
+    assert samples[f'status_server_http_request_duration_seconds_sum{{{labels}}}'] > 0
+    assert samples['status_server_auth_duration_seconds_count{cached="true"}'] >= 1
+    assert samples['status_server_auth_duration_seconds_count{cached="false"}'] >= 1
+    assert samples['status_server_password_hash_duration_seconds_count'] >= 1
+    assert 'status_server_database_writer_queue_depth' in samples
+    assert 'status_server_database_writer_last_writer_lag' in samples
+    assert any(series.startswith('status_server_database_writer_lag_seconds_count') for series in samples)
+
+
+def test_metrics_are_only_for_admins_and_owners(client, new_credentials):
+    for access_level, status_code in [('client', 401), ('system', 401), ('admin', 200)]:
+        _id, _auth = new_credentials(access_level)
+        assert client.post(f'{api_base_url}admin/metrics', data={'id': _id, 'auth': _auth}).status_code == status_code
+
+
+def test_format_metrics_escapes_labels(main):
+    histograms = {('auth_duration_seconds', (('cached', 'a"b\\c\n'),)): {
+        'buckets': [1] + [0] * (len(main.metrics_buckets) - 1) + [2], 'count': 3, 'sum': 30.0}}
+    samples = parse_metrics(main.format_metrics(histograms, {'group': {'number': 5, 'text': 'ignored'}}))
+    assert samples['status_server_group_number'] == 5 and 'status_server_group_text' not in samples
+    assert samples['status_server_auth_duration_seconds_bucket{cached="a\\"b\\\\c\\n",le="0.0005"}'] == 1
+    assert samples['status_server_auth_duration_seconds_bucket{cached="a\\"b\\\\c\\n",le="10.0"}'] == 1
+    assert samples['status_server_auth_duration_seconds_bucket{cached="a\\"b\\\\c\\n",le="+Inf"}'] == 3
+    assert samples['status_server_auth_duration_seconds_count{cached="a\\"b\\\\c\\n"}'] == 3
+
+
+def test_sampled_requests_are_profiled(main, client, owner, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, 'api_profile_fraction', 1)
+    monkeypatch.setattr(main, 'profile_directory', f'{tmp_path}/')
+    assert client.post(f'{api_base_url}admin/stats', data={'id': owner[0], 'auth': owner[1]}).status_code == 200
+    profiles = os.listdir(tmp_path)
+    assert len(profiles) == 1 and profiles[0].endswith('_api_admin_stats.prof')
+    assert pstats.Stats(f'{tmp_path}/{profiles[0]}').total_calls > 0
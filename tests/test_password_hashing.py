@@ -0,0 +1,24 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for hashing passwords in the process pool used by admin/new_auth
+
+# Pretend that the server was started with "python main.py", then check which modules a process of the pool loads
+hash_in_pool = '''
+import main
+sys.modules['__main__'].__file__ = main.__file__
+hashed = main.hash_passwords(['first', 'second'])
+modules = main.get_password_hash_pool().submit(eval, 'sorted(__import__("sys").modules)').result()
+print(json.dumps({'verified': [main.verify_password(hashed[0], 'first'), main.verify_password(hashed[1], 'second'),
+                               main.verify_password(hashed[0], 'second')],
+                  'modules': modules}), flush=True)
+main.get_password_hash_pool().shutdown()
+os._exit(0)
+'''
+
+
+def test_pool_processes_only_import_password_hashing(run_server_script):
+    result = run_server_script(hash_in_pool)
+    assert result['verified'] == [True, True, False]
+    assert 'password_hashing' in result['modules']
+    assert not {'main', 'flask', 'numpy', 'yaml'} & set(result['modules'])
@@ -0,0 +1,124 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for merge patches (RFC 7396) and JSON patches (RFC 6902), using the examples from each RFC
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from conftest import api_base_url
+
+# RFC 7396 appendix A, as (document, patch, result)
+merge_patch_examples = [
+    ({'a': 'b'}, {'a': 'c'}, {'a': 'c'}),
+    ({'a': 'b'}, {'b': 'c'}, {'a': 'b', 'b': 'c'}),
+    ({'a': 'b'}, {'a': None}, {}),
+    ({'a': 'b', 'b': 'c'}, {'a': None}, {'b': 'c'}),
+    ({'a': ['b']}, {'a': 'c'}, {'a': 'c'}),
+    ({'a': 'c'}, {'a': ['b']}, {'a': ['b']}),
+    ({'a': {'b': 'c'}}, {'a': {'b': 'd', 'c': None}}, {'a': {'b': 'd'}}),
+    ({'a': [{'b': 'c'}]}, {'a': [1]}, {'a': [1]}),
+    (['a', 'b'], ['c', 'd'], ['c', 'd']),
+    ({'a': 'b'}, ['c'], ['c']),
+    ({'a': 'foo'}, None, None),
+    ({'a': 'foo'}, 'bar', 'bar'),
+    ({'e': None}, {'a': 1}, {'e': None, 'a': 1}),
+    ([1, 2], {'a': 'b', 'c': None}, {'a': 'b'}),
+    ({}, {'a': {'bb': {'ccc': None}}}, {'a': {'bb': {}}})
+]
+
+# RFC 6902 appendix A, as (document, patch, result)
+json_patch_examples = [
+    ({'foo': 'bar'}, [{'op': 'add', 'path': '/baz', 'value': 'qux'}], {'baz': 'qux', 'foo': 'bar'}),
+    ({'foo': ['bar', 'baz']}, [{'op': 'add', 'path': '/foo/1', 'value': 'qux'}], {'foo': ['bar', 'qux', 'baz']}),
+    ({'baz': 'qux', 'foo': 'bar'}, [{'op': 'remove', 'path': '/baz'}], {'foo': 'bar'}),
+    ({'foo': ['bar', 'qux', 'baz']}, [{'op': 'remove', 'path': '/foo/1'}], {'foo': ['bar', 'baz']}),
+    ({'baz': 'qux', 'foo': 'bar'}, [{'op': 'replace', 'path': '/baz', 'value': 'boo'}], {'baz': 'boo', 'foo': 'bar'}),
+    ({'foo': {'bar': 'baz', 'waldo': 'fred'}, 'qux': {'corge': 'grault'}},
+     [{'op': 'move', 'from': '/foo/waldo', 'path': '/qux/thud'}],
+     {'foo': {'bar': 'baz'}, 'qux': {'corge': 'grault', 'thud': 'fred'}}),
+    ({'foo': ['all', 'grass', 'cows', 'eat']}, [{'op': 'move', 'from': '/foo/1', 'path': '/foo/3'}],
+     {'foo': ['all', 'cows', 'eat', 'grass']}),
+    ({'baz': 'qux', 'foo': ['a', 2, 'c']},
+     [{'op': 'test', 'path': '/baz', 'value': 'qux'}, {'op': 'test', 'path': '/foo/1', 'value': 2}],
+     {'baz': 'qux', 'foo': ['a', 2, 'c']}),
+    ({'foo': 'bar'}, [{'op': 'add', 'path': '/child', 'value': {'grandchild': {}}}],
+     {'foo': 'bar', 'child': {'grandchild': {}}}),
+    ({'foo': 'bar'}, [{'op': 'add', 'path': '/baz', 'value': 'qux', 'xyz': 123}], {'foo': 'bar', 'baz': 'qux'}),
+    ({'/': 9, '~1': 10}, [{'op': 'test', 'path': '/~01', 'value': 10}], {'/': 9, '~1': 10}),
+    ({'foo': ['bar']}, [{'op': 'add', 'path': '/foo/-', 'value': ['abc', 'def']}], {'foo': ['bar', ['abc', 'def']]}),
+    ({'a/b': 1, 'm~n': 2}, [{'op': 'copy', 'from': '/a~1b', 'path': '/m~0n'}], {'a/b': 1, 'm~n': 1}),
+    ({'foo': 'bar'}, [{'op': 'add', 'path': '', 'value': [1]}], [1]),
+    # Numbers match if they are numerically equal
+    ({'x': [1, {'y': True}]}, [{'op': 'test', 'path': '/x', 'value': [1.0, {'y': True}]}], {'x': [1, {'y': True}]})
+]
+
+# Patches that must raise ValueError, as (document, patch)
+invalid_json_patches = [
+    ({'baz': 'qux'}, [{'op': 'test', 'path': '/baz', 'value': 'bar'}]),
+    ({'foo': 'bar'}, [{'op': 'add', 'path': '/baz/bat', 'value': 'qux'}]),
+    ({'/': 9, '~1': 10}, [{'op': 'test', 'path': '/~01', 'value': '10'}]),
+    ({'foo': [1]}, [{'op': 'add', 'path': '/foo/2', 'value': 1}]),
+    ({}, [{'op': 'remove', 'path': '/missing'}]),
+    ({}, [{'op': 'unknown', 'path': '/a'}]),
+    ({'a': {}}, [{'op': 'move', 'from': '/a', 'path': '/a/b'}]),
+    ({'a': 1}, [{'op': 'replace', 'path': '/a', 'value': 2}, {'op': 'remove', 'path': '/b'}]),
+    # test only matches values of the same JSON type
+    ({'x': 1}, [{'op': 'test', 'path': '/x', 'value': True}]),
+    ({'x': 0}, [{'op': 'test', 'path': '/x', 'value': False}]),
+    ({'x': True}, [{'op': 'test', 'path': '/x', 'value': 1}]),
+    ({'x': [1, {'y': False}]}, [{'op': 'test', 'path': '/x', 'value': [1, {'y': 0}]}]),
+    ({'x': {'y': 1}}, [{'op': 'test', 'path': '/x', 'value': {'y': 1, 'z': None}}]),
+    ({'x': '1'}, [{'op': 'test', 'path': '/x', 'value': 1}])
+]
+
+
+@pytest.mark.parametrize('document, patch, result', merge_patch_examples)
+def test_merge_patch(main, document, patch, result):
+    assert main.apply_merge_patch(document, patch) == result
+
+
+@pytest.mark.parametrize('document, patch, result', json_patch_examples)
+def test_json_patch(main, document, patch, result):
+    assert main.apply_json_patch(document, patch) == result
+
+
+@pytest.mark.parametrize('document, patch', invalid_json_patches)
+def test_invalid_json_patch(main, document, patch):
+    with pytest.raises(ValueError):
+        main.apply_json_patch(document, patch)
+
+
+def test_update_main_applies_patches_in_order(client, new_credentials):
+    system_id, system_auth = new_credentials('system')
+    client_id, client_auth = new_credentials('client')
+
+    def update(**arguments):
+        return client.post(f'{api_base_url}update/main', data=dict(arguments, id=system_id, auth=system_auth,
+                                                                    value='disk')).status_code
+
+    def fetch():
+        return json.loads(client.post(f'{api_base_url}fetch/main', data={'id': client_id, 'auth': client_auth,
+                                                                         'system_id': system_id, 'value': 'disk'}).data)
+    assert update(data=json.dumps({'SDA1': {'total': 1024, 'used': 500}, 'SDB1': {'total': 10}})) == 200
+    assert update(patch='merge', data=json.dumps({'SDA1': {'used': 510}, 'SDB1': None})) == 200
+    assert update(patch='json', data=json.dumps([{'op': 'add', 'path': '/SDA1/free', 'value': 514}])) == 200
+    assert fetch() == {'SDA1': {'total': 1024, 'used': 510, 'free': 514}}
+    # A patch that can't be applied is rejected and leaves the value as it was
+    assert update(patch='json', data=json.dumps([{'op': 'remove', 'path': '/SDB1'}])) == 400
+    assert update(patch='unknown', data='{}') == 400
+    assert fetch() == {'SDA1': {'total': 1024, 'used': 510, 'free': 514}}
+
+
+def test_concurrent_patches_are_all_applied(main, client, new_credentials):
+    system_id, system_auth = new_credentials('system')
+    client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'keys',
+                                                    'data': '{}'})
+
+    def update(i):
+        return main.app.test_client().post(f'{api_base_url}update/main', data={
+            'id': system_id, 'auth': system_auth, 'value': 'keys', 'patch': 'merge', 'data': json.dumps({str(i): i})
+        }).status_code
+    with ThreadPoolExecutor(8) as executor:
+        assert set(executor.map(update, range(0, 200))) == {200}
+    assert json.loads(main.get_system_value(system_id, 'keys')[0]) == {str(i): i for i in range(0, 200)}
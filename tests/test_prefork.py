@@ -0,0 +1,77 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for the prefork serving mode, with a writer process and two request workers that each run in their own process
+
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from time import sleep, time
+from conftest import repo_directory
+
+create_server = '''
+print(json.dumps({'base_directory': base_directory, 'system': systems[0]}), flush=True)
+'''
+
+# Wait for an update from another request worker, after writing a file to say that this worker has connected
+wait_for_update = '''
+from time import sleep, time
+import main
+initial_value = main.get_system_value(system_id, 'cpu')[0]
+open(f'{base_directory}worker_ready', 'w').close()
+deadline = time() + 20
+while main.get_system_value(system_id, 'cpu')[0] is None and time() < deadline:
+    sleep(0.01)
+print(json.dumps({'role': main.server_role, 'initial_value': initial_value,
+                  'value': main.get_system_value(system_id, 'cpu')[0],
+                  'heartbeat': main.get_system_heartbeat(system_id)}), flush=True)
+os._exit(0)
+'''
+
+send_update = '''
+import main
+client = main.app.test_client()
+statuses = [client.post('/api/v2/update/heartbeat', data={'id': system_id, 'auth': system_auth}).status_code,
+            client.post('/api/v2/update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu',
+                                                     'data': '{"load": 42}'}).status_code]
+print(json.dumps({'role': main.server_role, 'statuses': statuses}), flush=True)
+os._exit(0)
+'''
+
+
+def test_updates_are_replicated_to_every_request_worker(run_server_script, start_server_script):
+    server = run_server_script(create_server, {'server_mode': 'prefork'})
+    base_directory = server['base_directory']
+    system_id, system_auth = server['system']
+    writer = subprocess.Popen([sys.executable, os.path.join(repo_directory, 'main.py'), 'writer'],
+                              env=dict(os.environ, CONF_FILE=f'{base_directory}conf.yaml'),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_worker = start_server_script(f'system_id = {system_id!r}\n{wait_for_update}',
+                                              base_directory=base_directory)
+        deadline = time() + 20
+        while not os.path.exists(f'{base_directory}worker_ready') and time() < deadline:
+            sleep(0.05)
+        sent = run_server_script(f'system_id, system_auth = {system_id!r}, {system_auth!r}\n{send_update}',
+                                 base_directory=base_directory)
+        assert sent == {'role': 'worker', 'statuses': [200, 200]}
+        received = wait_for_worker()
+        assert received['role'] == 'worker'
+        assert received['initial_value'] is None
+        assert json.loads(received['value']) == {'load': 42}
+        assert received['heartbeat'] is not None
+        # Only the writer process writes to the database
+        deadline = time() + 10
+        while time() < deadline:
+            with sqlite3.connect(f'{base_directory}main.sqlite') as con:
+                rows = con.execute('SELECT data FROM system_values WHERE system_id = ? AND value_name = ?',
+                                   (system_id, 'cpu')).fetchall()
+            if rows:
+                break
+            sleep(0.05)
+        assert [json.loads(data) for data, in rows] == [{'load': 42}]
+    finally:
+        writer.terminate()
+        writer.wait(10)
@@ -0,0 +1,53 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for the per system ID token buckets. The tests run with rate_limit_heartbeat at 1 request per second and
+# rate_limit_burst at 5 seconds, and the other limits disabled
+
+from collections import OrderedDict
+from conftest import api_base_url
+
+
+def test_heartbeats_over_the_burst_are_rejected(main, client, new_credentials):
+    system_id, system_auth = new_credentials('system')
+    rejected = main.rate_limit_stats['heartbeat']
+    statuses = [client.post(f'{api_base_url}update/heartbeat', data={'id': system_id, 'auth': system_auth}).status_code
+                for i in range(0, 5)]
+    assert statuses == [200] * 5
+    response = client.post(f'{api_base_url}update/heartbeat', data={'id': system_id, 'auth': system_auth})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    # Requests with the wrong auth still count towards the limit, and are rejected before the password is checked
+    assert client.post(f'{api_base_url}update/heartbeat', data={'id': system_id, 'auth': 'wrong'}).status_code == 429
+    assert main.rate_limit_stats['heartbeat'] == rejected + 2
+
+
+def test_batch_heartbeats_are_charged_to_the_heartbeat_limit(client, new_credentials):
+    system_id, system_auth = new_credentials('system')
+
+    def batch(heartbeat):
+        return client.post(f'{api_base_url}update/batch', data={'id': system_id, 'auth': system_auth,
+                                                                'data': '{"a": 1}', 'heartbeat': heartbeat}).status_code
+    assert [batch('true') for i in range(0, 5)] == [200] * 5
+    assert batch('true') == 429
+    # Without a heartbeat only the values limit applies, which is disabled
+    assert batch('false') == 200
+
+
+def test_tokens_are_taken_from_every_class_or_none(main, monkeypatch):
+    monkeypatch.setitem(main.rate_limits, 'values', 1000)
+    for i in range(0, 5):
+        assert main.take_rate_limit_tokens(['heartbeat', 'values'], 'token_test') == 0
+    assert main.take_rate_limit_tokens(['heartbeat', 'values'], 'token_test') > 0
+    # The values bucket wasn't charged for the rejected request
+    assert main.rate_limit_buckets[('values', 'token_test')][0] > main.rate_limit_capacity('values') - 6
+
+
+def test_least_recently_used_buckets_are_removed(main, monkeypatch):
+    monkeypatch.setattr(main, 'rate_limit_buckets', OrderedDict())
+    monkeypatch.setattr(main, 'api_rate_limit_table_size', 3)
+    for _id in ['lru_a', 'lru_b', 'lru_c']:
+        main.take_rate_limit_tokens(['heartbeat'], _id)
+    main.take_rate_limit_tokens(['heartbeat'], 'lru_a')
+    main.take_rate_limit_tokens(['heartbeat'], 'lru_d')
+    assert list(main.rate_limit_buckets) == [('heartbeat', 'lru_c'), ('heartbeat', 'lru_a'), ('heartbeat', 'lru_d')]
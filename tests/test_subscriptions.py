@@ -0,0 +1,150 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for fetch/subscribe, both the Server-Sent Events server on subscribe_port and the long-poll endpoint
+
+import base64
+import json
+import socket
+import threading
+import pytest
+from conftest import api_base_url, test_api_config
+
+
+def basic_authorization(_id, auth):
+    return 'Basic ' + base64.b64encode(f'{_id}:{auth}'.encode('utf-8')).decode('ascii')
+
+
+# Create a function to send a request to the Server-Sent Events server, returning the status code, the headers and a
+# file to read the rest of the response from
+def open_stream(query='', headers=None, method='GET', path=f'{api_base_url}fetch/subscribe'):
+    connection = socket.create_connection((test_api_config['subscribe_address'], test_api_config['subscribe_port']),
+                                          timeout=5)
+    request = f'{method} {path}?{query} HTTP/1.1\r\nHost: localhost\r\n'
+    request += ''.join(f'{name}: {value}\r\n' for name, value in (headers or {}).items())
+    connection.sendall(f'{request}\r\n'.encode('utf-8'))
+    response = connection.makefile('rb')
+    connection.close()
+    status_code = int(response.readline().split(b' ')[1])
+    response_headers = {}
+    for line in iter(response.readline, b'\r\n'):
+        name, separator, value = line.decode('latin-1').partition(':')
+        response_headers[name.strip().lower()] = value.strip()
+    return status_code, response_headers, response
+
+
+# Create a function to count the running threads, apart from the fixed size pool that checks the credentials of new
+# subscribers
+def count_threads():
+    return len([thread for thread in threading.enumerate() if not thread.name.startswith('subscription_auth')])
+
+
+# Create a function to read the next message from an event stream as a dictionary of its fields, skipping comments
+def read_message(response):
+    message = {}
+    while True:
+        line = response.readline().decode('utf-8').rstrip('\n')
+        if line == '' and message:
+            return message
+        if line and not line.startswith(':'):
+            field, separator, value = line.partition(': ')
+            message[field] = value
+
+
+@pytest.fixture
+def subscriber(new_credentials):
+    return new_credentials('client')
+
+
+def test_stream_sends_changes_to_subscribers_using_basic_authentication(client, new_credentials, subscriber):
+    system_id, system_auth = new_credentials('system')
+    status_code, headers, response = open_stream(f'system_ids={system_id}',
+                                                 {'Authorization': basic_authorization(*subscriber)})
+    assert status_code == 200 and headers['content-type'] == 'text/event-stream'
+    client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu',
+                                                    'data': '{"load": 1}'})
+    message = read_message(response)
+    event = json.loads(message['data'])
+    assert event == {'seq': int(message['id']), 'system_id': system_id, 'type': 'value', 'value': 'cpu',
+                     'data': {'load': 1}}
+    response.close()
+
+
+def test_stream_accepts_credentials_in_the_query_string(client, new_credentials, subscriber):
+    system_id, system_auth = new_credentials('system')
+    status_code, headers, response = open_stream(f'id={subscriber[0]}&auth={subscriber[1]}&system_ids={system_id}'
+                                                 f'&values=b')
+    assert status_code == 200
+    # Only the values that were asked for are sent
+    for value_name in ['a', 'b']:
+        client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': value_name,
+                                                        'data': '1'})
+    assert json.loads(read_message(response)['data'])['value'] == 'b'
+    response.close()
+
+
+def test_stream_catches_up_from_the_last_event_id(main, client, new_credentials, subscriber):
+    system_id, system_auth = new_credentials('system')
+    cursor = main.subscription_sequence
+    for i in range(0, 3):
+        client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu',
+                                                        'data': str(i)})
+    status_code, headers, response = open_stream(f'system_ids={system_id}', {
+        'Authorization': basic_authorization(*subscriber), 'Last-Event-ID': str(cursor)})
+    assert [json.loads(read_message(response)['data'])['data'] for i in range(0, 3)] == [0, 1, 2]
+    response.close()
+    # A cursor from before a restart means that events were missed
+    status_code, headers, response = open_stream(f'cursor={cursor + 1000000}',
+                                                 {'Authorization': basic_authorization(*subscriber)})
+    message = read_message(response)
+    assert message['event'] == 'missed' and json.loads(message['data']) == {'cursor': int(message['id'])}
+    response.close()
+
+
+@pytest.mark.parametrize('query, headers, method, path, expected_status', [
+    ('', {}, 'GET', None, 400),
+    ('id=missing&auth=wrong', {}, 'GET', None, 401),
+    ('', {'Authorization': 'Basic not-base64!'}, 'GET', None, 400),
+    ('', {'Authorization': basic_authorization('missing', 'wrong')}, 'GET', None, 401),
+    ('cursor=first', {'subscriber': True}, 'GET', None, 400),
+    ('', {'subscriber': True}, 'POST', None, 405),
+    ('', {'subscriber': True}, 'GET', f'{api_base_url}fetch/main', 404)
+])
+def test_stream_errors(subscriber, query, headers, method, path, expected_status):
+    if headers.pop('subscriber', False):
+        headers['Authorization'] = basic_authorization(*subscriber)
+    status_code, response_headers, response = open_stream(query, headers, method,
+                                                          path or f'{api_base_url}fetch/subscribe')
+    assert status_code == expected_status
+    assert response.read(int(response_headers['content-length'])).startswith(b'Error: ')
+    response.close()
+
+
+def test_idle_subscribers_do_not_need_a_thread_each(main, client, new_credentials, subscriber):
+    system_id, system_auth = new_credentials('system')
+    threads = count_threads()
+    streams = [open_stream(f'system_ids={system_id}', {'Authorization': basic_authorization(*subscriber)})
+               for i in range(0, 200)]
+    assert [status_code for status_code, headers, response in streams] == [200] * 200
+    assert count_threads() == threads
+    client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu',
+                                                    'data': '1'})
+    for status_code, headers, response in streams:
+        assert json.loads(read_message(response)['data'])['system_id'] == system_id
+        response.close()
+
+
+def test_long_poll_waits_for_a_change(client, new_credentials, subscriber):
+    system_id, system_auth = new_credentials('system')
+    arguments = {'id': subscriber[0], 'auth': subscriber[1], 'system_ids': system_id}
+    cursor = json.loads(client.post(f'{api_base_url}fetch/subscribe', data=arguments).data)['cursor']
+    thread = threading.Timer(0.2, lambda: client.post(f'{api_base_url}update/main', data={
+        'id': system_id, 'auth': system_auth, 'value': 'cpu', 'data': '1'}))
+    thread.start()
+    result = json.loads(client.post(f'{api_base_url}fetch/subscribe',
+                                    data=dict(arguments, cursor=cursor, timeout=5)).data)
+    thread.join()
+    assert result['missed'] is False
+    assert [(event['system_id'], event['value'], event['data']) for event in result['events']] == \
+        [(system_id, 'cpu', 1)]
+    assert result['cursor'] == result['events'][-1]['seq']
@@ -0,0 +1,76 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# Tests for the in-memory system state that fetch/main and fetch/heartbeat are served from
+
+import json
+import pytest
+from conftest import api_base_url
+
+
+@pytest.fixture
+def fetch(client, new_credentials):
+    """Return a function that sends a fetch request with client credentials, returning (status code, data)."""
+    client_id, client_auth = new_credentials('client')
+
+    def send(endpoint, **arguments):
+        response = client.post(f'{api_base_url}fetch/{endpoint}', data=dict(arguments, id=client_id, auth=client_auth))
+        return response.status_code, response.data.decode('utf-8')
+    return send
+
+
+def test_fetches_read_their_writes_without_the_database(main, client, new_credentials, fetch, monkeypatch):
+    system_id, system_auth = new_credentials('system')
+    assert client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu',
+                                                           'data': '{"load": 1}'}).status_code == 200
+    # Check the credentials once so that they are cached, after that nothing should need the database
+    assert fetch('main', system_id=system_id, value='cpu') == (200, '{"load": 1}')
+
+    def no_database(*args, **kwargs):
+        raise AssertionError('the database was used')
+    monkeypatch.setattr(main.sqlite3, 'connect', no_database)
+    for i in range(0, 3):
+        assert client.post(f'{api_base_url}update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu',
+                                                               'data': json.dumps({'load': i})}).status_code == 200
+        assert json.loads(fetch('main', system_id=system_id, value='cpu')[1]) == {'load': i}
+    assert client.post(f'{api_base_url}update/heartbeat', data={'id': system_id, 'auth': system_auth}).status_code \
+        == 200
+    status_code, heartbeat = fetch('heartbeat', system_id=system_id)
+    assert status_code == 200 and heartbeat == main.get_system_heartbeat(system_id)
+
+
+def test_fetch_errors(new_credentials, fetch):
+    system_id, system_auth = new_credentials('system')
+    assert fetch('heartbeat', system_id=system_id)[0] == 400
+    assert fetch('heartbeat', system_id='missing')[0] == 400
+    assert fetch('main', system_id=system_id, value='never_sent')[0] == 400
+    assert fetch('main', system_id='missing', value='cpu')[0] == 400
+
+
+# Send a value and a heartbeat, wait for them to be written to the database, then stop without any cleanup
+write_state = '''
+import main
+system_id, system_auth = systems[0]
+client = main.app.test_client()
+client.post('/api/v2/update/main', data={'id': system_id, 'auth': system_auth, 'value': 'cpu', 'data': '[1, 2]'})
+client.post('/api/v2/update/heartbeat', data={'id': system_id, 'auth': system_auth})
+main.queue_database_operation(['transaction', []]).result(timeout=10)
+print(json.dumps({'base_directory': base_directory, 'system_id': system_id,
+                  'heartbeat': main.get_system_heartbeat(system_id)}), flush=True)
+os._exit(0)
+'''
+
+read_state = '''
+import main
+system_id = {system_id!r}
+print(json.dumps({{'value': main.get_system_value(system_id, 'cpu')[0],
+                  'heartbeat': main.get_system_heartbeat(system_id)}}), flush=True)
+os._exit(0)
+'''
+
+
+def test_state_is_loaded_from_the_database_on_startup(run_server_script):
+    written = run_server_script(write_state)
+    restarted = run_server_script(read_state.format(system_id=written['system_id']),
+                                  base_directory=written['base_directory'])
+    assert restarted == {'value': '[1, 2]', 'heartbeat': written['heartbeat']}
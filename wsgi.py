@@ -0,0 +1,8 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/) All Rights Reserved.
+# For licensing enquiries please contact Alex Verrico (https://alexverrico.com/)
+
+# WSGI entry point for running request workers under a WSGI server, for example "gunicorn --workers 4 wsgi:app".
+# Importing main starts the process in the role set by server_mode in conf.yaml: with "single" every request worker
+# would write to the database itself, so use "prefork" and start the writer process with "python main.py writer" first.
+# Don't preload the app, each request worker must connect to the writer process after it has been forked
+from main import app